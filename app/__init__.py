@@ -43,6 +43,12 @@ import toml
 
 from flask import Flask, current_app
 
+from app.compression import init_compression
+from app.elastic import init_elastic
+from app.feed import init_feed
+from app.meta import init_meta
+from app.metrics import init_metrics
+from app.serializer import init_serializer
 from app.utils import handle_exception
 from . import api_json
 
@@ -62,7 +68,18 @@ def create_app(test_config=None):
     else:
         app.config.from_mapping(test_config)
 
+    init_serializer(app)
+    init_compression(app)
+    init_elastic(app)
+    init_feed(app)
+    init_meta(app)
+    init_metrics(app)
+
     app.register_blueprint(api_json.bp)
     return app
 
-app = create_app()
+# the app used by `flask run` and WSGI servers, configured from
+# instance/config.toml -- tools that only ever build their own app from a
+# test config (e.g. the benchmarks) can skip it by setting GRIP_API_NO_APP
+if not os.environ.get('GRIP_API_NO_APP'):
+    app = create_app()
@@ -38,51 +38,71 @@
 # academic research and education purposes is subject to the conditions and
 # copyright notices in the source code files and in the included LICENSE file.
 
-from ipaddress import ip_network
 import elasticsearch
 from flask import Blueprint, request, current_app
-import requests, json
 
 from app.elastic import getElastic
-from app.utils import handle_exception, post_process, validate_event_id
+from app.feed import FEED_RETRY_AFTER, FeedFull, getFeed
+from app.meta import getMeta
+from app.metrics import cache_stats
+from app.utils import handle_exception, post_process, post_process_ndjson, \
+        parse_event_id, parse_pfx_fingerprint, validate_pfx_fingerprint, \
+        get_event_id_list, batch_result, is_conditional, is_not_modified, \
+        not_modified_response, post_process_conditional
 from app.GripException import ValidationError
 
 bp = Blueprint('json', __name__, url_prefix="/json")
 
 @bp.route('/tags', methods=['GET'])
 def json_tags():
-    r = requests.get(current_app.config['META_SERVICE'] + "/tags")
-    data = json.loads(r.content.decode('utf-8'))
-    return post_process(data), 200
+    meta = getMeta()
+    data = meta.get("/tags")
+    return post_process_conditional(data, meta.validator("/tags", data))
 
 @bp.route('/asndrop', methods=['GET'])
 def json_asndrop():
-    r = requests.get(current_app.config['META_SERVICE'] + "/asndrop")
-    data = json.loads(r.content.decode('utf-8'))
-    return post_process(data), 200
+    meta = getMeta()
+    data = meta.get("/asndrop")
+    return post_process_conditional(data, meta.validator("/asndrop", data))
 
 @bp.route('/blacklist', methods=['GET'])
 def json_blacklist():
-    r = requests.get(current_app.config['META_SERVICE'] + "/blacklist")
-    data = json.loads(r.content.decode('utf-8'))
-    return post_process(data), 200
+    meta = getMeta()
+    data = meta.get("/blacklist")
+    return post_process_conditional(data, meta.validator("/blacklist", data))
 
 @bp.route('/blocklist', methods=['GET'])
 def json_blocklist():
-    r = requests.get(current_app.config['META_SERVICE'] + "/blacklist")
-    data = json.loads(r.content.decode('utf-8'))
+    meta = getMeta()
+    blacklist = meta.get("/blacklist")
+    validator = meta.validator("/blacklist", blacklist)
+    if validator is not None:
+        validator = validator.derive("blocklist")
+
+    # shares the cached /blacklist payload, so copy before renaming
+    data = dict(blacklist)
     # rename blacklist to blocklist because that's what the caller will expect
     data['blocklist'] = data.pop('blacklist')
 
-    return post_process(data), 200
+    return post_process_conditional(data, validator)
 
 @bp.route('/event/id/<evid>', methods=['GET'])
 def json_event_by_id(evid):
     try:
         es = getElastic()
-        validate_event_id(evid)
-        pending = es.getEventById(evid)
-        return post_process(pending), 200
+        eventid = parse_event_id(evid)
+
+        # check whether the client's copy (of either representation) is
+        # current before fetching the whole event, which may be several MB
+        if is_conditional(request):
+            validator = es.getEventValidator(eventid)
+            for current in es.eventValidators(validator):
+                if is_not_modified(request, current):
+                    return not_modified_response(current)
+
+        pending = es.getEventById(eventid, raw=True)
+        return post_process_conditional(pending,
+                es.eventValidator(eventid, pending))
 
     except elasticsearch.exceptions.NotFoundError:
         return handle_exception('The requested event was not found', 404)
@@ -93,49 +113,88 @@ def json_event_by_id(evid):
     except Exception as e:
         return handle_exception(e.args[0], 500)
 
+@bp.route('/event/ids', methods=['GET', 'POST'])
+def json_events_by_ids():
+    try:
+        body = None
+        if request.method == 'POST':
+            body = request.get_json(force=True, silent=True)
+            if body is None:
+                body = ""
+        evids = get_event_id_list(request.args, body,
+                current_app.config.get('BATCH_MAX_IDS', 1000))
+        es = getElastic()
+
+        results = (batch_result(*r) for r in es.getEventsByIds(evids))
+        return post_process_ndjson(results), 200
+
+    except ValidationError as v:
+        return handle_exception(v.args[0], 400)
+
 @bp.route('/events', methods=['GET'])
 def json_search_events():
     args = request.args
 
-    es = getElastic()
+    try:
+        es = getElastic()
+
+        if args.get('format') == 'ndjson':
+            # stream every matching event, ignoring start and length
+            return post_process_ndjson(es.exportEvents(args)), 200
+
+        pending = es.lookupEvents(args)
+        return post_process(pending), 200
+
+    except ValidationError as v:
+        return handle_exception(v.args[0], 400)
+
+@bp.route('/events/stats', methods=['GET'])
+def json_event_stats():
+    try:
+        es = getElastic()
+        return post_process(es.eventStats(request.args)), 200
 
-    pending = es.lookupEvents(args)
-    return post_process(pending), 200
+    except ValidationError as v:
+        return handle_exception(v.args[0], 400)
+
+@bp.route('/events/live', methods=['GET'])
+def json_live_events():
+    feed = getFeed()
+    try:
+        sub = feed.subscribe(request.args)
+
+    except ValidationError as v:
+        return handle_exception(v.args[0], 400)
+
+    except FeedFull:
+        response = handle_exception("Too many live feed subscribers, please try again later", 503)
+        response.headers['Retry-After'] = str(FEED_RETRY_AFTER)
+        return response
+
+    return current_app.response_class(feed.stream(sub),
+            mimetype="text/event-stream",
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@bp.route('/cache_stats', methods=['GET'])
+def json_cache_stats():
+    return post_process(cache_stats(current_app)), 200
 
 @bp.route('/pfx_event/id/<evid>/<prefix>', methods=['GET'])
 def json_pfx_event_by_id(evid, prefix):
     try:
         es = getElastic()
-        validate_event_id(evid)
-        fullev = es.getEventById(evid)
-
-        replaced = prefix.replace("-", "/")
-        search = replaced.split("_")
-        
-        for prefix_addr in search:
-            # Validating IP addresses, this line will throw a ValueError
-            # If IP prefix validation fails
-            _ = ip_network(prefix_addr)
-
-        if fullev['event_type'] in ['moas', 'edges']:
-            if len(search) != 1:
-                err_str = f"{fullev['event_type']} must only have one prefix in the fingerprint for a pfx_event!"
-                raise ValidationError(err_str)
-            
-            for p in fullev['pfx_events']:
-                if p['details']['prefix'] == search[0]:
-                    return post_process(p), 200
-
-        elif fullev['event_type'] in ['defcon', 'submoas']:
-
-            if len(search) != 2:
-                err_str = f"{fullev['event_type']} must have two prefixes (sub-pfx and super-pfx) in the fingerprint for a pfx_event!"
-                raise ValidationError(err_str)
-            
-            for p in fullev['pfx_events']:
-                if p['details']['sub_pfx'] == search[0]:
-                    if p['details']['super_pfx'] == search[1]:
-                        return post_process(p), 200
+        eventid = parse_event_id(evid)
+
+        search = parse_pfx_fingerprint(prefix)
+
+        # only the matching pfx_event is fetched from elasticsearch, but
+        # we still need to know that the event exists before validating
+        # the prefixes so that errors are reported in the same order
+        event_type, pfxevent = es.getPfxEventById(eventid, search)
+        validate_pfx_fingerprint(event_type, search)
+
+        if pfxevent is not None:
+            return post_process(pfxevent), 200
 
         return handle_exception('No events with the given search parameters were found', 404)
     
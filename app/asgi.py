@@ -0,0 +1,567 @@
+# This source code is Copyright (c) 2023 Georgia Tech Research Corporation. All
+# Rights Reserved. Permission to copy, modify, and distribute this software and
+# its documentation for academic research and education purposes, without fee,
+# and without a written agreement is hereby granted, provided that the above
+# copyright notice, this paragraph and the following three paragraphs appear in
+# all copies. Permission to make use of this software for other than academic
+# research and education purposes may be obtained by contacting:
+#
+#  Office of Technology Licensing
+#  Georgia Institute of Technology
+#  926 Dalney Street, NW
+#  Atlanta, GA 30318
+#  404.385.8066
+#  techlicensing@gtrc.gatech.edu
+#
+# This software program and documentation are copyrighted by Georgia Tech
+# Research Corporation (GTRC). The software program and documentation are 
+# supplied "as is", without any accompanying services from GTRC. GTRC does
+# not warrant that the operation of the program will be uninterrupted or
+# error-free. The end-user understands that the program was developed for
+# research purposes and is advised not to rely exclusively on the program for
+# any reason.
+#
+# IN NO EVENT SHALL GEORGIA TECH RESEARCH CORPORATION BE LIABLE TO ANY PARTY FOR
+# DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING
+# LOST PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION,
+# EVEN IF GEORGIA TECH RESEARCH CORPORATION HAS BEEN ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE. GEORGIA TECH RESEARCH CORPORATION SPECIFICALLY DISCLAIMS ANY
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED
+# HEREUNDER IS ON AN "AS IS" BASIS, AND  GEORGIA TECH RESEARCH CORPORATION HAS
+# NO OBLIGATIONS TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR
+# MODIFICATIONS.
+#
+# This source code is part of the GRIP software. The original GRIP software is
+# Copyright (c) 2015 The Regents of the University of California. All rights
+# reserved. Permission to copy, modify, and distribute this software for
+# academic research and education purposes is subject to the conditions and
+# copyright notices in the source code files and in the included LICENSE file.
+
+# Async (ASGI) serving mode.
+#
+# This serves the same /json/ API as the Flask app in app/__init__.py, with
+# the same config, but as a Quart app: elasticsearch queries go through an
+# AsyncElasticsearch client and grip-tags-service requests through a pooled
+# aiohttp session, so a single worker process can have thousands of queries
+# in flight instead of one per thread. Run it with any ASGI server, e.g.
+#
+#     hypercorn --workers 4 app.asgi:asgi_app
+#
+# Everything but the I/O is shared with the Flask app: ElasticSearchConn's
+# operations are carried out with awaits (see app/elastic.py), and the
+# routes below build their responses with the same helpers as the ones in
+# app/api_json.py.
+
+import asyncio, logging, os, time
+
+import aiohttp
+import requests
+import toml
+from elasticsearch import AsyncElasticsearch, NotFoundError
+from quart import Blueprint, Quart, current_app, g, request
+
+from app.GripException import ValidationError
+from app.cache import AsyncRefreshingCache, AsyncSingleFlight
+from app.compression import init_compression
+from app.elastic import ElasticClientRegistry, ElasticSearchConn, Emit, \
+        elastic_options
+from app.feed import EventFeed, FEED_KEEPALIVE, FEED_MAX_PAGES, \
+        FEED_PAGE_SIZE, FEED_RETRY_AFTER, FeedFull
+from app.meta import MetaServiceClient
+from app.metrics import CONTENT_TYPE, ES_CONN_DURATION, META_DURATION, \
+        cache_stats, record_request, render_metrics
+from app.serializer import GripJSONProvider, get_json_backend
+from app.utils import NDJSONEncoder, conditional_response, error_response, \
+        json_response, not_modified, parse_event_id, parse_pfx_fingerprint, \
+        validate_pfx_fingerprint, get_event_id_list, batch_result, \
+        is_conditional, is_not_modified
+
+logger = logging.getLogger(__name__)
+
+# The asyncio version of ElasticClientRegistry. An ASGI worker runs a single
+# event loop, so there are no threads to share the client with; the health
+# check runs as a task on the loop between app startup and shutdown.
+class AsyncElasticClientRegistry(ElasticClientRegistry):
+    client_class = AsyncElasticsearch
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._health_task = None
+        self._wakeup = None
+
+    def client(self):
+        if self._client is None:
+            self._client = self._build_client()
+            self._healthy = True
+        return self._client
+
+    # AsyncTransport only creates its connections once it is running on the
+    # event loop, normally on its first request -- but _rawRequest() asks it
+    # for a connection directly, which may well come first
+    async def _connect(self, client):
+        await client.transport._async_call()
+        return client
+
+    async def start(self):
+        await self._connect(self.client())
+        if self.health_interval > 0:
+            self._wakeup = asyncio.Event()
+            self._health_task = asyncio.ensure_future(self._health_loop())
+
+    async def stop(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    def mark_unhealthy(self):
+        self._healthy = False
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def reconnect(self):
+        old = self._client
+        self._client = await self._connect(self._build_client())
+        if old is not None:
+            try:
+                await old.close()
+            except Exception:
+                pass
+
+    async def _ping(self):
+        try:
+            return await self._client.ping()
+        except Exception:
+            return False
+
+    async def _health_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(),
+                        self.health_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            ok = await self._ping()
+            if not ok:
+                logger.warning("ElasticSearch health check failed, reconnecting")
+                await self.reconnect()
+                ok = await self._ping()
+
+            self._healthy = ok
+
+# ElasticSearchConn carrying out its operations (see _run() in
+# app/elastic.py) with awaits. The AsyncElasticsearch client, the
+# single-flight group and the index cache all return awaitables, so the
+# public methods return coroutines, and getEventsByIds() and the stream from
+# exportEvents() are async generators.
+class AsyncElasticSearchConn(ElasticSearchConn):
+    flight_class = AsyncSingleFlight
+    index_cache_class = AsyncRefreshingCache
+
+    async def _run(self, ops, send=None, value=None):
+        if send is None:
+            send = ops.send
+        while True:
+            try:
+                op = send(value)
+            except StopIteration as stop:
+                return stop.value
+
+            try:
+                send, value = ops.send, await self._start(op)
+            except Exception as e:
+                send, value = ops.throw, e
+
+    async def _stream(self, ops):
+        send, value = ops.send, None
+        while True:
+            try:
+                op = send(value)
+            except StopIteration:
+                return
+
+            if isinstance(op, Emit):
+                try:
+                    yield op.item
+                except GeneratorExit:
+                    await self._close(ops)
+                    raise
+                send, value = ops.send, None
+                continue
+
+            try:
+                send, value = ops.send, await self._start(op)
+            except Exception as e:
+                send, value = ops.throw, e
+
+    async def _close(self, ops):
+        try:
+            await self._run(ops, ops.throw, GeneratorExit())
+        except GeneratorExit:
+            pass
+
+    async def _call(self, name, ops):
+        with ES_CONN_DURATION.labels(name).time():
+            return await self._run(ops)
+
+    async def _callStream(self, name, ops):
+        return self._stream(await self._call(name, ops))
+
+# MetaServiceClient using a pooled aiohttp session
+class AsyncMetaServiceClient(MetaServiceClient):
+    cache_class = AsyncRefreshingCache
+
+    @property
+    def session(self):
+        # created on first use, as it has to belong to the running loop
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                    timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def stop(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _fetch(self, path):
+        if self.adapter is not None:
+            # a stand-in for the service, e.g. in the benchmarks
+            return await asyncio.get_running_loop().run_in_executor(None,
+                    self._fetchFromAdapter, path)
+
+        with META_DURATION.labels(path).time():
+            async with self.session.get(self.base_url + path) as r:
+                r.raise_for_status()
+                body = await r.read()
+        return self._decode(path, body)
+
+    async def get(self, path):
+        # callers must not modify the returned object, it is shared with
+        # every other request that hits the cache
+        return await self.cache.get(path)
+
+    def _fetchFromAdapter(self, path):
+        request = requests.Request('GET', self.base_url + path).prepare()
+        r = self.adapter.send(request, timeout=self.timeout)
+        r.raise_for_status()
+        return self._decode(path, r.content)
+
+# EventFeed with the poller as a task on the event loop, and asyncio queues
+class AsyncEventFeed(EventFeed):
+    queue_full = asyncio.QueueFull
+
+    def _new_queue(self):
+        return asyncio.Queue(self.queue_size)
+
+    def _start(self):
+        if self._poller is not None:
+            return
+
+        self.watermark = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        self._seen = set()
+        self._poller = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._poller is not None:
+            self._poller.cancel()
+            self._poller = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+
+            with self._lock:
+                if len(self.subscribers) == 0:
+                    self._poller = None
+                    return
+
+            try:
+                self._publish(await self.es.eventChanges(self.watermark,
+                        FEED_PAGE_SIZE, FEED_MAX_PAGES))
+            except Exception as e:
+                logger.warning("Live feed poll failed: %s", e)
+
+    async def stream(self, sub):
+        try:
+            yield self.hello()
+            while True:
+                try:
+                    if sub.lagged is not None:
+                        yield sub.messages.get_nowait()
+                    else:
+                        yield await asyncio.wait_for(sub.messages.get(),
+                                FEED_KEEPALIVE)
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    if sub.lagged is not None:
+                        yield self.goodbye(sub)
+                        return
+                    yield ": keepalive\n\n"
+        finally:
+            self.unsubscribe(sub)
+
+# the response helpers from app/utils.py, with Quart's app and request
+
+def handle_exception(message_str, status_code):
+    return error_response(current_app, message_str, status_code)
+
+def post_process(data, validator=None):
+    return json_response(current_app, request, data, validator)
+
+def not_modified_response(validator):
+    return not_modified(current_app, request, validator)
+
+def post_process_conditional(data, validator):
+    return conditional_response(current_app, request, data, validator)
+
+def post_process_ndjson(items):
+    encoder = NDJSONEncoder(current_app, request)
+
+    async def generate():
+        async for item in items:
+            out = encoder.push(item)
+            if out:
+                yield out
+        yield encoder.finish()
+
+    return encoder.response(generate())
+
+def getElastic():
+    return current_app.extensions['grip_es']
+
+def getMeta():
+    return current_app.extensions['grip_meta']
+
+def getFeed():
+    return current_app.extensions['grip_feed']
+
+bp = Blueprint('json', __name__, url_prefix="/json")
+
+@bp.route('/tags', methods=['GET'])
+async def json_tags():
+    meta = getMeta()
+    data = await meta.get("/tags")
+    return post_process_conditional(data, meta.validator("/tags", data))
+
+@bp.route('/asndrop', methods=['GET'])
+async def json_asndrop():
+    meta = getMeta()
+    data = await meta.get("/asndrop")
+    return post_process_conditional(data, meta.validator("/asndrop", data))
+
+@bp.route('/blacklist', methods=['GET'])
+async def json_blacklist():
+    meta = getMeta()
+    data = await meta.get("/blacklist")
+    return post_process_conditional(data, meta.validator("/blacklist", data))
+
+@bp.route('/blocklist', methods=['GET'])
+async def json_blocklist():
+    meta = getMeta()
+    blacklist = await meta.get("/blacklist")
+    validator = meta.validator("/blacklist", blacklist)
+    if validator is not None:
+        validator = validator.derive("blocklist")
+
+    # shares the cached /blacklist payload, so copy before renaming
+    data = dict(blacklist)
+    # rename blacklist to blocklist because that's what the caller will expect
+    data['blocklist'] = data.pop('blacklist')
+
+    return post_process_conditional(data, validator)
+
+@bp.route('/event/id/<evid>', methods=['GET'])
+async def json_event_by_id(evid):
+    try:
+        es = getElastic()
+        eventid = parse_event_id(evid)
+
+        # check whether the client's copy (of either representation) is
+        # current before fetching the whole event, which may be several MB
+        if is_conditional(request):
+            validator = await es.getEventValidator(eventid)
+            for current in es.eventValidators(validator):
+                if is_not_modified(request, current):
+                    return not_modified_response(current)
+
+        pending = await es.getEventById(eventid, raw=True)
+        return post_process_conditional(pending,
+                es.eventValidator(eventid, pending))
+
+    except NotFoundError:
+        return handle_exception('The requested event was not found', 404)
+
+    except ValidationError as v:
+        return handle_exception(v.args[0], 400)
+
+    except Exception as e:
+        return handle_exception(e.args[0], 500)
+
+@bp.route('/event/ids', methods=['GET', 'POST'])
+async def json_events_by_ids():
+    try:
+        body = None
+        if request.method == 'POST':
+            body = await request.get_json(force=True, silent=True)
+            if body is None:
+                body = ""
+        evids = get_event_id_list(request.args, body,
+                current_app.config.get('BATCH_MAX_IDS', 1000))
+        es = getElastic()
+
+        async def results():
+            async for r in es.getEventsByIds(evids):
+                yield batch_result(*r)
+
+        return post_process_ndjson(results()), 200
+
+    except ValidationError as v:
+        return handle_exception(v.args[0], 400)
+
+@bp.route('/events', methods=['GET'])
+async def json_search_events():
+    args = request.args
+
+    try:
+        es = getElastic()
+
+        if args.get('format') == 'ndjson':
+            # stream every matching event, ignoring start and length
+            return post_process_ndjson(await es.exportEvents(args)), 200
+
+        pending = await es.lookupEvents(args)
+        return post_process(pending), 200
+
+    except ValidationError as v:
+        return handle_exception(v.args[0], 400)
+
+@bp.route('/events/stats', methods=['GET'])
+async def json_event_stats():
+    try:
+        es = getElastic()
+        return post_process(await es.eventStats(request.args)), 200
+
+    except ValidationError as v:
+        return handle_exception(v.args[0], 400)
+
+@bp.route('/events/live', methods=['GET'])
+async def json_live_events():
+    feed = getFeed()
+    try:
+        sub = feed.subscribe(request.args)
+
+    except ValidationError as v:
+        return handle_exception(v.args[0], 400)
+
+    except FeedFull:
+        response = handle_exception("Too many live feed subscribers, please try again later", 503)
+        response.headers['Retry-After'] = str(FEED_RETRY_AFTER)
+        return response
+
+    response = current_app.response_class(feed.stream(sub),
+            mimetype="text/event-stream",
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # the stream never ends by itself
+    response.timeout = None
+    return response
+
+@bp.route('/cache_stats', methods=['GET'])
+async def json_cache_stats():
+    return post_process(cache_stats(current_app)), 200
+
+@bp.route('/pfx_event/id/<evid>/<prefix>', methods=['GET'])
+async def json_pfx_event_by_id(evid, prefix):
+    try:
+        es = getElastic()
+        eventid = parse_event_id(evid)
+
+        search = parse_pfx_fingerprint(prefix)
+        event_type, pfxevent = await es.getPfxEventById(eventid, search)
+        validate_pfx_fingerprint(event_type, search)
+
+        if pfxevent is not None:
+            return post_process(pfxevent), 200
+
+        return handle_exception('No events with the given search parameters were found', 404)
+
+    except ValidationError as v:
+        return handle_exception(v.args[0], 400)
+
+    except NotFoundError:
+        return handle_exception('The requested event was not found', 404)
+
+    except ValueError as val:
+        return handle_exception("One or more invalid IP prefixes: " + val.args[0], 400)
+
+    except Exception as e:
+        return handle_exception(e.args[0], 500)
+
+def create_asgi_app(test_config=None):
+    app = Quart(__name__, instance_relative_config=True)
+
+    @app.errorhandler(404)
+    async def not_found(error):
+        return handle_exception("The requested URL was not found on the server.", 404)
+
+    @app.errorhandler(500)
+    async def internal_error(error):
+        return handle_exception("Internal Server Error: The server encountered an internal error and was unable to complete your request. Either the server is overloaded or there is an error in the application.", 500)
+
+    if test_config is None:
+        app.config.from_file('config.toml', load=toml.load)
+    else:
+        app.config.from_mapping(test_config)
+
+    backend = get_json_backend(app.config.get('JSON_BACKEND', 'auto'))
+    app.json = GripJSONProvider(app, backend)
+    init_compression(app)
+
+    registry = AsyncElasticClientRegistry.from_config(app.config,
+            json_backend=backend)
+    app.extensions['grip_es'] = AsyncElasticSearchConn(registry,
+            **elastic_options(app.config))
+    app.extensions['grip_meta'] = AsyncMetaServiceClient.from_config(
+            app.config)
+    app.extensions['grip_feed'] = AsyncEventFeed.from_config(
+            app.extensions['grip_es'], app.config)
+
+    @app.before_serving
+    async def startup():
+        await registry.start()
+
+    @app.after_serving
+    async def shutdown():
+        await registry.stop()
+        await app.extensions['grip_meta'].stop()
+        await app.extensions['grip_feed'].stop()
+
+    if app.config.get('METRICS_ENABLED', True):
+        @app.before_request
+        async def start_timer():
+            g.request_start = time.perf_counter()
+
+        @app.after_request
+        async def record(response):
+            start = g.get('request_start')
+            if start is not None:
+                record_request(request, response,
+                        time.perf_counter() - start)
+            return response
+
+        @app.route('/metrics')
+        async def metrics():
+            return current_app.response_class(
+                    render_metrics(current_app),
+                    content_type=CONTENT_TYPE)
+
+    app.register_blueprint(bp)
+    return app
+
+# see the note on `app` in app/__init__.py
+if not os.environ.get('GRIP_API_NO_APP'):
+    asgi_app = create_asgi_app()
@@ -0,0 +1,330 @@
+# This source code is Copyright (c) 2023 Georgia Tech Research Corporation. All
+# Rights Reserved. Permission to copy, modify, and distribute this software and
+# its documentation for academic research and education purposes, without fee,
+# and without a written agreement is hereby granted, provided that the above
+# copyright notice, this paragraph and the following three paragraphs appear in
+# all copies. Permission to make use of this software for other than academic
+# research and education purposes may be obtained by contacting:
+#
+#  Office of Technology Licensing
+#  Georgia Institute of Technology
+#  926 Dalney Street, NW
+#  Atlanta, GA 30318
+#  404.385.8066
+#  techlicensing@gtrc.gatech.edu
+#
+# This software program and documentation are copyrighted by Georgia Tech
+# Research Corporation (GTRC). The software program and documentation are 
+# supplied "as is", without any accompanying services from GTRC. GTRC does
+# not warrant that the operation of the program will be uninterrupted or
+# error-free. The end-user understands that the program was developed for
+# research purposes and is advised not to rely exclusively on the program for
+# any reason.
+#
+# IN NO EVENT SHALL GEORGIA TECH RESEARCH CORPORATION BE LIABLE TO ANY PARTY FOR
+# DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING
+# LOST PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION,
+# EVEN IF GEORGIA TECH RESEARCH CORPORATION HAS BEEN ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE. GEORGIA TECH RESEARCH CORPORATION SPECIFICALLY DISCLAIMS ANY
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED
+# HEREUNDER IS ON AN "AS IS" BASIS, AND  GEORGIA TECH RESEARCH CORPORATION HAS
+# NO OBLIGATIONS TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR
+# MODIFICATIONS.
+#
+# This source code is part of the GRIP software. The original GRIP software is
+# Copyright (c) 2015 The Regents of the University of California. All rights
+# reserved. Permission to copy, modify, and distribute this software for
+# academic research and education purposes is subject to the conditions and
+# copyright notices in the source code files and in the included LICENSE file.
+
+import asyncio, threading, time
+from collections import OrderedDict
+
+# Collapses concurrent calls for the same key into one: the first caller
+# runs the function, everyone else who asks for the same key while that call
+# is in flight waits for it and receives the same result (or exception).
+class SingleFlight(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+        # number of calls actually made, and of callers that shared the
+        # result of a call made for someone else
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._calls
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "coalesced": self.coalesced,
+                    "in_flight": len(self._calls)}
+
+class _Call(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+# A small cache for values that are expensive to fetch but change rarely.
+#
+# Entries younger than `ttl` seconds are served as-is. Entries older than
+# that but younger than `ttl + stale_ttl` are still served, but the first
+# request to see them kicks off a refresh in a background thread so that the
+# caller doesn't have to wait for it. Missing (or hopelessly stale) entries
+# are loaded in the calling thread. Either way, only one load per key is ever
+# in flight at a time.
+#
+# Stale entries that are served count as hits (and as stale_hits), and
+# lookups that have to wait for a load count as misses.
+class RefreshingCache(object):
+    def __init__(self, loader, ttl=60, stale_ttl=3600):
+        self.loader = loader
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+        self._entries = {}
+        self._flight = SingleFlight()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        now = time.monotonic()
+
+        if entry is not None:
+            age = now - entry[0]
+            if age < self.ttl:
+                with self._lock:
+                    self.hits += 1
+                return entry[1]
+            if age < self.ttl + self.stale_ttl:
+                with self._lock:
+                    self.hits += 1
+                    self.stale_hits += 1
+                if not self._flight.in_flight(key):
+                    threading.Thread(target=self._refresh, args=(key,),
+                            daemon=True).start()
+                return entry[1]
+
+        with self._lock:
+            self.misses += 1
+        return self._flight.do(key, lambda: self._load(key))
+
+    def _load(self, key):
+        value = self.loader(key)
+        self._entries[key] = (time.monotonic(), value)
+        return value
+
+    def _refresh(self, key):
+        try:
+            self._flight.do(key, lambda: self._load(key))
+        except Exception:
+            # keep serving the stale copy, we'll try again on the next hit
+            pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+            }
+
+# A thread-safe LRU cache that is bounded by the total size of its entries
+# rather than by the number of entries. The caller supplies the size (in
+# bytes, or any other consistent unit) of each value when it is stored, along
+# with the number of seconds for which the value may be served.
+class SizedLRUCache(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            if entry[0] <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, size, ttl):
+        if size > self.max_bytes or ttl <= 0:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (time.monotonic() + ttl, value, size)
+            self.bytes += size
+
+            while self.bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.bytes -= entry[2]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+# The asyncio equivalent of SingleFlight, for coroutine functions.
+class AsyncSingleFlight(object):
+    def __init__(self):
+        self._calls = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, fn):
+        call = self._calls.get(key)
+        if call is None:
+            call = asyncio.ensure_future(fn())
+            self._calls[key] = call
+            call.add_done_callback(lambda f: self._calls.pop(key, None))
+            self.calls += 1
+        else:
+            self.coalesced += 1
+
+        # don't let one caller giving up cancel the call for everyone else
+        return await asyncio.shield(call)
+
+    def stats(self):
+        return {"calls": self.calls, "coalesced": self.coalesced,
+                "in_flight": len(self._calls)}
+
+# The asyncio equivalent of RefreshingCache, for use with an async loader.
+# Background refreshes run as tasks on the event loop rather than threads.
+class AsyncRefreshingCache(object):
+    def __init__(self, loader, ttl=60, stale_ttl=3600):
+        self.loader = loader
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+        self._entries = {}
+        self._loads = {}
+
+    async def get(self, key):
+        entry = self._entries.get(key)
+        now = time.monotonic()
+
+        if entry is not None:
+            age = now - entry[0]
+            if age < self.ttl:
+                self.hits += 1
+                return entry[1]
+            if age < self.ttl + self.stale_ttl:
+                self.hits += 1
+                self.stale_hits += 1
+                if key not in self._loads:
+                    self._start_load(key)
+                return entry[1]
+
+        self.misses += 1
+        load = self._loads.get(key)
+        if load is None:
+            load = self._start_load(key)
+
+        # don't let one caller giving up cancel the load for everyone else
+        return await asyncio.shield(load)
+
+    def _start_load(self, key):
+        load = asyncio.ensure_future(self._load(key))
+        self._loads[key] = load
+        load.add_done_callback(lambda f: self._load_done(key, f))
+        return load
+
+    def _load_done(self, key, load):
+        self._loads.pop(key, None)
+        if not load.cancelled():
+            # mark failed background refreshes as handled, we'll just try
+            # again on the next hit
+            load.exception()
+
+    async def _load(self, key):
+        value = await self.loader(key)
+        self._entries[key] = (time.monotonic(), value)
+        return value
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+        }
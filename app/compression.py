@@ -0,0 +1,309 @@
+# This source code is Copyright (c) 2023 Georgia Tech Research Corporation. All
+# Rights Reserved. Permission to copy, modify, and distribute this software and
+# its documentation for academic research and education purposes, without fee,
+# and without a written agreement is hereby granted, provided that the above
+# copyright notice, this paragraph and the following three paragraphs appear in
+# all copies. Permission to make use of this software for other than academic
+# research and education purposes may be obtained by contacting:
+#
+#  Office of Technology Licensing
+#  Georgia Institute of Technology
+#  926 Dalney Street, NW
+#  Atlanta, GA 30318
+#  404.385.8066
+#  techlicensing@gtrc.gatech.edu
+#
+# This software program and documentation are copyrighted by Georgia Tech
+# Research Corporation (GTRC). The software program and documentation are 
+# supplied "as is", without any accompanying services from GTRC. GTRC does
+# not warrant that the operation of the program will be uninterrupted or
+# error-free. The end-user understands that the program was developed for
+# research purposes and is advised not to rely exclusively on the program for
+# any reason.
+#
+# IN NO EVENT SHALL GEORGIA TECH RESEARCH CORPORATION BE LIABLE TO ANY PARTY FOR
+# DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING
+# LOST PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION,
+# EVEN IF GEORGIA TECH RESEARCH CORPORATION HAS BEEN ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE. GEORGIA TECH RESEARCH CORPORATION SPECIFICALLY DISCLAIMS ANY
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED
+# HEREUNDER IS ON AN "AS IS" BASIS, AND  GEORGIA TECH RESEARCH CORPORATION HAS
+# NO OBLIGATIONS TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR
+# MODIFICATIONS.
+#
+# This source code is part of the GRIP software. The original GRIP software is
+# Copyright (c) 2015 The Regents of the University of California. All rights
+# reserved. Permission to copy, modify, and distribute this software for
+# academic research and education purposes is subject to the conditions and
+# copyright notices in the source code files and in the included LICENSE file.
+
+# Compression of responses, negotiated with Accept-Encoding.
+#
+# Event JSON is very repetitive (prefixes, ASNs, tag names), so it usually
+# shrinks by 10x or more. Responses with an ETag don't change until their
+# ETag does, so their compressed bodies are cached and served to later
+# requests without encoding or compressing them again.
+
+import time, zlib
+
+from app.cache import SizedLRUCache
+from app.metrics import FORMAT_DURATION
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# bodies smaller than this aren't worth compressing
+COMPRESS_MIN_BYTES = 1024
+
+# bodies at least this large are compressed (and sent) a chunk at a time,
+# so that the client can start receiving them sooner
+STREAM_MIN_BYTES = 1024 * 1024
+STREAM_CHUNK_BYTES = 256 * 1024
+
+# when compressing a stream, flush the compressed output once at least this
+# much input has gone into it, so that clients see steady progress
+STREAM_FLUSH_BYTES = 64 * 1024
+
+# how long a compressed body may be cached -- it is identified by its ETag,
+# so this only limits how long an unpopular body can hang around
+COMPRESSED_CACHE_TTL = 86400
+
+# gzip level 1 gets most of the gain of the higher levels, which take
+# several times as long, and most responses are compressed on demand
+class GzipCoding(object):
+    name = 'gzip'
+
+    def __init__(self, level=1):
+        self.level = level
+
+    def compress(self, data):
+        stream = self.stream()
+        return stream.compress(data) + stream.finish()
+
+    def stream(self):
+        return _ZlibStream(zlib.compressobj(self.level, zlib.DEFLATED, 31))
+
+class _ZlibStream(object):
+    def __init__(self, obj):
+        self.obj = obj
+
+    def compress(self, data):
+        return self.obj.compress(data)
+
+    def flush(self):
+        return self.obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.obj.flush()
+
+class BrotliCoding(object):
+    name = 'br'
+
+    # the highest qualities are far too slow for responses made on demand
+    def __init__(self, quality=5):
+        self.quality = quality
+
+    def compress(self, data):
+        return brotli.compress(data, quality=self.quality)
+
+    def stream(self):
+        return _BrotliStream(brotli.Compressor(quality=self.quality))
+
+class _BrotliStream(object):
+    def __init__(self, obj):
+        self.obj = obj
+
+    def compress(self, data):
+        return self.obj.process(data)
+
+    def flush(self):
+        return self.obj.flush()
+
+    def finish(self):
+        return self.obj.finish()
+
+class ZstdCoding(object):
+    name = 'zstd'
+
+    def __init__(self, level=3):
+        self.level = level
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def stream(self):
+        return _ZstdStream(zstandard.ZstdCompressor(
+                level=self.level).compressobj())
+
+class _ZstdStream(object):
+    def __init__(self, obj):
+        self.obj = obj
+
+    def compress(self, data):
+        return self.obj.compress(data)
+
+    def flush(self):
+        return self.obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.obj.flush()
+
+# every content coding we know of, most preferred first -- which of them
+# can be used depends on the libraries that are installed
+CONTENT_CODINGS = ['zstd', 'br', 'gzip']
+
+def available_codings():
+    codings = []
+    if zstandard is not None:
+        codings.append(ZstdCoding())
+    if brotli is not None:
+        codings.append(BrotliCoding())
+    codings.append(GzipCoding())
+    return codings
+
+# the ETag of the `coding`-compressed representation of a response, which
+# has to differ from the uncompressed one's
+def coded_etag(etag, coding):
+    return "{}-{}".format(etag, coding)
+
+# A stream of chunks being compressed. push() returns whatever compressed
+# output is ready (possibly nothing), finish() the rest. If `key` is given,
+# the whole compressed stream is cached under it once it is finished (until
+# `expires`, see Compressor.store()).
+class CompressingStream(object):
+    def __init__(self, compressor, coding, key=None, expires=None):
+        self.compressor = compressor
+        self.coding = coding
+        self.key = key
+        self.expires = expires
+
+        self._stream = coding.stream()
+        self._pending = 0
+        self._kept = None
+        if key is not None and compressor.cache is not None:
+            self._kept = []
+
+    def push(self, chunk):
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+
+        out = self._stream.compress(chunk)
+        self._pending += len(chunk)
+        if self._pending >= STREAM_FLUSH_BYTES:
+            out += self._stream.flush()
+            self._pending = 0
+
+        if self._kept is not None and out:
+            self._kept.append(out)
+        return out
+
+    def finish(self):
+        out = self._stream.finish()
+        if self._kept is not None:
+            self._kept.append(out)
+            self.compressor.store(self.key, self.coding, b"".join(self._kept),
+                    self.expires)
+        return out
+
+class Compressor(object):
+    def __init__(self, codings, min_bytes=COMPRESS_MIN_BYTES, cache=None):
+        self.codings = {c.name: c for c in codings}
+        self.preference = [c.name for c in codings]
+        self.min_bytes = min_bytes
+        self.cache = cache
+
+    @classmethod
+    def from_config(cls, config):
+        codings = available_codings()
+        names = config.get('COMPRESSION_CODINGS')
+        if names is not None:
+            codings = [c for c in codings if c.name in names]
+
+        cache = None
+        max_bytes = config.get('COMPRESSION_CACHE_MAX_BYTES', 32 * 1024 * 1024)
+        if max_bytes > 0:
+            cache = SizedLRUCache(max_bytes)
+
+        return cls(codings,
+                min_bytes=config.get('COMPRESSION_MIN_BYTES',
+                        COMPRESS_MIN_BYTES),
+                cache=cache)
+
+    # the coding to use for a client that sent `accept_encodings` (a
+    # werkzeug Accept), or None to send the response uncompressed
+    def choose(self, accept_encodings):
+        return self.codings.get(accept_encodings.best_match(self.preference))
+
+    def cached(self, key, coding):
+        if self.cache is None or key is None:
+            return None
+        return self.cache.get((key, coding.name))
+
+    # `expires` is the time.monotonic() deadline after which the body may
+    # no longer be served, if there is one
+    def store(self, key, coding, body, expires=None):
+        if self.cache is None or key is None:
+            return
+
+        ttl = COMPRESSED_CACHE_TTL
+        if expires is not None:
+            ttl = min(ttl, expires - time.monotonic())
+        self.cache.put((key, coding.name), body, len(body), ttl)
+
+    # Encode a response body for a client that sent `accept_encodings`.
+    # `encode` returns the uncompressed body, and is only called if there
+    # is no compressed copy of it cached under `key` (its ETag, if it has
+    # one, or the key of the cache that it is shared through, until
+    # `expires`). Returns the body to send -- bytes, or an iterator of bytes
+    # for large bodies -- and the coding that it is compressed with, if any.
+    def encode(self, accept_encodings, encode, key=None, expires=None):
+        coding = self.choose(accept_encodings)
+        if coding is None:
+            return encode(), None
+
+        cached = self.cached(key, coding)
+        if cached is not None:
+            return cached, coding
+
+        body = encode()
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if len(body) < self.min_bytes:
+            return body, None
+
+        if len(body) >= STREAM_MIN_BYTES:
+            return self.compress_chunks((body[i:i + STREAM_CHUNK_BYTES]
+                    for i in range(0, len(body), STREAM_CHUNK_BYTES)),
+                    coding, key, expires), coding
+
+        with FORMAT_DURATION.labels('compress').time():
+            compressed = coding.compress(body)
+        self.store(key, coding, compressed, expires)
+        return compressed, coding
+
+    def compress_chunks(self, chunks, coding, key=None, expires=None):
+        stream = CompressingStream(self, coding, key, expires)
+        for chunk in chunks:
+            out = stream.push(chunk)
+            if out:
+                yield out
+        yield stream.finish()
+
+    def stats(self):
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
+def init_compression(app):
+    compressor = None
+    if app.config.get('COMPRESSION_ENABLED', True):
+        compressor = Compressor.from_config(app.config)
+    app.extensions['grip_compression'] = compressor
@@ -39,13 +39,27 @@
 # copyright notices in the source code files and in the included LICENSE file.
 
 from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import ConnectionError as ESConnectionError
+from elasticsearch.exceptions import NotFoundError, TransportError
 from datetime import datetime
+from collections import namedtuple
+from operator import attrgetter
 
-import re, time
+import base64, calendar, hashlib, json, logging, os, re, threading, time
+from urllib.parse import quote
 
-from flask import current_app, g, request, jsonify
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from werkzeug.datastructures import MultiDict
 
 from app.GripException import ValidationError
+from app.cache import RefreshingCache, SingleFlight, SizedLRUCache
+from app.metrics import ES_CONN_DURATION, ES_REQUEST_DURATION, \
+        ES_RESPONSE_BYTES, FORMAT_DURATION, observe_took
+from app.serializer import GripESSerializer, STDLIB_BACKEND, response_size
+from app.utils import EventId, RawJSON, SharedResponse, Validator, \
+        http_time, make_etag, parse_event_id, raw_fields
 
 OLD_TIME_FMT="^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}$"
 NEW_TIME_FMT="^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$"
@@ -87,14 +101,75 @@ def convert_time_str(ts_str):
     dt = datetime.utcfromtimestamp(intts)
     return dt.strftime("%Y-%m-%d %H:%M:%S")
 
+# parse one of the "*_ts" fields of an event into seconds since the epoch,
+# returns None if the field is missing or can't be parsed
+def parse_event_ts(value):
+    if value is None:
+        return None
+
+    ts_str = convert_time_str(str(value))
+    if ts_str is None:
+        return None
+    return calendar.timegm(time.strptime(ts_str, "%Y-%m-%d %H:%M:%S"))
+
+# the ts_start or ts_end parameter (`name`) in seconds since the epoch, or
+# None if it is missing or not a time at all -- raises ValidationError for
+# times that are in the right format but don't exist, e.g. 2023-13-45
+def query_param_ts(queryparams, name):
+    try:
+        return parse_event_ts(queryparams.get(name, type=str))
+    except (ValueError, OverflowError, OSError):
+        raise ValidationError("Invalid {} -- should be a unix timestamp or a time in the form YYYY-MM-DD HH:MM:SS".format(name))
+
 def add_match_params(must_terms, must_not_terms, termname, paramstring):
-    termvals=paramstring.split(",")
+    # the order (and repetition) of the values doesn't affect the results,
+    # so put them in a canonical order to make equivalent queries identical
+    termvals=sorted(set(paramstring.split(",")))
     for a in termvals:
         if a[0] == '!' and len(a) > 1:
             must_not_terms.append({ "term": {termname: a[1:] }})
         else:
             must_terms.append({ "term": {termname: a }})
 
+# view_ts is always the start of a minute (the start of the BGP view that
+# the event was seen in), so a bound on it can be moved to a whole minute
+# without changing which events it matches -- lower bounds move up, upper
+# bounds move down. Requests for slightly different times then produce the
+# same query, which elasticsearch and our query cache can both reuse.
+def round_view_ts(ts_str, up):
+    if ts_str is None or ts_str.endswith(":00"):
+        return ts_str
+
+    try:
+        ts = calendar.timegm(time.strptime(ts_str, "%Y-%m-%d %H:%M:%S"))
+    except ValueError:
+        # let elasticsearch reject it
+        return ts_str
+
+    ts -= ts % 60
+    if up:
+        ts += 60
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(ts))
+
+# the time after which an event must have been created or updated to match,
+# from the modified_since parameter, or None for any event
+def modified_since_ts(queryparams):
+    value = queryparams.get("modified_since", type=str)
+    if value is None:
+        return None
+
+    try:
+        ts_str = convert_time_str(value)
+    except (ValueError, OverflowError, OSError):
+        ts_str = None
+    if ts_str is None:
+        raise ValidationError("Invalid modified_since -- should be a unix timestamp or a time in the form YYYY-MM-DD HH:MM:SS")
+    return ts_str
+
+# The query for the events matching a set of /json/events parameters. None
+# of the clauses need to be scored, since results are sorted by view_ts, so
+# they are all in filter (or must_not) context where elasticsearch can cache
+# them.
 def buildESEventQuery(queryparams):
     q = {}
 
@@ -106,12 +181,15 @@ def buildESEventQuery(queryparams):
     must_filters = []
 
     if start_ts is not None:
+        start_str = convert_time_str(start_ts)
+        start_view = round_view_ts(start_str, True)
+
         if overlap:
             # case 1: event start time is after "start_ts"
             should_filters.append(
                 { "range":  {
                     "view_ts": {
-                        "gte": convert_time_str(start_ts)
+                        "gte": start_view
                     }
                 }}
             )
@@ -124,7 +202,7 @@ def buildESEventQuery(queryparams):
                         {
                             "range": {
                                 "view_ts": {
-                                    "lt": convert_time_str(start_ts)
+                                    "lt": start_view
                                 }
                             }
                         },
@@ -134,7 +212,7 @@ def buildESEventQuery(queryparams):
                                     {
                                         "range": {
                                              "finished_ts": {
-                                                 "gte": convert_time_str(start_ts)
+                                                 "gte": start_str
                                              }
                                         }
                                     },
@@ -161,7 +239,7 @@ def buildESEventQuery(queryparams):
             must_filters.append(
                 { "range": {
                     "view_ts": {
-                        "gte": convert_time_str(start_ts)
+                        "gte": start_view
                     }
                 }})
 
@@ -170,7 +248,7 @@ def buildESEventQuery(queryparams):
         must_filters.append(
             { "range": {
                 "view_ts": {
-                    "lte": convert_time_str(end_ts)
+                    "lte": round_view_ts(convert_time_str(end_ts), False)
                 }
             }})
 
@@ -243,49 +321,373 @@ def buildESEventQuery(queryparams):
                 "summary.inference_result.primary_inference.labels",
                 labelstring)
 
+    # events that were inserted or updated at (or after) the watermark --
+    # inclusive, since several updates can share the same second and a
+    # client would rather see an event twice than miss it
+    modified = modified_since_ts(queryparams)
+    if modified is not None:
+        must_terms.append({ "bool": {
+            "should": [
+                { "range": { "last_modified_ts": { "gte": modified } } },
+                { "range": { "insert_ts": { "gte": modified } } }
+            ],
+            "minimum_should_match": 1
+        }})
+
     return {
         'query': {
             'bool': {
-                "must": must_terms,
-                "must_not": must_not_terms,
-                "filter": filter_term
+                "filter": must_terms + [filter_term],
+                "must_not": must_not_terms
             }
         }
     }
 
+# the event and pfx_event fields that are kept when the caller does not ask
+# for `full` events, plus the pfx_event details that are copied up a level
+EVENT_DETAIL_FIELDS = ['id', 'event_type', 'view_ts', 'finished_ts', 'asinfo',
+        'insert_ts', 'last_modified_ts', 'duration', 'tr_metrics',
+        'event_metrics', 'summary']
+PFX_EVENT_DETAIL_FIELDS = ['tags', 'finished_ts', 'inferences']
+PFX_EVENT_HIGH_LEVEL_FIELDS = ['prefix', 'sub_pfx', 'super_pfx']
+
+BRIEF_EVENT_FIELDS = ["*_ts", "id", "summary", "event_type"]
+
+# the _source fields that elasticsearch needs to send us for each event,
+# or None if we need the whole event -- `brief` limits the fields even if
+# `full` is also set
+def event_source_includes(brief, full):
+    if brief:
+        return BRIEF_EVENT_FIELDS
+    if full:
+        return None
+
+    # just enough for remove_extra_event_detail() to produce the same
+    # output as it would from the full event
+    return EVENT_DETAIL_FIELDS + \
+            ["pfx_events." + k for k in PFX_EVENT_DETAIL_FIELDS] + \
+            ["pfx_events.details." + k for k in PFX_EVENT_HIGH_LEVEL_FIELDS]
+
 def add_high_level_pfx_event_tags(dest, pfxevent):
-    if "details" in pfxevent and "prefix" in pfxevent['details']:
-        dest['prefix'] = pfxevent['details']['prefix']
-    if "details" in pfxevent and "sub_pfx" in pfxevent['details']:
-        dest['sub_pfx'] = pfxevent['details']['sub_pfx']
-    if "details" in pfxevent and "super_pfx" in pfxevent['details']:
-        dest['super_pfx'] = pfxevent['details']['super_pfx']
+    if "details" in pfxevent:
+        for k in PFX_EVENT_HIGH_LEVEL_FIELDS:
+            if k in pfxevent['details']:
+                dest[k] = pfxevent['details'][k]
 
     return dest
 
 def remove_extra_pfx_event_detail(pfxevent):
     pfx = {}
     for k, v in pfxevent.items():
-         if k in ['tags', 'finished_ts', 'inferences']:
+         if k in PFX_EVENT_DETAIL_FIELDS:
              pfx[k] = v
 
     pfx = add_high_level_pfx_event_tags(pfx, pfxevent)
     return pfx
 
+# Ingest pipeline that does the same job as enhance_pfxevents_for_event()
+# when events are written. Once every event index has been written (or
+# updated by query) through it, set ES_EVENTS_ENRICHED so that events can be
+# passed straight from elasticsearch to the client without being decoded.
+# `flask install-pfx-event-pipeline` installs it (see
+# installPfxEventPipeline()).
+PFX_EVENT_FIELDS_PIPELINE_ID = "grip-pfx-event-fields"
+PFX_EVENT_FIELDS_PIPELINE = {
+    "description": "Copy the prefix fields of each pfx_event's details up a level",
+    "processors": [{
+        "script": {
+            "lang": "painless",
+            "source": """
+if (ctx.pfx_events != null) {
+    for (def p : ctx.pfx_events) {
+        if (p.details == null) {
+            continue;
+        }
+        for (def k : params.fields) {
+            if (p.details.containsKey(k)) {
+                p[k] = p.details[k];
+            }
+        }
+    }
+}
+""",
+            "params": {"fields": PFX_EVENT_HIGH_LEVEL_FIELDS}
+        }
+    }]
+}
+
 def enhance_pfxevents_for_event(event):
     for pfxev in event['pfx_events']:
         x = add_high_level_pfx_event_tags(pfxev, pfxev)
 
     return event
 
+# check whether a pfx_event is the one identified by the prefix(es) in
+# `search` -- the prefix for moas and edges events, or the sub-prefix and
+# super-prefix for defcon and submoas events
+def match_pfx_event(event_type, pfxevent, search):
+    details = pfxevent.get('details')
+    if details is None:
+        return False
+
+    if event_type in ['moas', 'edges']:
+        return len(search) == 1 and details.get('prefix') == search[0]
+
+    if event_type in ['defcon', 'submoas']:
+        return len(search) == 2 and details.get('sub_pfx') == search[0] \
+                and details.get('super_pfx') == search[1]
+
+    return False
+
+def find_pfx_event(event, search):
+    for p in event['pfx_events']:
+        if match_pfx_event(event['event_type'], p, search):
+            return p
+    return None
+
+# rough memory cost of one entry in a CachedEvent's prefix index, used to
+# reserve room for the index in the event cache before it is built
+PFX_INDEX_ENTRY_BYTES = 256
+
+# the key identifying a pfx_event within an event -- prefixes are compared
+# exactly as stored, as they are by find_pfx_event() and PFX_EVENT_SCRIPT,
+# since parse_pfx_fingerprint() has already put the searched ones in the
+# same canonical form
+def pfx_event_key(event_type, prefixes):
+    if event_type in ['moas', 'edges'] and len(prefixes) == 1:
+        return prefixes[0]
+    if event_type in ['defcon', 'submoas'] and len(prefixes) == 2:
+        return (prefixes[0], prefixes[1])
+    return None
+
+# an event held in the event cache, along with an index of its pfx_events
+# that is built the first time one of them is looked up
+class CachedEvent(object):
+    __slots__ = ('event', 'pfx_index')
+
+    def __init__(self, event):
+        self.event = event
+        self.pfx_index = None
+
+    def _build_pfx_index(self):
+        event_type = self.event['event_type']
+        index = {}
+
+        for p in self.event['pfx_events']:
+            details = p.get('details')
+            if details is None:
+                continue
+
+            if event_type in ['moas', 'edges']:
+                prefixes = [details.get('prefix')]
+            else:
+                prefixes = [details.get('sub_pfx'), details.get('super_pfx')]
+
+            # keep the first match, just like a scan would
+            key = pfx_event_key(event_type, prefixes)
+            if key is not None and key not in index:
+                index[key] = p
+
+        # another thread may have beaten us to it, but the result will be
+        # the same either way
+        self.pfx_index = index
+
+    def find_pfx_event(self, search):
+        key = pfx_event_key(self.event['event_type'], search)
+        if key is None:
+            return None
+
+        if self.pfx_index is None:
+            self._build_pfx_index()
+        return self.pfx_index.get(key)
+
+# painless equivalent of find_pfx_event(), so that elasticsearch can pick the
+# matching pfx_event out of an event and send us only that
+PFX_EVENT_SCRIPT = """
+def src = params['_source'];
+def evtype = src['event_type'];
+def result = new HashMap();
+result.put('event_type', evtype);
+if (src['pfx_events'] == null) {
+    return result;
+}
+for (def p : src['pfx_events']) {
+    def d = p['details'];
+    if (d == null) {
+        continue;
+    }
+    if (evtype == 'moas' || evtype == 'edges') {
+        if (params.search.size() == 1 && params.search[0].equals(d['prefix'])) {
+            result.put('pfx_event', p);
+            return result;
+        }
+    } else if (evtype == 'defcon' || evtype == 'submoas') {
+        if (params.search.size() == 2 && params.search[0].equals(d['sub_pfx'])
+                && params.search[1].equals(d['super_pfx'])) {
+            result.put('pfx_event', p);
+            return result;
+        }
+    }
+}
+return result;
+"""
+
+# events are stored in monthly indices, named after the event type and the
+# month of the timestamp in the event ID -- `evid` may be an EventId from
+# parse_event_id() or an unchecked ID string
+def event_index_name(evid):
+    if isinstance(evid, EventId):
+        return "observatory-v4-query-events-{}-{}".format(evid.event_type,
+                evid.month)
+
+    evparams = evid.split('-')
+    if len(evparams) != 3:
+        err_str = "Invalid event ID format -- should be <evtype>-<timestamp>-<aslist>"
+        raise ValidationError(err_str)
+
+    evtype = evparams[0]
+
+    try:
+        evts = datetime.fromtimestamp(int(evparams[1]))
+        datestr = datetime.strftime(evts, "%Y-%m")
+    except:
+        err_str = "Invalid timestamp in event ID -- should be a unix timestamp"
+        raise ValidationError(err_str)
+
+    return "observatory-v4-query-events-{}-{}".format(evtype, datestr)
+
+# the index (pattern) to search for events of the requested type
+def event_search_index(queryparams):
+    event_type = queryparams.get("event_type", default="*", type=str)
+
+    if event_type == "all":
+        event_type = '*'
+
+    if queryparams.get("debug") is not None:
+        return "observatory-v4-test-events-{}-*".format(event_type)
+    else:
+        return "observatory-v4-query-events-{}-*".format(event_type)
+
+# events are filed under the month of the timestamp in their ID, which is
+# not necessarily the same as their view_ts, so the months that are searched
+# are padded by this many seconds either side of the requested window
+INDEX_MONTH_MARGIN = 86400
+
+# searches that would need more indices than this use the wildcard pattern
+# instead, to keep the request line to a reasonable length
+MAX_SEARCH_INDICES = 48
+
+# the months (as "YYYY-MM", like in event_index_name()) of the indices that
+# can hold events matching a search, or None if the window is open-ended --
+# when `overlap` is set, events that started at any time before the window
+# may match
+def event_index_months(queryparams):
+    if queryparams.get('overlap', False, type=bool):
+        return None
+
+    start = query_param_ts(queryparams, 'ts_start')
+    if start is None:
+        return None
+
+    end = query_param_ts(queryparams, 'ts_end')
+    if end is None:
+        end = time.time()
+
+    first = datetime.fromtimestamp(max(0, start - INDEX_MONTH_MARGIN))
+    last = datetime.fromtimestamp(end + INDEX_MONTH_MARGIN)
+
+    months = []
+    year, month = first.year, first.month
+    while (year, month) <= (last.year, last.month):
+        months.append("{:04d}-{:02d}".format(year, month))
+        if len(months) > MAX_SEARCH_INDICES:
+            return None
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+# The indices to search for an index pattern (from event_search_index()),
+# limited to the given months: a comma-separated list of index names, the
+# pattern itself if the list can't be narrowed down, or None if there are
+# no indices that could hold matching events.
+#
+# `known` is the set of indices that existed when it was last fetched, so
+# months from the current one onwards are always searched in case their
+# indices have been created since -- the search must then be run with
+# ignore_unavailable.
+def narrow_event_index(pattern, months, known):
+    if months is None or known is None:
+        return pattern
+
+    prefix = pattern[:-1]
+    current = datetime.strftime(datetime.now(), "%Y-%m")
+
+    indices = set()
+    for name in known:
+        if name[-7:] in months:
+            indices.add(name)
+    for month in months:
+        if month >= current:
+            indices.add(prefix + month)
+
+    if len(indices) == 0:
+        return None
+    if len(indices) > MAX_SEARCH_INDICES:
+        return pattern
+    return ",".join(sorted(indices))
+
+# the search parameters to use when searching `index` -- any indices that
+# narrow_event_index() added in case they've been created recently may not
+# exist yet
+def search_params(params, index, pattern):
+    if index == pattern:
+        return params
+    return dict(params, ignore_unavailable='true')
+
+# what elasticsearch returns for a search that matches no events
+def empty_search_results():
+    return {'hits': {'total': {'value': 0, 'relation': 'eq'}, 'hits': []}}
+
+# a short hash of everything that determines which events a search matches
+# and in what order, so that a cursor can't be used with a different query
+def query_fingerprint(index, querybody):
+    q = json.dumps([index, querybody], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(q.encode('utf-8')).hexdigest()[:16]
+
+# cursors are opaque to clients, but are just the sort values of the last
+# event on a page along with the fingerprint of the query that produced it
+def encode_cursor(sort_values, fingerprint):
+    c = json.dumps([fingerprint, sort_values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(c.encode('utf-8')).decode('ascii').rstrip("=")
+
+def decode_cursor(cursor, fingerprint):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        cfp, sort_values = json.loads(base64.urlsafe_b64decode(padded))
+    except Exception:
+        raise ValidationError("Invalid cursor")
+
+    if cfp != fingerprint or not isinstance(sort_values, list):
+        raise ValidationError("Cursor does not match the query parameters -- cursors may only be used with the query that returned them")
+    return sort_values
+
+def format_event_hit(doc, full):
+    if full:
+        d = doc['_source']
+        d['_esid'] = doc['_index']
+    else:
+        # some event details are not required by the UI and can
+        # massively increase the response size, so we'll filter
+        # those details out unless the user specifically requests
+        # them using the `full` parameter
+        d = remove_extra_event_detail(doc['_source'])
+    return d
+
 def remove_extra_event_detail(event):
 
     ev = {}
     ev['pfx_events'] = []
     for k,v in event.items():
-        if k in ['id', 'event_type', 'view_ts', 'finished_ts', 'asinfo',
-                 'insert_ts', 'last_modified_ts', 'duration', 'tr_metrics',
-                 'event_metrics', 'summary']:
+        if k in EVENT_DETAIL_FIELDS:
              ev[k] = v
              continue
 
@@ -297,90 +699,1184 @@ def remove_extra_event_detail(event):
     ev['debug'] = {}
     return ev
 
-class ElasticSearchConn(object):
-    def __init__(self, nodes, api_key_id, api_key_secret):
-        self.es = Elasticsearch(nodes,
+logger = logging.getLogger(__name__)
+
+# Process-wide owner of the Elasticsearch client.
+#
+# A single client (and therefore a single pool of keep-alive connections per
+# ES node) is shared by every request thread in a worker process. Liveness is
+# checked by a background thread rather than by pinging before every query;
+# if the check fails, the client is rebuilt so that the next request starts
+# with fresh connections.
+#
+# The registry is created once in create_app(), which may happen before the
+# server forks its workers. Sockets and threads inherited across a fork are
+# not usable in the child, so the client and health check thread are created
+# lazily and recreated whenever the owning process id changes.
+class ElasticClientRegistry(object):
+    client_class = Elasticsearch
+
+    def __init__(self, nodes, api_key_id, api_key_secret, maxsize=10,
+            health_interval=30, json_backend=STDLIB_BACKEND,
+            transport_class=None):
+        self.nodes = nodes
+        self.api_key = (api_key_id, api_key_secret)
+        self.maxsize = maxsize
+        self.health_interval = health_interval
+        self.json_backend = json_backend
+        self.transport_class = transport_class
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._client = None
+        self._healthy = True
+        self._health_thread = None
+        self._wakeup = threading.Event()
+
+    @classmethod
+    def from_config(cls, config, json_backend=STDLIB_BACKEND):
+        return cls(config.get('ES_NODES'), config.get('ES_API_KEY_ID'),
+                config.get('ES_API_KEY_SECRET'),
+                maxsize=config.get('ES_MAXSIZE', 10),
+                health_interval=config.get('ES_HEALTH_CHECK_INTERVAL', 30),
+                json_backend=json_backend,
+                transport_class=config.get('ES_TRANSPORT_CLASS'))
+
+    # extra arguments for the client, e.g. a stand-in transport that lets
+    # the benchmarks run without a cluster
+    def _client_options(self):
+        if self.transport_class is None:
+            return {}
+        return {'transport_class': self.transport_class}
+
+    @property
+    def healthy(self):
+        return self._healthy
+
+    def _build_client(self):
+        # maxsize is the number of connections kept open to *each* node
+        return self.client_class(self.nodes,
                 timeout=30, max_retries=5, retry_on_timeout=True,
                 use_ssl=True, verify_certs=False, ssl_show_warn=False,
-                api_key=(api_key_id, api_key_secret))
+                api_key=self.api_key, maxsize=self.maxsize,
+                serializer=GripESSerializer(self.json_backend),
+                **self._client_options())
 
-        if not self.es.ping():
-            raise ValueError("Failed to connect to ElasticSearch")
+    def client(self):
+        client = self._client
+        if client is not None and self._pid == os.getpid():
+            return client
 
-    def getEventById(self, evid):
-        evparams = evid.split('-')
-        if len(evparams) != 3:
-            err_str = "Invalid event ID format -- should be <evtype>-<timestamp>-<aslist>"
-            raise ValidationError(err_str)
-         
-        evtype = evparams[0]
-        
+        with self._lock:
+            if self._pid != os.getpid():
+                # we are the first caller in a newly forked worker -- just
+                # drop the parent's client rather than closing it, as its
+                # sockets are still in use by the parent process
+                self._pid = os.getpid()
+                self._client = None
+                self._health_thread = None
+                self._wakeup = threading.Event()
+
+            if self._client is None:
+                self._client = self._build_client()
+                self._healthy = True
+
+            if self._health_thread is None and self.health_interval > 0:
+                self._health_thread = threading.Thread(
+                        target=self._health_loop, args=(self._wakeup,),
+                        name="grip-es-health", daemon=True)
+                self._health_thread.start()
+
+            return self._client
+
+    def mark_unhealthy(self):
+        # called when a request fails to reach the cluster: check (and
+        # reconnect if needed) straight away instead of waiting for the
+        # next scheduled health check
+        self._healthy = False
+        self._wakeup.set()
+
+    def reconnect(self):
+        with self._lock:
+            old = self._client
+            self._client = self._build_client()
+            self._pid = os.getpid()
+
+        if old is not None:
+            try:
+                old.close()
+            except Exception:
+                pass
+
+    def _health_loop(self, wakeup):
+        while True:
+            wakeup.wait(self.health_interval)
+            wakeup.clear()
+
+            if self._pid != os.getpid():
+                return
+
+            try:
+                ok = self._client.ping()
+            except Exception:
+                ok = False
+
+            if not ok:
+                logger.warning("ElasticSearch health check failed, reconnecting")
+                self.reconnect()
+                try:
+                    ok = self._client.ping()
+                except Exception:
+                    ok = False
+
+            self._healthy = ok
+
+# the URL of an event's _source document
+def event_source_url(indexname, evid):
+    return "/{}/_source/{}".format(quote(indexname, safe=''),
+            quote(evid, safe=''))
+
+# a search that picks the pfx_event matching `search` out of an event
+# using PFX_EVENT_SCRIPT, so that only that pfx_event is sent to us
+def pfx_event_lookup_query(evid, search):
+    return {
+        "query": {"ids": {"values": [evid]}},
+        "size": 1,
+        "_source": False,
+        "script_fields": {
+            "pfx_match": {
+                "script": {
+                    "lang": "painless",
+                    "source": PFX_EVENT_SCRIPT,
+                    "params": {"search": search}
+                }
+            }
+        }
+    }
+
+def pfx_event_lookup_result(evid, results):
+    hits = results['hits']['hits']
+    if len(hits) == 0:
+        raise NotFoundError(404, "not_found", {"_id": evid})
+
+    found = hits[0]['fields']['pfx_match'][0]
+    pfxevent = found.get('pfx_event')
+    if pfxevent is not None:
+        pfxevent = add_high_level_pfx_event_tags(pfxevent, pfxevent)
+    return found['event_type'], pfxevent
+
+# newest events first, with the event ID as a tie-breaker so that the order
+# is stable enough to page through with search_after
+EVENT_SORT = [{"view_ts": "desc"}, {"id": "desc"}]
+
+# number of events fetched per request when exporting a whole result set,
+# and how long elasticsearch should keep the point in time open between them
+EXPORT_BATCH_SIZE = 500
+PIT_KEEP_ALIVE = "2m"
+
+# number of events requested from elasticsearch in each mget request when
+# fetching events in bulk
+MGET_BATCH_SIZE = 100
+
+# Work out how to fetch a batch of events by ID: returns a list of
+# (evid, error) for IDs that are not valid, and a list of (index name, IDs)
+# for the mget requests needed to fetch the rest, with events from the same
+# monthly index grouped together.
+def plan_event_batch(evids):
+    invalid = []
+    groups = {}
+
+    for evid in evids:
         try:
-            evts = datetime.fromtimestamp(int(evparams[1]))
-            datestr = datetime.strftime(evts, "%Y-%m")
-        except:
-            err_str = "Invalid timestamp in event ID -- should be a unix timestamp"
-            raise ValidationError(err_str)
+            indexname = event_index_name(parse_event_id(evid))
+        except ValidationError as v:
+            invalid.append((evid, v.args[0]))
+            continue
+        groups.setdefault(indexname, []).append(evid)
 
-        indexname = "observatory-v4-query-events-{}-{}".format(
-                evtype, datestr)
-        result = self.es.get(index=indexname, id=evid)
-        event = enhance_pfxevents_for_event(result['_source'])
-        return event
+    requests = []
+    for indexname, ids in groups.items():
+        for i in range(0, len(ids), MGET_BATCH_SIZE):
+            requests.append((indexname, ids[i:i + MGET_BATCH_SIZE]))
+    return invalid, requests
 
-    def lookupEvents(self, queryparams):
+# Results for a window that extends up to the present will change as new
+# events arrive, older windows should only change if old events are updated
+# -- the same goes for ongoing events that started before the window when
+# `overlap` is set.
+def search_is_live(queryparams):
+    end = query_param_ts(queryparams, 'ts_end')
+    return end is None or end >= time.time() - LIVE_WINDOW_MARGIN \
+            or queryparams.get('overlap', False, type=bool)
+
+# how recordsTotal is counted for each value of the `total` parameter, as
+# the track_total_hits value to send to elasticsearch -- counting every
+# match is expensive for broad searches, so by default we stop counting
+# once we know there are at least TOTAL_HITS_THRESHOLD
+TOTAL_HITS_THRESHOLD = 10000
+TOTAL_HITS_MODES = {
+    'exact': 'true',
+    'approx': TOTAL_HITS_THRESHOLD,
+    'none': 'false',
+}
 
+# A /json/events search: the request to send to elasticsearch for a set of
+# query parameters, and how to turn the results into our response.
+class EventSearch(object):
+    def __init__(self, queryparams):
         start = queryparams.get("start", default=0, type=int)
-        size = queryparams.get("length", default=100, type=int)
-        event_type = queryparams.get("event_type", default="*", type=str)
+        cursor = queryparams.get("cursor", type=str)
+        brief = queryparams.get("brief")
 
-        if event_type == "all":
-            event_type = '*'
+        self.size = queryparams.get("length", default=100, type=int)
+        self.full = queryparams.get("full") is not None
+        self.index = event_search_index(queryparams)
+        self.months = event_index_months(queryparams)
 
-        brief = queryparams.get("brief")
-        debug = queryparams.get("debug")
-        full = queryparams.get("full")
+        self.total = queryparams.get("total", default="approx", type=str)
+        if self.total not in TOTAL_HITS_MODES:
+            err_str = "Invalid total -- should be one of {}".format(", ".join(TOTAL_HITS_MODES))
+            raise ValidationError(err_str)
 
-        if debug is not None:
-            index = "observatory-v4-test-events-{}-*".format(event_type)
-        else:
-            index = "observatory-v4-query-events-{}-*".format(event_type)
+        self.params = {'from': start, 'size': self.size,
+                'sort': "view_ts:desc,id:desc",
+                'track_total_hits': TOTAL_HITS_MODES[self.total]}
+
+        # when polling for changes, go through them oldest first so that
+        # the high-water mark of each page is where the next one starts
+        self.modified_since = modified_since_ts(queryparams)
+        if self.modified_since is not None:
+            self.params['sort'] = "last_modified_ts:asc,id:asc"
+
+        # only fetch the fields that we are going to return
+        includes = event_source_includes(brief is not None, self.full)
+        if includes is not None:
+            self.params["_source_includes"] = ",".join(includes)
+
+        self.querybody = buildESEventQuery(queryparams)
+        self.fingerprint = query_fingerprint(self.index, self.querybody)
+
+        self.live = self.modified_since is not None or \
+                search_is_live(queryparams)
 
-        kwargs = {'from': start, 'size': size,
-                'sort': "view_ts:desc"}
+        if cursor is not None:
+            # carry on from the last event of the previous page, which
+            # costs the same no matter how deep into the results we are
+            self.querybody['search_after'] = decode_cursor(cursor,
+                    self.fingerprint)
+            self.params['from'] = 0
 
-        if brief is not None:
-            kwargs["_source"] = "*_ts,id,summary,event_type"
+    # identifies searches that will produce the same response
+    def cacheKey(self):
+        key = json.dumps([self.fingerprint, self.params, self.full,
+                self.querybody.get('search_after')], sort_keys=True)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
 
-        querybody = buildESEventQuery(queryparams)
+    # identifies searches that will match the same number of events, no
+    # matter which page of them is being fetched
+    def countKey(self):
+        key = json.dumps(['count', self.fingerprint, self.total])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
 
-        results = self.es.search(body=querybody, index=index, params=kwargs)
+    # the (value, relation) count of matching events from a response, where
+    # relation is "eq" if the count is exact or "gte" if it is a lower bound
+    def count(self, results):
+        total = results['hits'].get('total')
+        if total is None:
+            return (None, None)
+        return (total['value'], total['relation'])
+
+    # `count` is from count(), possibly from an earlier page of results
+    def response(self, results, count):
         ret = {"data": [], "draw": None,
-                "recordsFiltered": 0, "recordsTotal": 0}
+                "recordsFiltered": 0, "recordsTotal": 0,
+                "recordsTotalRelation": None, "cursor": None}
 
         # recordsFiltered has never been correct (or at least it is
         # a misnomer), so I'm just setting it to 0 for now and we
         # can figure out how to implement later if necessary
-        ret['recordsTotal'] = results['hits']['total']['value']
+        ret['recordsTotal'], ret['recordsTotalRelation'] = count
+
+        hits = results['hits']['hits']
+        for num, doc in enumerate(hits):
+            ret['data'].append(format_event_hit(doc, self.full))
+
+        # a short page means there is nothing left to fetch
+        if len(hits) == self.size and self.size > 0:
+            ret['cursor'] = encode_cursor(hits[-1]['sort'], self.fingerprint)
+
+        if self.modified_since is not None:
+            ret['highWaterMark'] = high_water_mark(ret['data'],
+                    self.modified_since)
+
+        return ret
+
+# the latest time at which an event was inserted or updated, or None if it
+# has neither timestamp -- they are all in the same format, so the latest
+# is the greatest as a string
+def event_changed_ts(event):
+    changed = None
+    for field in ('last_modified_ts', 'insert_ts'):
+        ts = event.get(field)
+        if ts is not None and (changed is None or ts > changed):
+            changed = ts
+    return changed
+
+# the latest time at which any of `events` was inserted or updated, or
+# `watermark` if that is later -- the modified_since for the next poll, once
+# every page of this one has been fetched
+def high_water_mark(events, watermark):
+    for ev in events:
+        ts = event_changed_ts(ev)
+        if ts is not None and ts > watermark:
+            watermark = ts
+    return watermark
+
+# the index, body and params of a search for whole events that changed at or
+# after `watermark`, oldest change first, for the live feed
+def event_changes_search(watermark, size, search_after=None):
+    search = EventSearch(MultiDict({'modified_since': watermark,
+            'length': size, 'full': '', 'total': 'none'}))
+
+    body = search.querybody
+    if search_after is not None:
+        body = dict(body, search_after=search_after)
+    return search.index, body, search.params
+
+# the index and query body for exporting every event matching a query, to be
+# used with a point in time and search_after
+def export_query(queryparams):
+    brief = queryparams.get("brief")
+    full = queryparams.get("full")
+
+    index = event_search_index(queryparams)
+    querybody = buildESEventQuery(queryparams)
+    querybody['size'] = EXPORT_BATCH_SIZE
+    querybody['sort'] = EVENT_SORT
+    includes = event_source_includes(brief is not None, full is not None)
+    if includes is not None:
+        querybody['_source'] = includes
+
+    return index, querybody
 
-        for num, doc in enumerate(results['hits']['hits']):
-            if full is not None:
-                d = doc['_source']
-                d['_esid'] = doc['_index']
+# the aggregations that /json/events/stats can return, as the field to
+# aggregate on and the type of aggregation
+STATS_AGGREGATIONS = {
+    'event_type': ('event_type', 'terms'),
+    'time': ('view_ts', 'date_histogram'),
+    'tags': ('summary.tags.name', 'terms'),
+    'asns': ('summary.ases', 'terms'),
+    'codes': ('summary.inference_result.inferences.inference_id', 'terms'),
+    'suspicion': ('summary.inference_result.primary_inference.suspicion_level',
+            'histogram'),
+}
+STATS_INTERVALS = ['hour', 'day', 'week', 'month', 'year']
+STATS_MAX_TERMS = 1000
+
+# A /json/events/stats request: counts of the events matching a set of
+# /json/events query parameters, computed by elasticsearch so that none of
+# the events themselves need to be fetched.
+class EventStats(object):
+    def __init__(self, queryparams):
+        aggstring = queryparams.get("aggs", type=str)
+        if aggstring is None:
+            names = list(STATS_AGGREGATIONS)
+        else:
+            names = sorted(set(aggstring.split(",")))
+            for name in names:
+                if name not in STATS_AGGREGATIONS:
+                    err_str = "Unknown aggregation '{}' -- should be one of {}".format(name, ", ".join(STATS_AGGREGATIONS))
+                    raise ValidationError(err_str)
+
+        interval = queryparams.get("interval", default="day", type=str)
+        if interval not in STATS_INTERVALS:
+            err_str = "Invalid interval -- should be one of {}".format(", ".join(STATS_INTERVALS))
+            raise ValidationError(err_str)
+
+        top = queryparams.get("top", default=10, type=int)
+        if top < 1 or top > STATS_MAX_TERMS:
+            err_str = "Invalid top -- should be between 1 and {}".format(STATS_MAX_TERMS)
+            raise ValidationError(err_str)
+
+        susp_interval = queryparams.get("susp_interval", default=10, type=int)
+        if susp_interval < 1 or susp_interval > 100:
+            err_str = "Invalid susp_interval -- should be between 1 and 100"
+            raise ValidationError(err_str)
+
+        self.index = event_search_index(queryparams)
+        self.months = event_index_months(queryparams)
+        self.params = {'size': 0, 'track_total_hits': 'true'}
+
+        aggs = {}
+        for name in names:
+            field, aggtype = STATS_AGGREGATIONS[name]
+            if aggtype == 'terms':
+                agg = {'field': field, 'size': top}
+            elif aggtype == 'date_histogram':
+                agg = {'field': field, 'calendar_interval': interval,
+                        'format': "yyyy-MM-dd HH:mm:ss"}
             else:
-                # some event details are not required by the UI and can
-                # massively increase the response size, so we'll filter
-                # those details out unless the user specifically requests
-                # them using the `full` parameter
-                d = remove_extra_event_detail(doc['_source'])
+                agg = {'field': field, 'interval': susp_interval,
+                        'extended_bounds': {'min': 0, 'max': 100}}
+            aggs[name] = {aggtype: agg}
 
-            ret['data'].append(d)
+        self.querybody = buildESEventQuery(queryparams)
+        self.querybody['aggs'] = aggs
+        self.live = search_is_live(queryparams)
 
+    def cacheKey(self):
+        key = json.dumps(['stats', self.index, self.querybody], sort_keys=True)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def response(self, results):
+        ret = {'total': results['hits']['total']['value']}
+
+        for name in self.querybody['aggs']:
+            buckets = results.get('aggregations', {}).get(name,
+                    {}).get('buckets', [])
+            ret[name] = [{'key': b.get('key_as_string', b['key']),
+                    'count': b['doc_count']} for b in buckets]
         return ret
 
+# a search window that ends less than this many seconds ago is treated as
+# extending up to the present
+LIVE_WINDOW_MARGIN = 300
+
+# events that finished (or were last modified) less than this many seconds
+# ago may still be updated, so they are cached as if they were ongoing
+EVENT_SETTLE_TIME = 3600
+
+# the fields of an event that its HTTP validator is derived from
+EVENT_VALIDATOR_FIELDS = ['last_modified_ts', 'finished_ts']
+
+# the name that ETags of RawJSON events are derived with
+RAW_EVENT_REPRESENTATION = "raw"
+
+# rough memory cost of one entry in the validator cache
+VALIDATOR_ENTRY_BYTES = 256
+
+# ElasticSearchConn's methods are written once for both the Flask app and
+# the async app in app/asgi.py, as generators ("operations") that yield each
+# piece of I/O they need and are sent back its result, or have its
+# exception thrown in. Everything else they do -- parsing, caching, picking
+# single-flight keys and formatting -- is shared; the two connection
+# classes only differ in how they carry out the I/O (see _run()).
+
+# a call to a method of the elasticsearch client, e.g. 'search'
+ESCall = namedtuple('ESCall', ['method', 'kwargs'])
+
+# a request sent directly on one of the client's pooled connections
+ConnectionCall = namedtuple('ConnectionCall', ['connection', 'method', 'url'])
+
+# the result of the operation `ops`, shared through the single-flight group
+# with any other caller using the same key
+Shared = namedtuple('Shared', ['key', 'ops'])
+
+# the names of the indices matching a pattern, from the index cache
+KnownIndices = namedtuple('KnownIndices', ['pattern'])
+
+# an item produced by a streaming operation, see _stream()
+Emit = namedtuple('Emit', ['item'])
+
+# a streaming operation that produces nothing
+def no_results():
+    return
+    yield
+
+class ElasticSearchConn(object):
+    flight_class = SingleFlight
+    index_cache_class = RefreshingCache
+
+    def __init__(self, registry, event_cache=None, ongoing_ttl=60,
+            finished_ttl=86400, events_enriched=False, query_cache=None,
+            query_live_ttl=30, query_historical_ttl=3600,
+            index_cache_ttl=300, validator_cache=None):
+        self.registry = registry
+        self.json_backend = registry.json_backend
+        self.event_cache = event_cache
+        self.ongoing_ttl = ongoing_ttl
+        self.finished_ttl = finished_ttl
+        self.events_enriched = events_enriched
+        self.query_cache = query_cache
+        self.query_live_ttl = query_live_ttl
+        self.query_historical_ttl = query_historical_ttl
+
+        # the HTTP validators of recently requested events, which outlive
+        # the (much larger) events in the event cache
+        self.validator_cache = validator_cache
+
+        # cleared if the cluster refuses to run PFX_EVENT_SCRIPT
+        self.pfx_script_enabled = True
+
+        # concurrent requests for the same event or search share one query
+        self.flight = self.flight_class()
+
+        # the event indices that exist, used to only search the indices
+        # that cover the requested time window
+        self.index_cache = None
+        if index_cache_ttl > 0:
+            self.index_cache = self.index_cache_class(
+                    lambda pattern: self._run(self._listIndices(pattern)),
+                    ttl=index_cache_ttl, stale_ttl=86400)
+
+    @property
+    def es(self):
+        return self.registry.client()
+
+    # Start the I/O for one of the things an operation yields, and return
+    # its result -- for the async connection, the client, single-flight
+    # group and index cache all return awaitables instead.
+    def _start(self, op):
+        if isinstance(op, ESCall):
+            return attrgetter(op.method)(self.es)(**op.kwargs)
+        if isinstance(op, ConnectionCall):
+            return op.connection.perform_request(op.method, op.url)
+        if isinstance(op, Shared):
+            return self.flight.do(op.key, lambda: self._run(op.ops))
+        if isinstance(op, KnownIndices):
+            return self.index_cache.get(op.pattern)
+        raise TypeError("Unexpected operation {!r}".format(op))
+
+    # Run an operation to the end and return its result. `send` and `value`
+    # resume it with something other than the result of a previous step.
+    def _run(self, ops, send=None, value=None):
+        if send is None:
+            send = ops.send
+        while True:
+            try:
+                op = send(value)
+            except StopIteration as stop:
+                return stop.value
+
+            try:
+                send, value = ops.send, self._start(op)
+            except Exception as e:
+                send, value = ops.throw, e
+
+    # Run an operation that Emits a stream of items, yielding each of them.
+    # If the caller stops early, the operation gets a GeneratorExit so that
+    # it can clean up (which may take more I/O).
+    def _stream(self, ops):
+        send, value = ops.send, None
+        while True:
+            try:
+                op = send(value)
+            except StopIteration:
+                return
+
+            if isinstance(op, Emit):
+                try:
+                    yield op.item
+                except GeneratorExit:
+                    self._close(ops)
+                    raise
+                send, value = ops.send, None
+                continue
+
+            try:
+                send, value = ops.send, self._start(op)
+            except Exception as e:
+                send, value = ops.throw, e
+
+    def _close(self, ops):
+        try:
+            self._run(ops, ops.throw, GeneratorExit())
+        except GeneratorExit:
+            pass
+
+    # run one of the public methods' operations, timed under its name
+    def _call(self, name, ops):
+        with ES_CONN_DURATION.labels(name).time():
+            return self._run(ops)
+
+    # like _call(), for an operation that returns a streaming operation,
+    # e.g. after opening a point in time -- errors before the stream starts
+    # are raised to the caller rather than part-way through a response
+    def _callStream(self, name, ops):
+        return self._stream(self._call(name, ops))
+
+    def _request(self, method, **kwargs):
+        try:
+            with ES_REQUEST_DURATION.labels(method).time():
+                result = yield ESCall(method, kwargs)
+        except ESConnectionError:
+            self.registry.mark_unhealthy()
+            raise
+
+        observe_took(method, result)
+        return result
+
+    # events returned by getEventById() are shared with other requests via
+    # the event cache, so callers must treat them as read-only -- `evid` may
+    # be an EventId, to save parsing the ID again
+    #
+    # If `raw` is set and the stored events already include the fields that
+    # enhance_pfxevents_for_event() would add, an event that is not in the
+    # cache is returned as the RawJSON from elasticsearch rather than being
+    # decoded (and then re-encoded by post_process())
+    def getEventById(self, evid, raw=False):
+        return self._call('getEventById', self._getEventById(evid, raw))
+
+    def _getEventById(self, evid, raw=False):
+        indexname = event_index_name(evid)
+        evid = str(evid)
+
+        if raw and self.events_enriched:
+            cached = self._cachedEvent(('raw', evid))
+            if cached is not None:
+                return cached
+
+        cached = self._cachedEvent(evid)
+        if cached is not None:
+            return cached.event
+
+        if raw and self.events_enriched:
+            return (yield Shared(('raw', evid),
+                    self._fetchRawEvent(indexname, evid)))
+        return (yield Shared(('get', evid), self._fetchEvent(indexname, evid)))
+
+    def _fetchEvent(self, indexname, evid):
+        result = yield from self._request('get', index=indexname, id=evid)
+        return self._cacheEvent(evid, result['_source'],
+                response_size(result))
+
+    def _fetchRawEvent(self, indexname, evid):
+        data = yield from self._rawRequest(event_source_url(indexname, evid))
+        return self._cacheRawEvent(evid, RawJSON(data))
+
+    # `evid` may also be ('raw', evid), for the RawJSON of an event
+    def _cachedEvent(self, evid):
+        if self.event_cache is None:
+            return None
+        return self.event_cache.get(evid)
+
+    # `size` is roughly how big the event is when encoded (e.g. the size of
+    # the response it came in), if we know
+    def _cacheEvent(self, evid, source, size=None):
+        with FORMAT_DURATION.labels('event').time():
+            event = enhance_pfxevents_for_event(source)
+
+        if self.event_cache is not None:
+            if size is None:
+                size = len(self.json_backend.dumps(event))
+            size += len(event['pfx_events']) * PFX_INDEX_ENTRY_BYTES
+            self.event_cache.put(evid, CachedEvent(event), size,
+                    self.eventCacheTTL(event))
+        if self.validator_cache is not None:
+            self.validator_cache.put(evid, self.eventValidator(evid, event),
+                    VALIDATOR_ENTRY_BYTES, self.eventCacheTTL(event))
+        return event
+
+    # RawJSON events are cached as they are, alongside (rather than instead
+    # of) any decoded copy of the same event
+    def _cacheRawEvent(self, evid, event):
+        fields = self._rawEventFields(event)
+        ttl = self.eventCacheTTL(fields)
+
+        if self.event_cache is not None:
+            self.event_cache.put(('raw', evid), event, len(event), ttl)
+        if self.validator_cache is not None:
+            self.validator_cache.put(evid, self.eventValidator(evid, fields),
+                    VALIDATOR_ENTRY_BYTES, ttl)
+        return event
+
+    # the EVENT_VALIDATOR_FIELDS of a RawJSON event, without decoding all of
+    # it unless we have to
+    def _rawEventFields(self, event):
+        fields = raw_fields(event, EVENT_VALIDATOR_FIELDS)
+        if fields is None:
+            fields = self.json_backend.loads(event)
+        return fields
+
+    # The Validator for an event (or its EVENT_VALIDATOR_FIELDS), with an
+    # ETag that changes whenever it is modified. Events that have settled
+    # may be cached by clients for as long as we would cache them
+    # ourselves; other events must always be revalidated.
+    #
+    # RawJSON events from getEventById() are encoded differently from
+    # decoded ones, so they get an ETag of their own.
+    def eventValidator(self, evid, source):
+        if isinstance(source, RawJSON):
+            fields = self._rawEventFields(source)
+            return self.eventValidator(evid, fields).derive(
+                    RAW_EVENT_REPRESENTATION)
+
+        modified = source.get('last_modified_ts')
+        if modified is None:
+            return Validator(None)
+
+        max_age = None
+        if self.eventIsSettled(source):
+            max_age = self.finished_ttl
+        return Validator(make_etag(str(evid), modified),
+                http_time(parse_event_ts(modified)), max_age)
+
+    # the Validators of each representation of an event that getEventById()
+    # may return, given the one for the decoded event
+    def eventValidators(self, validator):
+        if not self.events_enriched:
+            return [validator]
+        return [validator, validator.derive(RAW_EVENT_REPRESENTATION)]
+
+    # the Validator for an event, without fetching the whole event from
+    # elasticsearch unless it is needed anyway -- raises NotFoundError if
+    # there is no such event
+    def getEventValidator(self, evid):
+        return self._call('getEventValidator', self._getEventValidator(evid))
+
+    def _getEventValidator(self, evid):
+        indexname = event_index_name(evid)
+        evid = str(evid)
+
+        cached = self._cachedEvent(evid)
+        if cached is not None:
+            return self.eventValidator(evid, cached.event)
+
+        if self.validator_cache is not None:
+            validator = self.validator_cache.get(evid)
+            if validator is not None:
+                return validator
+
+        return (yield Shared(('validator', evid),
+                self._fetchValidator(indexname, evid)))
+
+    def _fetchValidator(self, indexname, evid):
+        result = yield from self._request('get', index=indexname, id=evid,
+                _source_includes=",".join(EVENT_VALIDATOR_FIELDS))
+        return self._cacheValidator(evid, result['_source'])
+
+    def _cacheValidator(self, evid, source):
+        validator = self.eventValidator(evid, source)
+        if self.validator_cache is not None:
+            self.validator_cache.put(evid, validator, VALIDATOR_ENTRY_BYTES,
+                    self.eventCacheTTL(source))
+        return validator
+
+    # Fetch many events at once. Returns a generator of (evid, event, error)
+    # tuples, one per ID, where exactly one of event and error is set --
+    # errors are a tuple of (HTTP status code, message). Results are
+    # yielded as soon as they are available, so they are not in the same
+    # order as `evids`.
+    def getEventsByIds(self, evids):
+        return self._stream(self._getEventsByIds(evids))
+
+    def _getEventsByIds(self, evids):
+        invalid, requests = plan_event_batch(evids)
+
+        for evid, err in invalid:
+            yield Emit((evid, None, (400, err)))
+
+        for indexname, ids in requests:
+            missing = []
+            for evid in ids:
+                cached = self._cachedEvent(evid)
+                if cached is not None:
+                    yield Emit((evid, cached.event, None))
+                else:
+                    missing.append(evid)
+
+            if len(missing) == 0:
+                continue
+
+            try:
+                results = yield from self._request('mget', index=indexname,
+                        body={'ids': missing})
+            except TransportError as e:
+                # the response is already being streamed, so report the
+                # failure against each event rather than raising
+                for evid in missing:
+                    yield Emit((evid, None, (500, str(e))))
+                continue
+
+            for result in self._mgetResults(results):
+                yield Emit(result)
+
+    def _mgetResults(self, results):
+        docs = results['docs']
+
+        # share the size of the response out between the events in it, in
+        # proportion to their numbers of pfx_events (which is what makes
+        # events big)
+        size = response_size(results)
+        weights = [len(doc['_source'].get('pfx_events') or []) + 1
+                for doc in docs if doc.get('found')]
+        if size is not None and weights:
+            size /= sum(weights)
+
+        for doc in docs:
+            if doc.get('found'):
+                event_size = None
+                if size is not None:
+                    event_size = int(size * (len(
+                            doc['_source'].get('pfx_events') or []) + 1))
+                yield doc['_id'], self._cacheEvent(doc['_id'],
+                        doc['_source'], event_size), None
+            elif 'error' in doc and doc['error'].get('type') != \
+                    'index_not_found_exception':
+                yield doc['_id'], None, (500, str(doc['error'].get('reason')))
+            else:
+                yield doc['_id'], None, (404,
+                        'The requested event was not found')
+
+    # how long an event may be served from the event cache: ongoing events
+    # can change at any moment, while events that finished a while ago are
+    # effectively immutable
+    def eventCacheTTL(self, event):
+        if self.eventIsSettled(event):
+            return self.finished_ttl
+        return self.ongoing_ttl
+
+    def eventIsSettled(self, event):
+        now = time.time()
+
+        finished = parse_event_ts(event.get('finished_ts'))
+        if finished is None or now - finished < EVENT_SETTLE_TIME:
+            return False
+
+        modified = parse_event_ts(event.get('last_modified_ts'))
+        if modified is not None and now - modified < EVENT_SETTLE_TIME:
+            return False
+
+        return True
+
+    # perform a GET request and return the body without decoding it -- the
+    # client's transport always decodes JSON responses, so this goes to a
+    # connection from its pool directly, retrying on other nodes in the
+    # same way as the transport would
+    def _rawRequest(self, url):
+        transport = self.es.transport
+        for attempt in range(transport.max_retries + 1):
+            connection = transport.get_connection()
+            try:
+                with ES_REQUEST_DURATION.labels('raw_get').time():
+                    status, headers, data = yield ConnectionCall(connection,
+                            "GET", url)
+                ES_RESPONSE_BYTES.observe(len(data))
+                return data
+            except ESConnectionError:
+                transport.mark_dead(connection)
+                if attempt == transport.max_retries:
+                    self.registry.mark_unhealthy()
+                    raise
+
+    # find the pfx_event of an event that matches the prefix(es) in
+    # `search`, returns a tuple of (event type, pfx_event) where pfx_event
+    # is None if there is no match
+    def getPfxEventById(self, eventid, search):
+        return self._call('getPfxEventById',
+                self._getPfxEventById(eventid, search))
+
+    def _getPfxEventById(self, eventid, search):
+        indexname = event_index_name(eventid)
+        evid = str(eventid)
+
+        cached = self._cachedEvent(evid)
+        if cached is not None:
+            return cached.event['event_type'], cached.find_pfx_event(search)
+
+        if self.pfx_script_enabled:
+            try:
+                return (yield Shared(('pfx', evid, tuple(search)),
+                        self._lookupPfxEvent(indexname, evid, search)))
+            except (NotFoundError, ESConnectionError):
+                raise
+            except TransportError as e:
+                self._pfxScriptFailed(e)
+
+        # fetch the whole event and scan it ourselves
+        event = yield from self._getEventById(eventid)
+        return event['event_type'], find_pfx_event(event, search)
+
+    def _lookupPfxEvent(self, indexname, evid, search):
+        results = yield from self._request('search',
+                body=pfx_event_lookup_query(evid, search), index=indexname)
+        return pfx_event_lookup_result(evid, results)
+
+    def _pfxScriptFailed(self, e):
+        logger.warning("pfx_event lookup script failed: %s", e)
+        if e.status_code == 400:
+            # scripting is disabled or the script was rejected,
+            # retrying is not going to help
+            self.pfx_script_enabled = False
+
+    def cacheStats(self):
+        stats = {}
+        if self.event_cache is not None:
+            stats['event_cache'] = self.event_cache.stats()
+        if self.query_cache is not None:
+            stats['query_cache'] = self.query_cache.stats()
+        if self.validator_cache is not None:
+            stats['validator_cache'] = self.validator_cache.stats()
+        if self.index_cache is not None:
+            stats['index_cache'] = self.index_cache.stats()
+        stats['single_flight'] = self.flight.stats()
+        return stats
+
+    # responses returned by lookupEvents() may be shared with other
+    # requests via the query cache, so callers must treat them as read-only
+    def lookupEvents(self, queryparams):
+        return self._call('lookupEvents', self._lookupEvents(queryparams))
+
+    def _lookupEvents(self, queryparams):
+        search = EventSearch(queryparams)
+
+        ret = self._cachedSearch(search)
+        if ret is not None:
+            return ret
+
+        return (yield Shared(('search', search.cacheKey()),
+                self._fetchSearch(search)))
+
+    def _fetchSearch(self, search):
+        # don't count the matches again if we already know how many there
+        # are from another page of the same search
+        count = self._cachedCount(search)
+        params = search.params
+        if count is not None:
+            params = dict(params, track_total_hits='false')
+
+        index = yield from self._searchIndex(search.index, search.months)
+        if index is None:
+            results = empty_search_results()
+        else:
+            results = yield from self._request('search',
+                    body=search.querybody, index=index,
+                    params=search_params(params, index, search.index))
+
+        if count is None:
+            count = self._cacheCount(search, search.count(results))
+        with FORMAT_DURATION.labels('search').time():
+            ret = search.response(results, count)
+        return self._cacheSearch(search, ret, response_size(results))
+
+    # the hits from event_changes_search(), fetched `size` at a time and
+    # never cached, since the live feed only asks for each page once --
+    # stops after `max_pages`, anything beyond that is picked up by the
+    # next call
+    def eventChanges(self, watermark, size, max_pages):
+        return self._call('eventChanges',
+                self._eventChanges(watermark, size, max_pages))
+
+    def _eventChanges(self, watermark, size, max_pages):
+        hits = []
+        search_after = None
+        for _ in range(max_pages):
+            index, body, params = event_changes_search(watermark, size,
+                    search_after)
+            results = yield from self._request('search', index=index,
+                    body=body, params=params)
+
+            page = results['hits']['hits']
+            hits.extend(page)
+            if len(page) < size:
+                break
+            search_after = page[-1]['sort']
+        return hits
+
+    # counts of the events matching a search, see EventStats
+    def eventStats(self, queryparams):
+        return self._call('eventStats', self._eventStats(queryparams))
+
+    def _eventStats(self, queryparams):
+        stats = EventStats(queryparams)
+
+        ret = self._cachedSearch(stats)
+        if ret is not None:
+            return ret
+
+        return (yield Shared(('search', stats.cacheKey()),
+                self._fetchStats(stats)))
+
+    def _fetchStats(self, stats):
+        index = yield from self._searchIndex(stats.index, stats.months)
+        if index is None:
+            results = empty_search_results()
+        else:
+            results = yield from self._request('search',
+                    body=stats.querybody, index=index,
+                    params=search_params(stats.params, index, stats.index))
+        with FORMAT_DURATION.labels('stats').time():
+            ret = stats.response(results)
+        return self._cacheSearch(stats, ret, response_size(results))
+
+    # the names of all of the indices matching `pattern`
+    def _listIndices(self, pattern):
+        try:
+            return set((yield from self._request('indices.get_alias',
+                    index=pattern)))
+        except NotFoundError:
+            return set()
+
+    # where to search for events from the given months (see
+    # narrow_event_index()) -- if we can't tell which indices exist, just
+    # search all of them
+    def _searchIndex(self, pattern, months):
+        if months is None or self.index_cache is None:
+            return pattern
+
+        try:
+            known = yield KnownIndices(pattern)
+        except TransportError:
+            known = None
+        return narrow_event_index(pattern, months, known)
+
+    def _cachedSearch(self, search):
+        if self.query_cache is None:
+            return None
+        return self.query_cache.get(search.cacheKey())
+
+    # `size` is the size of the elasticsearch response that `ret` was made
+    # from, if we know it, which is close enough to the size of `ret`
+    def _cacheSearch(self, search, ret, size=None):
+        if self.query_cache is not None:
+            if size is None:
+                size = len(self.json_backend.dumps(ret))
+            ttl = self._searchCacheTTL(search)
+            ret = SharedResponse(ret, ('search', search.cacheKey()), ttl)
+            self.query_cache.put(search.cacheKey(), ret, size, ttl)
+        return ret
+
+    # counts are kept in the query cache alongside the pages of results
+    def _cachedCount(self, search):
+        if self.query_cache is None or search.total == 'none':
+            return None
+        return self.query_cache.get(search.countKey())
+
+    def _cacheCount(self, search, count):
+        if self.query_cache is not None and search.total != 'none':
+            self.query_cache.put(search.countKey(), count,
+                    len(search.countKey()) + 16,
+                    self._searchCacheTTL(search))
+        return count
+
+    def _searchCacheTTL(self, search):
+        if search.live:
+            return self.query_live_ttl
+        return self.query_historical_ttl
+
+    # Walk the entire result set for a query, in the same order as
+    # lookupEvents() but without its size limits. Returns a generator that
+    # yields one formatted event at a time, fetching EXPORT_BATCH_SIZE
+    # events from elasticsearch at a time, so memory use does not depend on
+    # how many events match.
+    #
+    # The point in time is opened before returning, so that errors with
+    # the query are raised to the caller rather than part-way through
+    # streaming the response.
+    def exportEvents(self, queryparams):
+        return self._callStream('exportEvents',
+                self._exportEvents(queryparams))
+
+    def _exportEvents(self, queryparams):
+        full = queryparams.get("full")
+        pattern, querybody = export_query(queryparams)
+
+        index = yield from self._searchIndex(pattern,
+                event_index_months(queryparams))
+        if index is None:
+            return no_results()
+
+        pit = yield from self._request('open_point_in_time', index=index,
+                params=search_params({'keep_alive': PIT_KEEP_ALIVE},
+                index, pattern))
+        return self._exportPages(pit['id'], querybody, full is not None)
+
+    def _exportPages(self, pit_id, querybody, full):
+        try:
+            while True:
+                querybody['pit'] = {'id': pit_id,
+                        'keep_alive': PIT_KEEP_ALIVE}
+                results = yield from self._request('search', body=querybody)
+                pit_id = results.get('pit_id', pit_id)
+
+                hits = results['hits']['hits']
+                for doc in hits:
+                    yield Emit(format_event_hit(doc, full))
+
+                if len(hits) < EXPORT_BATCH_SIZE:
+                    break
+                querybody['search_after'] = hits[-1]['sort']
+        finally:
+            try:
+                yield from self._request('close_point_in_time',
+                        body={'id': pit_id})
+            except Exception:
+                # the PIT will expire by itself after PIT_KEEP_ALIVE
+                pass
+
+    # Install PFX_EVENT_FIELDS_PIPELINE, make it the default pipeline of
+    # every event index so that events written from now on go through it,
+    # and start rewriting the events already stored through it. Returns the
+    # ID of the update_by_query task started for each index, by index name.
+    def installPfxEventPipeline(self):
+        return self._call('installPfxEventPipeline',
+                self._installPfxEventPipeline())
+
+    def _installPfxEventPipeline(self):
+        yield from self._request('ingest.put_pipeline',
+                id=PFX_EVENT_FIELDS_PIPELINE_ID,
+                body=PFX_EVENT_FIELDS_PIPELINE)
+
+        indices = yield from self._listIndices(event_search_index(MultiDict()))
+        tasks = {}
+        for index in sorted(indices):
+            yield from self._request('indices.put_settings', index=index,
+                    body={'index': {
+                        'default_pipeline': PFX_EVENT_FIELDS_PIPELINE_ID}})
+            # events that are written meanwhile go through the default
+            # pipeline anyway, so version conflicts can be skipped
+            result = yield from self._request('update_by_query', index=index,
+                    pipeline=PFX_EVENT_FIELDS_PIPELINE_ID, conflicts="proceed",
+                    slices="auto", wait_for_completion=False)
+            tasks[index] = result['task']
+        return tasks
+
+# the ElasticSearchConn options that come from the app config
+def elastic_options(config):
+    event_cache = None
+    max_bytes = config.get('EVENT_CACHE_MAX_BYTES', 128 * 1024 * 1024)
+    if max_bytes > 0:
+        event_cache = SizedLRUCache(max_bytes)
+
+    query_cache = None
+    max_bytes = config.get('QUERY_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+    if max_bytes > 0:
+        query_cache = SizedLRUCache(max_bytes)
+
+    validator_cache = None
+    max_bytes = config.get('VALIDATOR_CACHE_MAX_BYTES', 4 * 1024 * 1024)
+    if max_bytes > 0:
+        validator_cache = SizedLRUCache(max_bytes)
+
+    return {
+        'event_cache': event_cache,
+        'ongoing_ttl': config.get('EVENT_CACHE_ONGOING_TTL', 60),
+        'finished_ttl': config.get('EVENT_CACHE_FINISHED_TTL', 86400),
+        'events_enriched': config.get('ES_EVENTS_ENRICHED', False),
+        'query_cache': query_cache,
+        'query_live_ttl': config.get('QUERY_CACHE_LIVE_TTL', 30),
+        'query_historical_ttl': config.get('QUERY_CACHE_HISTORICAL_TTL', 3600),
+        'index_cache_ttl': config.get('INDEX_CACHE_TTL', 300),
+        'validator_cache': validator_cache,
+    }
+
+@click.command('install-pfx-event-pipeline')
+@with_appcontext
+def install_pfx_event_pipeline_command():
+    """Install the ingest pipeline needed by ES_EVENTS_ENRICHED."""
+    tasks = getElastic().installPfxEventPipeline()
+    for index, task in tasks.items():
+        click.echo("{}: {}".format(index, task))
+    click.echo("Started updating {} indices. Set ES_EVENTS_ENRICHED once "
+            "every task above has completed (GET _tasks/<task>).".format(
+            len(tasks)))
+
+def init_elastic(app):
+    registry = ElasticClientRegistry.from_config(app.config,
+            json_backend=app.extensions.get('grip_json', STDLIB_BACKEND))
+    app.extensions['grip_es'] = ElasticSearchConn(registry,
+            **elastic_options(app.config))
+    app.cli.add_command(install_pfx_event_pipeline_command)
+
 def getElastic():
-    if 'es' not in g:
-        g.es = ElasticSearchConn(current_app.config['ES_NODES'],
-                current_app.config['ES_API_KEY_ID'],
-                current_app.config['ES_API_KEY_SECRET'])
-    return g.es
+    return current_app.extensions['grip_es']
@@ -0,0 +1,270 @@
+# This source code is Copyright (c) 2023 Georgia Tech Research Corporation. All
+# Rights Reserved. Permission to copy, modify, and distribute this software and
+# its documentation for academic research and education purposes, without fee,
+# and without a written agreement is hereby granted, provided that the above
+# copyright notice, this paragraph and the following three paragraphs appear in
+# all copies. Permission to make use of this software for other than academic
+# research and education purposes may be obtained by contacting:
+#
+#  Office of Technology Licensing
+#  Georgia Institute of Technology
+#  926 Dalney Street, NW
+#  Atlanta, GA 30318
+#  404.385.8066
+#  techlicensing@gtrc.gatech.edu
+#
+# This software program and documentation are copyrighted by Georgia Tech
+# Research Corporation (GTRC). The software program and documentation are 
+# supplied "as is", without any accompanying services from GTRC. GTRC does
+# not warrant that the operation of the program will be uninterrupted or
+# error-free. The end-user understands that the program was developed for
+# research purposes and is advised not to rely exclusively on the program for
+# any reason.
+#
+# IN NO EVENT SHALL GEORGIA TECH RESEARCH CORPORATION BE LIABLE TO ANY PARTY FOR
+# DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING
+# LOST PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION,
+# EVEN IF GEORGIA TECH RESEARCH CORPORATION HAS BEEN ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE. GEORGIA TECH RESEARCH CORPORATION SPECIFICALLY DISCLAIMS ANY
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED
+# HEREUNDER IS ON AN "AS IS" BASIS, AND  GEORGIA TECH RESEARCH CORPORATION HAS
+# NO OBLIGATIONS TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR
+# MODIFICATIONS.
+#
+# This source code is part of the GRIP software. The original GRIP software is
+# Copyright (c) 2015 The Regents of the University of California. All rights
+# reserved. Permission to copy, modify, and distribute this software for
+# academic research and education purposes is subject to the conditions and
+# copyright notices in the source code files and in the included LICENSE file.
+
+# Live feed of new and updated events, pushed to clients as server-sent
+# events from /json/events/live.
+#
+# Rather than every client polling /json/events for itself, one poller per
+# process asks elasticsearch for whatever changed since its last poll (like
+# a /json/events?modified_since search) and hands each change to the
+# subscribers whose filters it matches. Filters take the same parameters as
+# /json/events, and are matched in memory with query_match.matches().
+#
+# Each subscriber has a bounded queue. The poller never waits for a slow
+# subscriber: one whose queue fills up is dropped and told where to catch up
+# from with /json/events?modified_since.
+
+import json, logging, os, queue, threading, time
+from fnmatch import fnmatchcase
+
+from flask import current_app
+
+from app.GripException import ValidationError
+from app.elastic import buildESEventQuery, event_changed_ts, \
+        event_search_index, format_event_hit, high_water_mark
+from app.query_match import matches
+from app.utils import COPYRIGHT_STRING
+
+logger = logging.getLogger(__name__)
+
+# events fetched per request while polling, and the most requests made in
+# one poll -- anything beyond that is picked up by the next poll
+FEED_PAGE_SIZE = 500
+FEED_MAX_PAGES = 20
+
+# how often (in seconds) an idle stream gets a comment, so that proxies
+# don't time it out and disconnected clients are noticed
+FEED_KEEPALIVE = 15
+
+# how long (in seconds) a client turned away because there are too many
+# subscribers is asked to wait before trying again
+FEED_RETRY_AFTER = 60
+
+class FeedFull(Exception):
+    pass
+
+# A subscriber's filter, and the queue of messages waiting to be sent to it.
+class Subscription(object):
+    def __init__(self, index, query, full, messages):
+        self.index = index
+        self.query = query
+        self.full = full
+        self.messages = messages
+
+        # once the subscriber has been dropped for falling behind, the
+        # watermark from which it has missed changes
+        self.lagged = None
+
+    def wants(self, doc):
+        return fnmatchcase(doc['_index'], self.index) and \
+                matches(doc['_source'], self.query)
+
+def sse_message(event, data, msgid=None):
+    msg = "event: {}\n".format(event)
+    if msgid is not None:
+        msg += "id: {}\n".format(msgid)
+    return msg + "data: {}\n\n".format(data)
+
+# One poller and its subscribers.
+class EventFeed(object):
+    queue_full = queue.Full
+
+    def __init__(self, es, interval=10, max_subscribers=100, queue_size=1000):
+        self.es = es
+        self.interval = interval
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+
+        self.subscribers = set()
+
+        # changes at or after the watermark are still to be published, and
+        # `_seen` holds the (id, changed time) of those already published
+        # that changed at exactly the watermark, since the next poll will
+        # return them again
+        self.watermark = None
+        self._seen = set()
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._poller = None
+
+    @classmethod
+    def from_config(cls, es, config):
+        return cls(es, interval=config.get('FEED_POLL_INTERVAL', 10),
+                max_subscribers=config.get('FEED_MAX_SUBSCRIBERS', 100),
+                queue_size=config.get('FEED_QUEUE_SIZE', 1000))
+
+    # Add a subscriber for the events matching a set of /json/events
+    # parameters. Raises FeedFull if there are too many subscribers already.
+    def subscribe(self, queryparams):
+        if queryparams.get("debug") is not None:
+            raise ValidationError("The live feed does not support debug")
+
+        sub = Subscription(event_search_index(queryparams),
+                buildESEventQuery(queryparams)['query'],
+                queryparams.get("full") is not None,
+                self._new_queue())
+
+        with self._lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                raise FeedFull()
+            self.subscribers.add(sub)
+            self._start()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self.subscribers.discard(sub)
+
+    def _new_queue(self):
+        return queue.Queue(self.queue_size)
+
+    # start the poller if it isn't running, with self._lock held
+    def _start(self):
+        if self._poller is not None and self._pid == os.getpid():
+            return
+
+        # only changes from now on
+        self.watermark = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        self._seen = set()
+
+        self._pid = os.getpid()
+        self._poller = threading.Thread(target=self._run,
+                name="grip-event-feed", daemon=True)
+        self._poller.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+
+            # stop once everyone has gone, the next subscriber starts over
+            with self._lock:
+                if len(self.subscribers) == 0 or self._pid != os.getpid():
+                    self._poller = None
+                    return
+
+            try:
+                self._publish(self.es.eventChanges(self.watermark,
+                        FEED_PAGE_SIZE, FEED_MAX_PAGES))
+            except Exception as e:
+                # try again next time, from the same watermark
+                logger.warning("Live feed poll failed: %s", e)
+
+    # hand the changes returned by a poll to the subscribers that want them,
+    # and move the watermark on past them
+    def _publish(self, hits):
+        fresh = []
+        for doc in hits:
+            key = (doc['_source'].get('id'), event_changed_ts(doc['_source']))
+            if key not in self._seen:
+                fresh.append((doc, key))
+
+        start = self.watermark
+        watermark = high_water_mark([doc['_source'] for doc in hits], start)
+        if watermark != start:
+            self._seen = set()
+        self._seen.update(key for doc, key in fresh if key[1] == watermark)
+        self.watermark = watermark
+
+        if len(fresh) == 0:
+            return
+
+        with self._lock:
+            subscribers = list(self.subscribers)
+
+        # each event is formatted (and encoded) at most once per form
+        encoded = {}
+        for doc, key in fresh:
+            for sub in subscribers:
+                if sub.lagged is not None or not sub.wants(doc):
+                    continue
+
+                form = (key, sub.full)
+                if form not in encoded:
+                    event = format_event_hit(dict(doc, _source=dict(
+                            doc['_source'])), sub.full)
+                    encoded[form] = sse_message("event",
+                            self.es.json_backend.dumps(event), key[1])
+                self._offer(sub, encoded[form], start)
+
+    def _offer(self, sub, message, start):
+        try:
+            sub.messages.put_nowait(message)
+        except self.queue_full:
+            # it has missed this change, so it has to catch up from the
+            # start of this poll
+            sub.lagged = start
+            self.unsubscribe(sub)
+
+    def hello(self):
+        return sse_message("hello", json.dumps({
+                'copyright': COPYRIGHT_STRING,
+                'highWaterMark': self.watermark}))
+
+    def goodbye(self, sub):
+        return sse_message("lagged", json.dumps({
+                'error': "Too far behind the live feed -- catch up with /json/events?modified_since=highWaterMark before subscribing again",
+                'highWaterMark': sub.lagged}))
+
+    # the text of the stream for a subscriber
+    def stream(self, sub):
+        try:
+            yield self.hello()
+            while True:
+                try:
+                    if sub.lagged is not None:
+                        # pass on what was queued before it was dropped
+                        yield sub.messages.get_nowait()
+                    else:
+                        yield sub.messages.get(timeout=FEED_KEEPALIVE)
+                except queue.Empty:
+                    if sub.lagged is not None:
+                        yield self.goodbye(sub)
+                        return
+                    yield ": keepalive\n\n"
+        finally:
+            self.unsubscribe(sub)
+
+def init_feed(app):
+    app.extensions['grip_feed'] = EventFeed.from_config(
+            app.extensions['grip_es'], app.config)
+
+def getFeed():
+    return current_app.extensions['grip_feed']
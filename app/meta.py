@@ -0,0 +1,132 @@
+# This source code is Copyright (c) 2023 Georgia Tech Research Corporation. All
+# Rights Reserved. Permission to copy, modify, and distribute this software and
+# its documentation for academic research and education purposes, without fee,
+# and without a written agreement is hereby granted, provided that the above
+# copyright notice, this paragraph and the following three paragraphs appear in
+# all copies. Permission to make use of this software for other than academic
+# research and education purposes may be obtained by contacting:
+#
+#  Office of Technology Licensing
+#  Georgia Institute of Technology
+#  926 Dalney Street, NW
+#  Atlanta, GA 30318
+#  404.385.8066
+#  techlicensing@gtrc.gatech.edu
+#
+# This software program and documentation are copyrighted by Georgia Tech
+# Research Corporation (GTRC). The software program and documentation are 
+# supplied "as is", without any accompanying services from GTRC. GTRC does
+# not warrant that the operation of the program will be uninterrupted or
+# error-free. The end-user understands that the program was developed for
+# research purposes and is advised not to rely exclusively on the program for
+# any reason.
+#
+# IN NO EVENT SHALL GEORGIA TECH RESEARCH CORPORATION BE LIABLE TO ANY PARTY FOR
+# DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING
+# LOST PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION,
+# EVEN IF GEORGIA TECH RESEARCH CORPORATION HAS BEEN ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE. GEORGIA TECH RESEARCH CORPORATION SPECIFICALLY DISCLAIMS ANY
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED
+# HEREUNDER IS ON AN "AS IS" BASIS, AND  GEORGIA TECH RESEARCH CORPORATION HAS
+# NO OBLIGATIONS TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR
+# MODIFICATIONS.
+#
+# This source code is part of the GRIP software. The original GRIP software is
+# Copyright (c) 2015 The Regents of the University of California. All rights
+# reserved. Permission to copy, modify, and distribute this software for
+# academic research and education purposes is subject to the conditions and
+# copyright notices in the source code files and in the included LICENSE file.
+
+import json, os, threading, time
+
+import requests
+from flask import current_app
+
+from app.cache import RefreshingCache
+from app.metrics import META_DURATION
+from app.utils import Validator, http_time, make_etag
+
+# Client for the grip-tags-service (META_SERVICE).
+#
+# The tags, asndrop and blacklist payloads change rarely but are polled
+# constantly by the UI, so responses are kept in a RefreshingCache and
+# fetched through a keep-alive session with a timeout.
+class MetaServiceClient(object):
+    cache_class = RefreshingCache
+
+    def __init__(self, base_url, ttl=60, stale_ttl=3600, timeout=10,
+            adapter=None):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.adapter = adapter
+        self.cache = self.cache_class(self._fetch, ttl=ttl,
+                stale_ttl=stale_ttl)
+
+        # path -> (payload, Validator) for the payloads in the cache
+        self._validators = {}
+
+        self._pid = None
+        self._session = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get('META_SERVICE'),
+                ttl=config.get('META_CACHE_TTL', 60),
+                stale_ttl=config.get('META_CACHE_STALE_TTL', 3600),
+                timeout=config.get('META_TIMEOUT', 10),
+                adapter=config.get('META_ADAPTER'))
+
+    @property
+    def session(self):
+        # don't share pooled connections with a parent process after a fork
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._session = requests.Session()
+                    if self.adapter is not None:
+                        # e.g. a stand-in for the service in the benchmarks
+                        self._session.mount(self.base_url, self.adapter)
+                    self._pid = os.getpid()
+        return self._session
+
+    def _fetch(self, path):
+        with META_DURATION.labels(path).time():
+            r = self.session.get(self.base_url + path, timeout=self.timeout)
+        r.raise_for_status()
+        return self._decode(path, r.content)
+
+    # decode a payload and remember its Validator -- the service doesn't
+    # say when a payload changed, so Last-Modified is the time at which we
+    # first saw the current version
+    def _decode(self, path, body):
+        data = json.loads(body.decode('utf-8'))
+
+        etag = make_etag(body)
+        old = self._validators.get(path)
+        if old is not None and old[1].etag == etag:
+            modified = old[1].last_modified
+        else:
+            modified = http_time(time.time())
+        self._validators[path] = (data, Validator(etag, modified))
+        return data
+
+    def get(self, path):
+        # callers must not modify the returned object, it is shared with
+        # every other request that hits the cache
+        return self.cache.get(path)
+
+    # the Validator for a payload returned by get(), or None if it has
+    # been replaced since
+    def validator(self, path, data):
+        entry = self._validators.get(path)
+        if entry is None or entry[0] is not data:
+            return None
+        return entry[1]
+
+def init_meta(app):
+    app.extensions['grip_meta'] = MetaServiceClient.from_config(app.config)
+
+def getMeta():
+    return current_app.extensions['grip_meta']
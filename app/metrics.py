@@ -0,0 +1,298 @@
+# This source code is Copyright (c) 2023 Georgia Tech Research Corporation. All
+# Rights Reserved. Permission to copy, modify, and distribute this software and
+# its documentation for academic research and education purposes, without fee,
+# and without a written agreement is hereby granted, provided that the above
+# copyright notice, this paragraph and the following three paragraphs appear in
+# all copies. Permission to make use of this software for other than academic
+# research and education purposes may be obtained by contacting:
+#
+#  Office of Technology Licensing
+#  Georgia Institute of Technology
+#  926 Dalney Street, NW
+#  Atlanta, GA 30318
+#  404.385.8066
+#  techlicensing@gtrc.gatech.edu
+#
+# This software program and documentation are copyrighted by Georgia Tech
+# Research Corporation (GTRC). The software program and documentation are 
+# supplied "as is", without any accompanying services from GTRC. GTRC does
+# not warrant that the operation of the program will be uninterrupted or
+# error-free. The end-user understands that the program was developed for
+# research purposes and is advised not to rely exclusively on the program for
+# any reason.
+#
+# IN NO EVENT SHALL GEORGIA TECH RESEARCH CORPORATION BE LIABLE TO ANY PARTY FOR
+# DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING
+# LOST PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION,
+# EVEN IF GEORGIA TECH RESEARCH CORPORATION HAS BEEN ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE. GEORGIA TECH RESEARCH CORPORATION SPECIFICALLY DISCLAIMS ANY
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED
+# HEREUNDER IS ON AN "AS IS" BASIS, AND  GEORGIA TECH RESEARCH CORPORATION HAS
+# NO OBLIGATIONS TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR
+# MODIFICATIONS.
+#
+# This source code is part of the GRIP software. The original GRIP software is
+# Copyright (c) 2015 The Regents of the University of California. All rights
+# reserved. Permission to copy, modify, and distribute this software for
+# academic research and education purposes is subject to the conditions and
+# copyright notices in the source code files and in the included LICENSE file.
+
+# Prometheus metrics, served in the text exposition format from /metrics.
+#
+# Metrics are kept per process, like the caches, so each worker has to be
+# scraped separately (or be behind a proxy that identifies the worker). The
+# histograms are cheap enough to be updated on every request: observe() is a
+# bisect and a few additions under a lock. Cache and single-flight numbers
+# are read from the caches' own stats (see cache_stats()) when /metrics is
+# scraped, so they cost nothing in between.
+
+import threading, time
+from bisect import bisect_left
+
+from flask import current_app, g, request
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+        0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+        16777216, 67108864)
+
+# every metric created by this module, in the order they are rendered
+METRICS = []
+
+class _HistogramChild(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count', 'lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    # times the body of a `with` block, which may contain awaits
+    def time(self):
+        return _Timer(self)
+
+class _Timer(object):
+    __slots__ = ('child', 'start')
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+        return False
+
+class Histogram(object):
+    def __init__(self, name, documentation, labelnames=(),
+            buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+
+        self._children = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values,
+                        _HistogramChild(self.buckets))
+        return child
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                "# TYPE {} histogram".format(self.name)]
+
+        for values, child in sorted(self._children.items()):
+            labels = list(zip(self.labelnames, values))
+            with child.lock:
+                counts = list(child.counts)
+                total, count = child.sum, child.count
+
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                lines.append("{}_bucket{} {}".format(self.name,
+                        _labels(labels + [('le', _value(bound))]),
+                        cumulative))
+            lines.append("{}_sum{} {}".format(self.name, _labels(labels),
+                    _value(total)))
+            lines.append("{}_count{} {}".format(self.name, _labels(labels),
+                    count))
+        return lines
+
+REQUEST_DURATION = Histogram('grip_api_request_duration_seconds',
+        'Time taken to produce a response (streamed bodies are not included)',
+        ['route', 'method', 'status'])
+RESPONSE_BYTES = Histogram('grip_api_response_bytes',
+        'Size of response bodies with a known length', ['route'],
+        buckets=BYTES_BUCKETS)
+JSON_ENCODE_DURATION = Histogram('grip_json_encode_duration_seconds',
+        'Time spent encoding JSON response bodies')
+FORMAT_DURATION = Histogram('grip_format_duration_seconds',
+        'Time spent turning elasticsearch results into responses', ['stage'])
+
+ES_CONN_DURATION = Histogram('grip_es_conn_duration_seconds',
+        'Time taken by ElasticSearchConn methods, including cache hits',
+        ['method'])
+ES_REQUEST_DURATION = Histogram('grip_es_request_duration_seconds',
+        'Wall time of requests to elasticsearch, including the network and '
+        'decoding the response', ['method'])
+ES_TOOK = Histogram('grip_es_took_seconds',
+        'Time elasticsearch reported spending on requests (took)', ['method'])
+ES_RESPONSE_BYTES = Histogram('grip_es_response_bytes',
+        'Size of response bodies from elasticsearch', buckets=BYTES_BUCKETS)
+ES_DECODE_DURATION = Histogram('grip_es_decode_duration_seconds',
+        'Time spent decoding response bodies from elasticsearch')
+
+META_DURATION = Histogram('grip_meta_request_duration_seconds',
+        'Time taken by requests to the meta service', ['path'])
+
+# record the `took` time from an elasticsearch response, if it has one
+def observe_took(method, result):
+    if isinstance(result, dict) and 'took' in result:
+        ES_TOOK.labels(method).observe(result['took'] / 1000.0)
+
+def _value(v):
+    if v == float("inf"):
+        return "+Inf"
+    if isinstance(v, float):
+        return repr(v)
+    return str(v)
+
+def _labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+            .replace('"', '\\"').replace('\n', '\\n'))
+            for k, v in labels) + "}"
+
+def _family(lines, name, mtype, documentation, samples):
+    lines.append("# HELP {} {}".format(name, documentation))
+    lines.append("# TYPE {} {}".format(name, mtype))
+    for labels, value in samples:
+        lines.append("{}{} {}".format(name, _labels(labels), _value(value)))
+
+# the metrics for the caches and single-flight groups in cache_stats()
+def _cache_lines(stats):
+    lines = []
+    caches = [(name, s) for name, s in sorted(stats.items())
+            if name != 'single_flight']
+
+    for key, name, mtype, documentation in [
+            ('hits', 'grip_cache_hits_total', 'counter', 'Cache hits'),
+            ('stale_hits', 'grip_cache_stale_hits_total', 'counter',
+                    'Cache hits on entries that were due to be refreshed'),
+            ('misses', 'grip_cache_misses_total', 'counter', 'Cache misses'),
+            ('evictions', 'grip_cache_evictions_total', 'counter',
+                    'Entries evicted to make room for new ones'),
+            ('expirations', 'grip_cache_expirations_total', 'counter',
+                    'Entries dropped because they had expired'),
+            ('entries', 'grip_cache_entries', 'gauge', 'Entries in the cache'),
+            ('bytes', 'grip_cache_bytes', 'gauge', 'Size of the cache'),
+            ('max_bytes', 'grip_cache_max_bytes', 'gauge',
+                    'Maximum size of the cache')]:
+        # not every kind of cache keeps every stat
+        _family(lines, name, mtype, documentation,
+                [([('cache', c)], s[key]) for c, s in caches if key in s])
+
+    ratios = []
+    for c, s in caches:
+        lookups = s['hits'] + s['misses']
+        ratios.append(([('cache', c)],
+                s['hits'] / lookups if lookups else 0.0))
+    _family(lines, 'grip_cache_hit_ratio', 'gauge',
+            'Fraction of cache lookups that were hits', ratios)
+
+    flight = stats.get('single_flight')
+    if flight is not None:
+        _family(lines, 'grip_single_flight_calls_total', 'counter',
+                'Calls made through the single-flight group',
+                [([], flight['calls'])])
+        _family(lines, 'grip_single_flight_coalesced_total', 'counter',
+                'Calls that waited for an identical call already in flight',
+                [([], flight['coalesced'])])
+        _family(lines, 'grip_single_flight_in_flight', 'gauge',
+                'Calls currently in flight', [([], flight['in_flight'])])
+    return lines
+
+# the stats of every cache in `app`, by name, as served by /json/cache_stats
+def cache_stats(app):
+    stats = dict(app.extensions['grip_es'].cacheStats())
+
+    meta = app.extensions.get('grip_meta')
+    if meta is not None:
+        stats['meta_cache'] = meta.cache.stats()
+
+    compressor = app.extensions.get('grip_compression')
+    if compressor is not None and compressor.cache is not None:
+        stats['compression_cache'] = compressor.stats()
+    return stats
+
+# the /metrics response body
+def render_metrics(app):
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    lines.extend(_cache_lines(cache_stats(app)))
+    return "\n".join(lines) + "\n"
+
+# the name of the route that handled `request`, which (unlike the path)
+# doesn't include event IDs and the like
+def request_route(request):
+    if request.url_rule is None:
+        return "unmatched"
+    return request.url_rule.rule
+
+def record_request(request, response, duration):
+    route = request_route(request)
+    REQUEST_DURATION.labels(route, request.method,
+            str(response.status_code)).observe(duration)
+    if response.content_length is not None:
+        RESPONSE_BYTES.labels(route).observe(response.content_length)
+
+def init_metrics(app):
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record(response):
+        start = g.get('request_start')
+        if start is not None:
+            record_request(request, response, time.perf_counter() - start)
+        return response
+
+    def metrics():
+        return current_app.response_class(
+                render_metrics(current_app),
+                content_type=CONTENT_TYPE)
+
+    app.add_url_rule('/metrics', 'metrics', metrics)
@@ -0,0 +1,182 @@
+# This source code is Copyright (c) 2023 Georgia Tech Research Corporation. All
+# Rights Reserved. Permission to copy, modify, and distribute this software and
+# its documentation for academic research and education purposes, without fee,
+# and without a written agreement is hereby granted, provided that the above
+# copyright notice, this paragraph and the following three paragraphs appear in
+# all copies. Permission to make use of this software for other than academic
+# research and education purposes may be obtained by contacting:
+#
+#  Office of Technology Licensing
+#  Georgia Institute of Technology
+#  926 Dalney Street, NW
+#  Atlanta, GA 30318
+#  404.385.8066
+#  techlicensing@gtrc.gatech.edu
+#
+# This software program and documentation are copyrighted by Georgia Tech
+# Research Corporation (GTRC). The software program and documentation are 
+# supplied "as is", without any accompanying services from GTRC. GTRC does
+# not warrant that the operation of the program will be uninterrupted or
+# error-free. The end-user understands that the program was developed for
+# research purposes and is advised not to rely exclusively on the program for
+# any reason.
+#
+# IN NO EVENT SHALL GEORGIA TECH RESEARCH CORPORATION BE LIABLE TO ANY PARTY FOR
+# DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING
+# LOST PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION,
+# EVEN IF GEORGIA TECH RESEARCH CORPORATION HAS BEEN ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE. GEORGIA TECH RESEARCH CORPORATION SPECIFICALLY DISCLAIMS ANY
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED
+# HEREUNDER IS ON AN "AS IS" BASIS, AND  GEORGIA TECH RESEARCH CORPORATION HAS
+# NO OBLIGATIONS TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR
+# MODIFICATIONS.
+#
+# This source code is part of the GRIP software. The original GRIP software is
+# Copyright (c) 2015 The Regents of the University of California. All rights
+# reserved. Permission to copy, modify, and distribute this software for
+# academic research and education purposes is subject to the conditions and
+# copyright notices in the source code files and in the included LICENSE file.
+
+# Evaluate elasticsearch queries against documents in memory, e.g. to decide
+# which live feed subscribers an event should go to without asking
+# elasticsearch once per subscriber.
+
+import operator
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from app.elastic import parse_event_ts
+
+def field_values(doc, path):
+    values = [doc]
+    for key in path.split("."):
+        found = []
+        for v in values:
+            if isinstance(v, dict) and v.get(key) is not None:
+                found.append(v[key])
+        values = []
+        for v in found:
+            values.extend(v if isinstance(v, list) else [v])
+    return values
+
+# the "*_ts" fields are dates, which elasticsearch compares as points in
+# time however they are written -- returns seconds since the epoch, or None
+# if `value` isn't a date
+@lru_cache(maxsize=65536)
+def date_value(value):
+    try:
+        ts = parse_event_ts(value)
+    except (ValueError, OverflowError, OSError):
+        ts = None
+
+    if ts is None and isinstance(value, str):
+        try:
+            dt = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        ts = dt.timestamp()
+    return ts
+
+# Elasticsearch converts the argument of a term or range query to the type
+# of the field, e.g. asns=70446 becomes the term "70446", which matches the
+# number 70446 in summary.ases. We don't have the mapping, so the type is
+# taken from the document value `like`. Returns None if `arg` can't be
+# converted, which never matches.
+def coerce(field, arg, like):
+    if field.endswith("_ts"):
+        return date_value(arg)
+
+    if isinstance(like, bool):
+        if isinstance(arg, str):
+            return {'true': True, 'false': False}.get(arg)
+        return arg
+
+    if isinstance(like, (int, float)):
+        if isinstance(arg, str):
+            try:
+                return float(arg)
+            except ValueError:
+                return None
+        return arg
+
+    if isinstance(like, str) and isinstance(arg, (int, float)) and \
+            not isinstance(arg, bool):
+        return str(arg)
+    return arg
+
+def doc_value(field, value):
+    if field.endswith("_ts"):
+        return date_value(value)
+    return value
+
+def term_matches(field, value, arg):
+    value = doc_value(field, value)
+    return value is not None and coerce(field, arg, value) == value
+
+RANGE_OPS = {
+    'gte': operator.ge,
+    'gt': operator.gt,
+    'lte': operator.le,
+    'lt': operator.lt,
+}
+
+def in_range(field, value, bounds):
+    value = doc_value(field, value)
+    if value is None:
+        return False
+
+    for op, bound in bounds.items():
+        if op not in RANGE_OPS:
+            continue
+        bound = coerce(field, bound, value)
+        if bound is None or not RANGE_OPS[op](value, bound):
+            return False
+    return True
+
+# the clauses of one occurrence type of a bool query, which may be given as
+# a single clause or a list of them
+def clauses(body, occur):
+    value = body.get(occur, [])
+    if isinstance(value, dict):
+        return [value]
+    return value
+
+# whether `doc` matches `query`, for the subset of the query DSL that
+# buildESEventQuery() and the other queries in app/elastic.py use
+def matches(doc, query):
+    (qtype, body), = query.items()
+
+    if qtype == 'bool':
+        required = clauses(body, 'must') + clauses(body, 'filter')
+        if not all(matches(doc, q) for q in required):
+            return False
+
+        if any(matches(doc, q) for q in clauses(body, 'must_not')):
+            return False
+
+        # should clauses are optional alongside must or filter clauses,
+        # otherwise at least one has to match
+        should = clauses(body, 'should')
+        needed = body.get('minimum_should_match', 0 if required else 1)
+        if should and needed > 0:
+            return sum(1 for q in should if matches(doc, q)) >= needed
+        return True
+
+    if qtype == 'match_all':
+        return True
+    if qtype == 'ids':
+        return doc.get('id') in body['values']
+    if qtype == 'exists':
+        return len(field_values(doc, body['field'])) > 0
+
+    (field, arg), = body.items()
+    values = field_values(doc, field)
+    if qtype in ('term', 'match'):
+        return any(term_matches(field, v, arg) for v in values)
+    if qtype == 'range':
+        return any(in_range(field, v, arg) for v in values)
+
+    raise ValueError("unsupported query type " + qtype)
@@ -0,0 +1,183 @@
+# This source code is Copyright (c) 2023 Georgia Tech Research Corporation. All
+# Rights Reserved. Permission to copy, modify, and distribute this software and
+# its documentation for academic research and education purposes, without fee,
+# and without a written agreement is hereby granted, provided that the above
+# copyright notice, this paragraph and the following three paragraphs appear in
+# all copies. Permission to make use of this software for other than academic
+# research and education purposes may be obtained by contacting:
+#
+#  Office of Technology Licensing
+#  Georgia Institute of Technology
+#  926 Dalney Street, NW
+#  Atlanta, GA 30318
+#  404.385.8066
+#  techlicensing@gtrc.gatech.edu
+#
+# This software program and documentation are copyrighted by Georgia Tech
+# Research Corporation (GTRC). The software program and documentation are 
+# supplied "as is", without any accompanying services from GTRC. GTRC does
+# not warrant that the operation of the program will be uninterrupted or
+# error-free. The end-user understands that the program was developed for
+# research purposes and is advised not to rely exclusively on the program for
+# any reason.
+#
+# IN NO EVENT SHALL GEORGIA TECH RESEARCH CORPORATION BE LIABLE TO ANY PARTY FOR
+# DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING
+# LOST PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION,
+# EVEN IF GEORGIA TECH RESEARCH CORPORATION HAS BEEN ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE. GEORGIA TECH RESEARCH CORPORATION SPECIFICALLY DISCLAIMS ANY
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED
+# HEREUNDER IS ON AN "AS IS" BASIS, AND  GEORGIA TECH RESEARCH CORPORATION HAS
+# NO OBLIGATIONS TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR
+# MODIFICATIONS.
+#
+# This source code is part of the GRIP software. The original GRIP software is
+# Copyright (c) 2015 The Regents of the University of California. All rights
+# reserved. Permission to copy, modify, and distribute this software for
+# academic research and education purposes is subject to the conditions and
+# copyright notices in the source code files and in the included LICENSE file.
+
+import json
+
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch.exceptions import SerializationError
+from flask.json.provider import DefaultJSONProvider
+
+from app.metrics import ES_DECODE_DURATION, ES_RESPONSE_BYTES, \
+        JSON_ENCODE_DURATION
+
+# orjson and ujson are both optional -- if neither is installed, everything
+# falls back to the standard library json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# A JSON encoder/decoder pair. dumps() must produce compact output (no
+# whitespace) and raise TypeError or ValueError for anything it can't encode,
+# so that callers can retry with the standard library.
+class JSONBackend(object):
+    name = "json"
+
+    def dumps(self, obj, sort_keys=False, default=None):
+        return json.dumps(obj, sort_keys=sort_keys, default=default,
+                ensure_ascii=False, separators=(",", ":"))
+
+    def loads(self, s):
+        return json.loads(s)
+
+class OrjsonBackend(JSONBackend):
+    name = "orjson"
+
+    def dumps(self, obj, sort_keys=False, default=None):
+        # let datetimes fall through to `default` so they are formatted the
+        # same way as they would be by the standard library
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=default, option=option).decode("utf-8")
+
+    def loads(self, s):
+        return orjson.loads(s)
+
+class UjsonBackend(JSONBackend):
+    name = "ujson"
+
+    # ujson has no `default` hook, anything that it can't encode is left to
+    # the standard library
+    def dumps(self, obj, sort_keys=False, default=None):
+        try:
+            return ujson.dumps(obj, sort_keys=sort_keys, ensure_ascii=False,
+                    escape_forward_slashes=False)
+        except OverflowError as e:
+            raise ValueError(str(e))
+
+    def loads(self, s):
+        return ujson.loads(s)
+
+STDLIB_BACKEND = JSONBackend()
+
+# pick a JSON backend by name, "auto" picks the fastest one available
+def get_json_backend(name="auto"):
+    if name in ["auto", "orjson"] and orjson is not None:
+        return OrjsonBackend()
+    if name in ["auto", "ujson"] and ujson is not None:
+        return UjsonBackend()
+    return STDLIB_BACKEND
+
+# Flask JSON provider (used by jsonify() and therefore post_process()) that
+# encodes with the fast backend, falling back to the standard library for
+# pretty-printed output and for anything the backend can't handle.
+class GripJSONProvider(DefaultJSONProvider):
+    def __init__(self, app, backend):
+        super().__init__(app)
+        self.backend = backend
+
+    def dumps(self, obj, **kwargs):
+        with JSON_ENCODE_DURATION.time():
+            if self.backend is not STDLIB_BACKEND and "indent" not in kwargs:
+                try:
+                    return self.backend.dumps(obj, sort_keys=self.sort_keys,
+                            default=self.default)
+                except (TypeError, ValueError):
+                    pass
+            return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return self.backend.loads(s)
+
+# A decoded elasticsearch response, which remembers how long it was when
+# encoded so that the caches can size what they keep from it without
+# encoding it again.
+class ESResponse(dict):
+    __slots__ = ('size',)
+
+    def __init__(self, data, size):
+        super().__init__(data)
+        self.size = size
+
+# the encoded size of an elasticsearch response, or None if it is unknown
+def response_size(result):
+    return getattr(result, 'size', None)
+
+# The same for the elasticsearch client, which decodes every response (and
+# encodes every query body) with its serializer.
+class GripESSerializer(JSONSerializer):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def loads(self, s):
+        ES_RESPONSE_BYTES.observe(len(s))
+        try:
+            with ES_DECODE_DURATION.time():
+                data = self.backend.loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
+        if isinstance(data, dict):
+            # only copies the top level, which is a handful of keys
+            data = ESResponse(data, len(s))
+        return data
+
+    def dumps(self, data):
+        # don't serialize strings
+        if isinstance(data, str):
+            return data
+
+        try:
+            return self.backend.dumps(data, default=self.default)
+        except (ValueError, TypeError):
+            return super().dumps(data)
+
+def init_serializer(app):
+    backend = get_json_backend(app.config.get('JSON_BACKEND', 'auto'))
+    app.json = GripJSONProvider(app, backend)
+    app.extensions['grip_json'] = backend
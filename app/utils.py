@@ -1,145 +1,473 @@
-import time
-from flask import jsonify, make_response
+import hashlib, json, re, time
+from datetime import datetime, timezone
+from functools import lru_cache
+from ipaddress import ip_network
+from flask import current_app, request, stream_with_context
 
 from app.GripException import ValidationError
+from app.compression import CONTENT_CODINGS, CompressingStream, coded_etag
 
 COPYRIGHT_STRING = "This data is Copyright (c) 2021 Georgia Tech Research Corporation. All Rights Reserved."
 
+# The helpers that build responses take the app and request to use, so that
+# they can be shared with the async app (see app/asgi.py) -- the Flask app
+# calls them through the wrappers below, which pass its current_app and
+# request.
+
+# encode a response body the way jsonify() would: compact, or indented if
+# the app is in debug mode and the JSON provider doesn't say otherwise
+def encode_json(app, data):
+    compact = app.json.compact
+    if compact is False or (compact is None and app.debug):
+        return app.json.dumps(data, indent=2) + "\n"
+    return app.json.dumps(data, separators=(",", ":")) + "\n"
+
+def error_response(app, message_str, status_code):
+    return app.response_class(encode_json(app, {'error': message_str}),
+            status=status_code, mimetype="application/json")
+
 def handle_exception(message_str, status_code):
-    message = {'error': message_str}
-    return make_response(jsonify(message), status_code)
+    return error_response(current_app, message_str, status_code)
+
+# a JSON object that has already been encoded (e.g. exactly as it was
+# returned by elasticsearch), which post_process() passes through untouched
+class RawJSON(str):
+    pass
+
+# A response that is shared with other requests through a cache (e.g. the
+# query cache) until `expires`, a time.monotonic() deadline. Compressed
+# copies of it are cached under `key` for as long, just like those of
+# responses with an ETag.
+class SharedResponse(dict):
+    __slots__ = ('key', 'expires')
 
-def post_process(data):
+    def __init__(self, data, key, ttl):
+        super().__init__(data)
+        self.key = key
+        self.expires = time.monotonic() + ttl
+
+def add_copyright(data):
+    # shallow copy, so that cached objects are never modified
+    data = dict(data)
     data['copyright'] = COPYRIGHT_STRING
-    return jsonify(data)
+    return data
 
-def is_valid_past_timestamp(timestamp:str):
-    timestamp = int(timestamp)
-    current_timestamp = int(time.time())
-    return 0 < timestamp < current_timestamp
-    
-def is_valid_asn(asn:str):
-    asn = int(asn)
+# splice the copyright into the end of an encoded JSON object, rather than
+# decoding it just to add one key and encoding it all over again
+def add_copyright_raw(raw):
+    body = raw.rstrip()
+    if not body.endswith("}"):
+        raise ValueError("Expected a JSON object")
 
-    # checking for 32 bit int
-    if 1 <= asn <= 4294967295:
-        return True
+    if body[:-1].rstrip().endswith("{"):
+        sep = ""
+    else:
+        sep = ","
 
-    # If the function reaches here the asn is invalid
-    err_str = "One or more ASNs listed in the event ID are not valid ASNs"
-    raise ValidationError(err_str)
+    return "{}{}\"copyright\":{}}}\n".format(body[:-1], sep,
+            json.dumps(COPYRIGHT_STRING))
 
-def validate_moas(as_list):
-    try:
-        as_list_arr = as_list.split('_')
-        assert len(as_list_arr)
+# the strings (keys and values) and brackets of encoded JSON, i.e. everything
+# that tells us how deeply nested we are
+JSON_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|[][{}]')
+JSON_KEY_VALUE = re.compile(r'\s*:\s*("(?:[^"\\]|\\.)*"|null|true|false|[-0-9.eE+]+)')
 
-        as_list_seen = set()
+# how far into an encoded object raw_fields() looks
+RAW_FIELDS_SCAN_CHARS = 8192
 
-        for asn in as_list_arr:
-            assert is_valid_asn(asn)
-            assert asn not in as_list_seen
-            as_list_seen.add(asn)
+# the values of some of the top-level fields of an encoded JSON object,
+# without decoding the rest of it -- returns None unless all of them are
+# near the start and have simple (non-object, non-array) values
+def raw_fields(raw, fields):
+    wanted = set(fields)
+    found = {}
+    depth = 0
+    for m in JSON_TOKEN.finditer(raw):
+        if m.start() > RAW_FIELDS_SCAN_CHARS:
+            return None
 
-    except ValidationError as v:
-        raise v
-    
-    except Exception as e:
-        err_str = "Invalid MOAS event. The right format for a MOAS event is moas-<unix_timestamp>-<asn1_asn2_...>, with each asn being a valid AS number"
-        raise ValidationError(err_str)
+        token = m.group()
+        if token in "{[":
+            depth += 1
+        elif token in "}]":
+            depth -= 1
+            if depth == 0:
+                return None
+        elif depth == 1 and token[1:-1] in wanted:
+            value = JSON_KEY_VALUE.match(raw, m.end())
+            if value is None:
+                # an object or array, or not a key at all
+                continue
+            found[token[1:-1]] = json.loads(value.group(1))
+            if len(found) == len(wanted):
+                return found
+    return None
 
-def validate_submoas(as_list):
-    try:
-        as_list_arr = as_list.split('=')
-        assert len(as_list_arr) == 2
-        
-        victim_list = as_list_arr[0].split('_')
-        assert len(victim_list)
-
-        as_list_seen = set()
-
-        for asn in victim_list:
-            assert is_valid_asn(asn)
-            assert asn not in as_list_seen
-            as_list_seen.add(asn)
-        
-        as_list_seen = set() # reinitializing as attackers can potentially be in the victim list
-
-        attacker_list = as_list_arr[1].split('_')
-        assert len(attacker_list)
-
-        for asn in attacker_list:
-            assert is_valid_asn(asn)
-            assert asn not in as_list_seen
-            as_list_seen.add(asn)
-
-    except ValidationError as v:
-        raise v
-    
-    except Exception as e:
-        err_str = "Invalid SUBMOAS event. The right format for a SUBMOAS event is submoas-<unix_timestamp>-<victim-asn1_victim-asn2_...>=<attacker-asn1_attacker-asn2...>, with each asn being a valid AS number"
-        raise ValidationError(err_str)
+# the JSON response for `data`, with the headers for `validator` (if any),
+# compressed if the client accepts it
+def json_response(app, req, data, validator=None):
+    if isinstance(data, RawJSON):
+        encode = lambda: add_copyright_raw(data)
+    else:
+        encode = lambda: encode_json(app, add_copyright(data))
 
-def validate_defcon(as_list):
-    try:
-        as_list_arr = as_list.split('_')
-        assert len(as_list_arr)
-        as_list_seen = set()
-
-        for asn in as_list_arr:
-            assert is_valid_asn(asn)
-            assert asn not in as_list_seen
-            as_list_seen.add(asn)
-    
-    except ValidationError as v:
-            raise v
-    
-    except Exception as e:
-        err_str = "Invalid DEFCON event ID. The right format for a DEFCON event is defcon-<unix_timestamp>-<victim-asn1_victim-asn2_...>, with each asn being a valid AS number"
-        raise ValidationError(err_str)
+    compressor = app.extensions.get('grip_compression')
+    key, expires = None, None
+    if validator is not None:
+        key = validator.etag
+    elif isinstance(data, SharedResponse):
+        key, expires = data.key, data.expires
+
+    if compressor is None:
+        body, coding = encode(), None
+    else:
+        body, coding = compressor.encode(req.accept_encodings, encode, key,
+                expires)
+
+    response = app.response_class(body, mimetype="application/json")
+    add_validator_headers(response, validator)
+    return add_encoding_headers(response, compressor, coding)
+
+def post_process(data, validator=None):
+    return json_response(current_app, request, data, validator)
+
+# Newline-delimited JSON, for an iterable of objects that are streamed to the
+# client followed by the copyright, and compressed if the client accepts it.
+# push() returns the bytes that are ready to be sent (possibly none) and
+# finish() the rest -- the caller feeds it items as they arrive and streams
+# what comes out as the body of response().
+class NDJSONEncoder(object):
+    def __init__(self, app, req):
+        self.app = app
+        self.dumps = app.json.dumps
+
+        self.compressor = app.extensions.get('grip_compression')
+        self.coding = None
+        self._stream = None
+        if self.compressor is not None:
+            self.coding = self.compressor.choose(req.accept_encodings)
+            if self.coding is not None:
+                self._stream = CompressingStream(self.compressor, self.coding)
+
+    def push(self, item):
+        # one item per line, so never indented
+        line = (self.dumps(item, separators=(",", ":")) + "\n").encode('utf-8')
+        if self._stream is None:
+            return line
+        return self._stream.push(line)
+
+    def finish(self):
+        out = self.push({'copyright': COPYRIGHT_STRING})
+        if self._stream is not None:
+            out += self._stream.finish()
+        return out
+
+    def response(self, body):
+        response = self.app.response_class(body,
+                mimetype="application/x-ndjson")
+        return add_encoding_headers(response, self.compressor, self.coding)
+
+def post_process_ndjson(items):
+    encoder = NDJSONEncoder(current_app, request)
+
+    def generate():
+        for item in items:
+            out = encoder.push(item)
+            if out:
+                yield out
+        yield encoder.finish()
+
+    return encoder.response(stream_with_context(generate()))
+
+def add_encoding_headers(response, compressor, coding):
+    if compressor is not None:
+        response.vary.add('Accept-Encoding')
+    if coding is not None:
+        response.content_encoding = coding.name
+        etag, _ = response.get_etag()
+        if etag is not None:
+            response.set_etag(coded_etag(etag, coding.name))
+    return response
+
+# The HTTP validators for a response -- a strong ETag and the time at which
+# it last changed, either of which may be None -- and how long (in seconds)
+# clients and shared caches may reuse it without revalidating, or None if
+# they must always revalidate.
+class Validator(object):
+    __slots__ = ('etag', 'last_modified', 'max_age')
+
+    def __init__(self, etag, last_modified=None, max_age=None):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.max_age = max_age
+
+    # a validator for a different representation of the same data
+    def derive(self, name):
+        etag = None
+        if self.etag is not None:
+            etag = make_etag(name, self.etag)
+        return Validator(etag, self.last_modified, self.max_age)
+
+def make_etag(*parts):
+    digest = hashlib.sha1()
+    for p in parts:
+        if isinstance(p, str):
+            p = p.encode('utf-8')
+        digest.update(p)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+# a Last-Modified time from a unix timestamp, which HTTP dates can only
+# represent to the second
+def http_time(epoch):
+    if epoch is None:
+        return None
+    return datetime.fromtimestamp(int(epoch), timezone.utc)
+
+def is_conditional(req):
+    return bool(req.if_none_match) or req.if_modified_since is not None
+
+# whether the client's copy (as described by the conditional headers of
+# `req`) is still current -- If-None-Match takes precedence over
+# If-Modified-Since, as in RFC 9110
+def is_not_modified(req, validator):
+    if validator is None:
+        return False
+
+    if req.if_none_match:
+        if validator.etag is None:
+            return False
+        # the client may have any of our representations
+        return req.if_none_match.contains_weak(validator.etag) or \
+                any(req.if_none_match.contains_weak(coded_etag(
+                validator.etag, c)) for c in CONTENT_CODINGS)
+
+    if req.if_modified_since is not None and \
+            validator.last_modified is not None:
+        return validator.last_modified <= req.if_modified_since
+
+    return False
+
+def add_validator_headers(response, validator):
+    if validator is None:
+        return response
+
+    if validator.etag is not None:
+        response.set_etag(validator.etag)
+    if validator.last_modified is not None:
+        response.last_modified = validator.last_modified
 
-def validate_edges(as_list):
+    if validator.max_age is None:
+        response.cache_control.no_cache = True
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = validator.max_age
+    return response
+
+# a 304 for a client whose copy is still current, with the ETag of the
+# representation we would have sent
+def not_modified(app, req, validator):
+    response = add_validator_headers(app.response_class(status=304),
+            validator)
+    # there is no body to describe (werkzeug drops this by itself, Quart
+    # doesn't)
+    del response.headers['Content-Type']
+
+    compressor = app.extensions.get('grip_compression')
+    if compressor is not None:
+        response.vary.add('Accept-Encoding')
+        coding = compressor.choose(req.accept_encodings)
+        if coding is not None and validator.etag is not None:
+            response.set_etag(coded_etag(validator.etag, coding.name))
+    return response
+
+def not_modified_response(validator):
+    return not_modified(current_app, request, validator)
+
+# json_response() for `data` with the headers for `validator` -- or, if the
+# client's copy is still current, a 304 without encoding anything
+def conditional_response(app, req, data, validator):
+    if is_not_modified(req, validator):
+        return not_modified(app, req, validator)
+    return json_response(app, req, data, validator)
+
+def post_process_conditional(data, validator):
+    return conditional_response(current_app, request, data, validator)
+
+# the event IDs requested from a batch endpoint, either as a comma-separated
+# `ids` query parameter or as a JSON body that is either a list of IDs or an
+# object with an `ids` list (`body` is None for GET requests) -- duplicates
+# are dropped
+def get_event_id_list(args, body, max_ids):
+    if body is not None:
+        if isinstance(body, dict):
+            body = body.get('ids')
+        if not isinstance(body, list) or \
+                not all(isinstance(i, str) for i in body):
+            err_str = "Request body must be a JSON list of event IDs, or an object with an 'ids' list"
+            raise ValidationError(err_str)
+        ids = body
+    else:
+        idstring = args.get('ids', '', type=str)
+        ids = [i for i in idstring.split(',') if i != '']
+
+    ids = list(dict.fromkeys(ids))
+    if len(ids) == 0:
+        raise ValidationError("No event IDs were given")
+    if len(ids) > max_ids:
+        raise ValidationError(f"Too many event IDs, at most {max_ids} may be requested at once")
+    return ids
+
+# one line of a batch response
+def batch_result(evid, event, err):
+    if err is not None:
+        return {'id': evid, 'status': err[0], 'error': err[1]}
+    return {'id': evid, 'status': 200, 'event': event}
+
+# split a pfx_event fingerprint from a URL, i.e. "<prefix>" or
+# "<sub_pfx>_<super_pfx>" with each "/" replaced by "-", into its prefixes
+# -- in canonical form, so that every way of finding the pfx_event (the
+# event cache, the lookup script and a scan) agrees on which one it is
+def parse_pfx_fingerprint(fingerprint):
+    replaced = fingerprint.replace("-", "/")
+    return [canonical_prefix(p) for p in replaced.split("_")]
+
+# the spelling of `prefix` that events use, e.g. "2001:db8::/32" for
+# "2001:DB8::/32" or "2001:0db8::/32" -- invalid prefixes are left as they
+# are, for validate_pfx_fingerprint() to reject
+@lru_cache(maxsize=4096)
+def canonical_prefix(prefix):
     try:
-        as_list_arr = as_list.split('_')
-        assert len(as_list_arr) == 2
-        assert is_valid_asn(as_list_arr[0]) and is_valid_asn(as_list_arr[1])
-        assert as_list_arr[0] != as_list_arr[1]
-    
-    except ValidationError as v:
-        raise v
-    
-    except Exception as e:
-        err_str = "Invalid edges event ID. The right format for a edges event is edges-<unix_timestamp>-<asn1_asn2>, with each asn being a valid AS number"
-        raise ValidationError(err_str)
+        return str(ip_network(prefix))
+    except ValueError:
+        return prefix
 
-event_validation_strategy = {
-    'moas': validate_moas,
-    'submoas': validate_submoas,
-    'defcon': validate_defcon,
-    'edges': validate_edges
-}
+# raises a ValueError if `prefix` is not a valid IP prefix -- the same
+# prefixes are looked up over and over, so remember the ones that are valid
+# rather than parsing them every time
+def check_prefix(prefix):
+    if not _is_valid_prefix(prefix):
+        ip_network(prefix)
 
-def validate_event_id(id):
+@lru_cache(maxsize=4096)
+def _is_valid_prefix(prefix):
     try:
-        id_split = id.split('-')
-        
-        if len(id_split) != 3:
-            # assuming every event is of the type
-            # <eventtype-timestamp-aslist_details>
-            err_str = "Invalid event ID"
+        ip_network(prefix)
+    except ValueError:
+        return False
+    return True
+
+# check that the prefixes from a pfx_event fingerprint are valid for the
+# type of event they were looked up in, raises a ValueError if any of the
+# prefixes are invalid and a ValidationError if there are the wrong number
+def validate_pfx_fingerprint(event_type, search):
+    for prefix_addr in search:
+        # Validating IP addresses, this line will throw a ValueError
+        # If IP prefix validation fails
+        check_prefix(prefix_addr)
+
+    if event_type in ['moas', 'edges']:
+        if len(search) != 1:
+            err_str = f"{event_type} must only have one prefix in the fingerprint for a pfx_event!"
+            raise ValidationError(err_str)
+
+    elif event_type in ['defcon', 'submoas']:
+
+        if len(search) != 2:
+            err_str = f"{event_type} must have two prefixes (sub-pfx and super-pfx) in the fingerprint for a pfx_event!"
             raise ValidationError(err_str)
-        
-        event_type, timestamp, as_details = id_split
 
-        if not is_valid_past_timestamp(timestamp):
-            err_str = "Invalid timestamp. Timestamp must be of UNIX timestamp format from the past."
+MAX_ASN = 4294967295
+
+# the grammar of a valid ID for each type of event, with groups for the
+# timestamp and each underscore-separated list of ASNs
+_AS_LIST = r"([0-9]+(?:_[0-9]+)*)"
+EVENT_ID_RE = {
+    'moas': re.compile(r"moas-([0-9]+)-" + _AS_LIST),
+    'submoas': re.compile(r"submoas-([0-9]+)-" + _AS_LIST + "=" + _AS_LIST),
+    'defcon': re.compile(r"defcon-([0-9]+)-" + _AS_LIST),
+    'edges': re.compile(r"edges-([0-9]+)-([0-9]+_[0-9]+)"),
+}
+
+AS_LIST_ERRORS = {
+    'moas': "Invalid MOAS event. The right format for a MOAS event is moas-<unix_timestamp>-<asn1_asn2_...>, with each asn being a valid AS number",
+    'submoas': "Invalid SUBMOAS event. The right format for a SUBMOAS event is submoas-<unix_timestamp>-<victim-asn1_victim-asn2_...>=<attacker-asn1_attacker-asn2...>, with each asn being a valid AS number",
+    'defcon': "Invalid DEFCON event ID. The right format for a DEFCON event is defcon-<unix_timestamp>-<victim-asn1_victim-asn2_...>, with each asn being a valid AS number",
+    'edges': "Invalid edges event ID. The right format for a edges event is edges-<unix_timestamp>-<asn1_asn2>, with each asn being a valid AS number",
+}
+
+# A validated event ID, split into its parts: `as_lists` has one tuple of
+# ASNs for each list in the ID, i.e. the victims and then the attackers for
+# submoas events and a single list for everything else.
+class EventId(object):
+    __slots__ = ('id', 'event_type', 'timestamp', 'as_lists')
+
+    def __init__(self, id, event_type, timestamp, as_lists):
+        self.id = id
+        self.event_type = event_type
+        self.timestamp = timestamp
+        self.as_lists = as_lists
+
+    def __str__(self):
+        return self.id
+
+    # the month of the index that the event is stored in
+    @property
+    def month(self):
+        t = time.localtime(self.timestamp)
+        return "{:04d}-{:02d}".format(t.tm_year, t.tm_mon)
+
+def _parse_as_list(as_list, event_type):
+    asns = []
+    seen = set()
+    for asn in as_list.split('_'):
+        value = int(asn)
+        if value < 1 or value > MAX_ASN:
+            err_str = "One or more ASNs listed in the event ID are not valid ASNs"
             raise ValidationError(err_str)
+        if asn in seen:
+            raise ValidationError(AS_LIST_ERRORS[event_type])
+        seen.add(asn)
+        asns.append(value)
+    return tuple(asns)
 
-        event_validation_strategy[event_type](as_details)
+# Parse an event ID of the form <eventtype>-<timestamp>-<aslist>, raising a
+# ValidationError that describes what is wrong with it if it is not valid.
+def parse_event_id(id):
+    event_type = id[:id.find('-')]
+    id_re = EVENT_ID_RE.get(event_type)
+    match = id_re.fullmatch(id) if id_re is not None else None
+    if match is None:
+        _event_id_error(id)
 
-    except KeyError:
+    timestamp = int(match.group(1))
+    if not 0 < timestamp < time.time():
+        err_str = "Invalid timestamp. Timestamp must be of UNIX timestamp format from the past."
+        raise ValidationError(err_str)
+
+    if event_type == 'submoas':
+        as_lists = (_parse_as_list(match.group(2), event_type),
+                _parse_as_list(match.group(3), event_type))
+    else:
+        as_lists = (_parse_as_list(match.group(2), event_type),)
+    return EventId(id, event_type, timestamp, as_lists)
+
+# raises the ValidationError for an ID that doesn't match EVENT_ID_RE
+def _event_id_error(id):
+    id_split = id.split('-')
+    if len(id_split) != 3:
+        err_str = "Invalid event ID"
+        raise ValidationError(err_str)
+
+    event_type, timestamp, as_details = id_split
+
+    if not (timestamp.isascii() and timestamp.isdigit()) or \
+            not 0 < int(timestamp) < time.time():
+        err_str = "Invalid timestamp. Timestamp must be of UNIX timestamp format from the past."
+        raise ValidationError(err_str)
+
+    if event_type not in EVENT_ID_RE:
         err_str = "Unknown event type. Event type must be one of [ moas, submoas, defcon, edges ]"
         raise ValidationError(err_str)
-    
-    except Exception as e:
-        raise e
\ No newline at end of file
+
+    raise ValidationError(AS_LIST_ERRORS[event_type])
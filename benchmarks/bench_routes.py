@@ -0,0 +1,345 @@
+# This source code is Copyright (c) 2023 Georgia Tech Research Corporation. All
+# Rights Reserved. Permission to copy, modify, and distribute this software and
+# its documentation for academic research and education purposes, without fee,
+# and without a written agreement is hereby granted, provided that the above
+# copyright notice, this paragraph and the following three paragraphs appear in
+# all copies. Permission to make use of this software for other than academic
+# research and education purposes may be obtained by contacting:
+#
+#  Office of Technology Licensing
+#  Georgia Institute of Technology
+#  926 Dalney Street, NW
+#  Atlanta, GA 30318
+#  404.385.8066
+#  techlicensing@gtrc.gatech.edu
+#
+# This software program and documentation are copyrighted by Georgia Tech
+# Research Corporation (GTRC). The software program and documentation are 
+# supplied "as is", without any accompanying services from GTRC. GTRC does
+# not warrant that the operation of the program will be uninterrupted or
+# error-free. The end-user understands that the program was developed for
+# research purposes and is advised not to rely exclusively on the program for
+# any reason.
+#
+# IN NO EVENT SHALL GEORGIA TECH RESEARCH CORPORATION BE LIABLE TO ANY PARTY FOR
+# DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING
+# LOST PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION,
+# EVEN IF GEORGIA TECH RESEARCH CORPORATION HAS BEEN ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE. GEORGIA TECH RESEARCH CORPORATION SPECIFICALLY DISCLAIMS ANY
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED
+# HEREUNDER IS ON AN "AS IS" BASIS, AND  GEORGIA TECH RESEARCH CORPORATION HAS
+# NO OBLIGATIONS TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR
+# MODIFICATIONS.
+#
+# This source code is part of the GRIP software. The original GRIP software is
+# Copyright (c) 2015 The Regents of the University of California. All rights
+# reserved. Permission to copy, modify, and distribute this software for
+# academic research and education purposes is subject to the conditions and
+# copyright notices in the source code files and in the included LICENSE file.
+
+# Measure every /json route end to end, in-process, against the stand-in
+# elasticsearch and meta services in benchmarks/fake_services.py.
+#
+# Usage (from the repository root):
+#
+#     python -m benchmarks.bench_routes [--quick] [--no-cache-only]
+#             [--compare-asgi] [NAME...]
+#
+# Each scenario is run with the app's caches enabled (as configured by
+# default) and with all of them disabled, and reports requests per second,
+# median and 99th percentile latency, and the peak memory allocated while
+# serving one request (measured in a separate pass, since tracing
+# allocations slows everything down). NAMEs restrict the run to scenarios
+# whose names contain any of them.
+#
+# With --compare-asgi, nothing is timed: each scenario is requested twice
+# (so that the second request can be served from the caches) from both the
+# Flask app and the ASGI app in app/asgi.py, and any differences in status,
+# body or headers are reported.
+#
+# The stand-ins answer from memory, so the numbers measure the app's own
+# work -- building queries, decoding responses, formatting and encoding --
+# rather than network or elasticsearch time.
+
+import argparse, asyncio, gzip, os, sys, time, tracemalloc
+
+os.environ.setdefault('GRIP_API_NO_APP', '1')
+
+from app import create_app
+from app.elastic import enhance_pfxevents_for_event
+from app.utils import make_etag
+from benchmarks.events import make_event, make_events
+from benchmarks.fake_services import EventStore, FakeMetaAdapter, \
+        async_transport_class, transport_class
+
+# view_ts of the first event in the corpus, and the gap between events
+CORPUS_START = 1672531200
+CORPUS_STEP = 6 * 3600
+
+def make_corpus(count):
+    events = make_events(count, n_pfx=10, seed=1)
+    for i, event in enumerate(events):
+        # spread the events over several monthly indices
+        view_ts = CORPUS_START + i * CORPUS_STEP
+        events[i] = make_event(event['event_type'],
+                n_pfx=len(event['pfx_events']), seed=i, view_ts=view_ts)
+
+    huge = [make_event("moas", n_pfx=12000, seed=count, view_ts=CORPUS_START + 7),
+            make_event("defcon", n_pfx=12000, seed=count + 1,
+                    view_ts=CORPUS_START + 11),
+            # stored as it would be once ES_EVENTS_ENRICHED can be set
+            enhance_pfxevents_for_event(make_event("moas", n_pfx=12000,
+                    seed=count + 2, view_ts=CORPUS_START + 13))]
+    return events, huge
+
+def pfx_fingerprint(event, pfxevent):
+    details = pfxevent['details']
+    if event['event_type'] in ['moas', 'edges']:
+        prefixes = [details['prefix']]
+    else:
+        prefixes = [details['sub_pfx'], details['super_pfx']]
+    return "_".join(p.replace("/", "-") for p in prefixes)
+
+def scenarios(events, huge):
+    small = events[len(events) // 2]
+    big = huge[0]
+    last_pfx = big['pfx_events'][-1]
+    ids = [e['id'] for e in events[:200]]
+
+    month = "ts_start={}&ts_end={}".format(CORPUS_START + 31 * 86400,
+            CORPUS_START + 59 * 86400)
+    return [
+        ("tags", "GET", "/json/tags", None),
+        ("asndrop", "GET", "/json/asndrop", None),
+        ("blacklist", "GET", "/json/blacklist", None),
+        ("blocklist", "GET", "/json/blocklist", None),
+        ("event/id small", "GET", "/json/event/id/" + small['id'], None),
+        ("event/id huge", "GET", "/json/event/id/" + big['id'], None),
+        ("event/id huge gzip", "GET", "/json/event/id/" + big['id'],
+                {'Accept-Encoding': "gzip"}),
+        ("event/id huge 304", "GET", "/json/event/id/" + big['id'],
+                {'If-None-Match': '"{}"'.format(make_etag(big['id'],
+                big['last_modified_ts']))}),
+        ("event/ids 200", "POST", "/json/event/ids", {'ids': ids}),
+        ("events default", "GET", "/json/events?length=100", None),
+        ("events full", "GET", "/json/events?length=100&full", None),
+        ("events full gzip", "GET", "/json/events?length=100&full",
+                {'Accept-Encoding': "gzip"}),
+        ("events filtered", "GET", "/json/events?length=100&event_type=moas&"
+                + month, None),
+        ("events ndjson", "GET", "/json/events?format=ndjson&" + month,
+                None),
+        ("events modified", "GET", "/json/events?modified_since={}".format(
+                CORPUS_START + len(events) * CORPUS_STEP), None),
+        ("events/stats", "GET", "/json/events/stats?" + month, None),
+        ("pfx_event small", "GET", "/json/pfx_event/id/{}/{}".format(
+                small['id'], pfx_fingerprint(small, small['pfx_events'][0])),
+                None),
+        ("pfx_event huge", "GET", "/json/pfx_event/id/{}/{}".format(
+                big['id'], pfx_fingerprint(big, last_pfx)), None),
+        ("cache_stats", "GET", "/json/cache_stats", None),
+    ]
+
+# scenarios for an app with ES_EVENTS_ENRICHED set, which serves events as
+# they are stored rather than decoding them
+def enriched_scenarios(huge):
+    return [
+        ("event/id enriched", "GET", "/json/event/id/" + huge[2]['id'], None),
+    ]
+
+def make_config(store, cached, transport=transport_class, enriched=False):
+    config = {
+        'ES_NODES': ["http://fake-es:9200"],
+        'ES_TRANSPORT_CLASS': transport(store),
+        'ES_EVENTS_ENRICHED': enriched,
+        'ES_HEALTH_CHECK_INTERVAL': 0,
+        'META_SERVICE': "http://meta",
+        'META_ADAPTER': FakeMetaAdapter(),
+    }
+    if not cached:
+        config.update({
+            'EVENT_CACHE_MAX_BYTES': 0,
+            'QUERY_CACHE_MAX_BYTES': 0,
+            'VALIDATOR_CACHE_MAX_BYTES': 0,
+            'COMPRESSION_CACHE_MAX_BYTES': 0,
+            'INDEX_CACHE_TTL': 0,
+            'META_CACHE_TTL': 0,
+            'META_CACHE_STALE_TTL': 0,
+        })
+    return config
+
+def make_client(store, cached, enriched=False):
+    return create_app(make_config(store, cached,
+            enriched=enriched)).test_client()
+
+# `body` is the JSON body of a POST, or the headers of a GET
+def call(client, method, url, body):
+    if method == "POST":
+        response = client.post(url, json=body)
+    else:
+        response = client.get(url, headers=body)
+    # read streamed bodies to the end, as a real client would
+    response.get_data()
+    if response.status_code not in (200, 304):
+        raise RuntimeError("{} {} returned {}: {}".format(method, url,
+                response.status_code, response.get_data(as_text=True)[:200]))
+    return response
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+def bench(client, method, url, body, min_time):
+    # warm up caches and lazily built state
+    call(client, method, url, body)
+
+    times = []
+    started = time.perf_counter()
+    while len(times) < 5 or time.perf_counter() - started < min_time:
+        t0 = time.perf_counter()
+        call(client, method, url, body)
+        times.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    call(client, method, url, body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return len(times) / elapsed, percentile(times, 0.5), \
+            percentile(times, 0.99), peak
+
+# requests that fail, only used to compare the two apps
+def error_scenarios(events):
+    moas = next(e for e in events if e['event_type'] == "moas")
+    return [
+        ("unknown route", "GET", "/json/nothing", None),
+        ("event/id missing", "GET", "/json/event/id/moas-{}-1_2".format(
+                CORPUS_START), None),
+        ("event/id invalid", "GET", "/json/event/id/nonsense", None),
+        ("event/ids invalid", "POST", "/json/event/ids", {'ids': 7}),
+        ("events invalid", "GET", "/json/events?modified_since=x", None),
+        ("events/stats invalid", "GET", "/json/events/stats?modified_since=x",
+                None),
+        ("events bad date", "GET", "/json/events?ts_start=2023-13-45 99:99:99",
+                None),
+        ("pfx_event invalid", "GET", "/json/pfx_event/id/{}/300.1.2.0-24"
+                .format(moas['id']), None),
+        ("pfx_event no match", "GET", "/json/pfx_event/id/{}/10.99.0.0-16"
+                .format(moas['id']), None),
+    ]
+
+# the headers that the two apps must agree on
+COMPARED_HEADERS = ['Content-Type', 'Content-Encoding', 'ETag',
+        'Cache-Control', 'Vary']
+
+def summarize(status, headers, data):
+    if headers.get('Content-Encoding') == "gzip":
+        data = gzip.decompress(data)
+    compared = {h: headers.get(h) for h in COMPARED_HEADERS}
+    if status == 304:
+        # Quart's test client gives the 304 it received the default
+        # Content-Type when it rebuilds it as a Response
+        compared['Content-Type'] = None
+    return status, compared, data
+
+async def call_asgi(client, method, url, body):
+    if method == "POST":
+        response = await client.post(url, json=body)
+    else:
+        response = await client.get(url, headers=body)
+    return summarize(response.status_code, response.headers,
+            await response.get_data())
+
+def call_flask(client, method, url, body):
+    if method == "POST":
+        response = client.post(url, json=body)
+    else:
+        response = client.get(url, headers=body)
+    return summarize(response.status_code, response.headers,
+            response.get_data())
+
+def differences(expected, got):
+    out = []
+    if expected[0] != got[0]:
+        out.append("status {} != {}".format(expected[0], got[0]))
+    for h in COMPARED_HEADERS:
+        if expected[1][h] != got[1][h]:
+            out.append("{} {!r} != {!r}".format(h, expected[1][h], got[1][h]))
+    if expected[2] != got[2]:
+        out.append("bodies differ: {!r}... != {!r}...".format(
+                expected[2][:80], got[2][:80]))
+    return out
+
+# request every scenario from both apps and report where they differ,
+# returns the number of differences
+async def compare_asgi(store, selected, modes, enriched=False):
+    from app.asgi import create_asgi_app
+
+    failures = 0
+    for cached in modes:
+        flask_client = make_client(store, cached, enriched)
+        app = create_asgi_app(make_config(store, cached,
+                async_transport_class, enriched))
+        async with app.test_app():
+            asgi_client = app.test_client()
+            for name, method, url, body in selected:
+                for attempt in ("first", "repeat"):
+                    diffs = differences(
+                            call_flask(flask_client, method, url, body),
+                            await call_asgi(asgi_client, method, url, body))
+                    for d in diffs:
+                        print("{} (cache {}, {}): {}".format(name,
+                                "on" if cached else "off", attempt, d))
+                    failures += len(diffs)
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the /json routes")
+    parser.add_argument("--quick", action="store_true",
+            help="smaller corpus and shorter runs")
+    parser.add_argument("--no-cache-only", action="store_true",
+            help="only run with the caches disabled")
+    parser.add_argument("--compare-asgi", action="store_true",
+            help="check that the ASGI app's responses match the Flask app's")
+    parser.add_argument("names", nargs="*",
+            help="only run scenarios whose names contain one of these")
+    args = parser.parse_args()
+
+    count, min_time = (300, 0.2) if args.quick else (2000, 1.0)
+    events, huge = make_corpus(count)
+    store = EventStore(events + huge)
+
+    modes = [False] if args.no_cache_only else [True, False]
+    def select(candidates):
+        return [s for s in candidates if not args.names
+                or any(n in s[0] for n in args.names)]
+    selected = select(scenarios(events, huge))
+    enriched = select(enriched_scenarios(huge))
+
+    if args.compare_asgi:
+        selected += select(error_scenarios(events))
+        # the enriched scenarios get apps of their own, so that the first
+        # request either app makes to elasticsearch is for a raw event
+        failures = asyncio.run(compare_asgi(store, selected, modes)) \
+                + asyncio.run(compare_asgi(store, enriched, modes, True))
+        print("{} scenarios, {} differences".format(
+                len(selected) + len(enriched), failures))
+        sys.exit(1 if failures else 0)
+
+    print("{:<18} {:>6} {:>10} {:>10} {:>10} {:>10}".format("scenario",
+            "cache", "req/s", "p50 ms", "p99 ms", "peak KiB"))
+    runs = [s + (False,) for s in selected] + [s + (True,) for s in enriched]
+    for name, method, url, body, events_enriched in runs:
+        for cached in modes:
+            # a fresh app for each run, so that runs don't share caches
+            client = make_client(store, cached, events_enriched)
+            rate, p50, p99, peak = bench(client, method, url, body, min_time)
+            print("{:<18} {:>6} {:>10.0f} {:>10.2f} {:>10.2f} {:>10.0f}".format(
+                    name, "on" if cached else "off", rate, p50 * 1000,
+                    p99 * 1000, peak / 1024))
+            sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
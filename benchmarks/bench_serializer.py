@@ -0,0 +1,115 @@
+# This source code is Copyright (c) 2023 Georgia Tech Research Corporation. All
+# Rights Reserved. Permission to copy, modify, and distribute this software and
+# its documentation for academic research and education purposes, without fee,
+# and without a written agreement is hereby granted, provided that the above
+# copyright notice, this paragraph and the following three paragraphs appear in
+# all copies. Permission to make use of this software for other than academic
+# research and education purposes may be obtained by contacting:
+#
+#  Office of Technology Licensing
+#  Georgia Institute of Technology
+#  926 Dalney Street, NW
+#  Atlanta, GA 30318
+#  404.385.8066
+#  techlicensing@gtrc.gatech.edu
+#
+# This software program and documentation are copyrighted by Georgia Tech
+# Research Corporation (GTRC). The software program and documentation are 
+# supplied "as is", without any accompanying services from GTRC. GTRC does
+# not warrant that the operation of the program will be uninterrupted or
+# error-free. The end-user understands that the program was developed for
+# research purposes and is advised not to rely exclusively on the program for
+# any reason.
+#
+# IN NO EVENT SHALL GEORGIA TECH RESEARCH CORPORATION BE LIABLE TO ANY PARTY FOR
+# DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING
+# LOST PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION,
+# EVEN IF GEORGIA TECH RESEARCH CORPORATION HAS BEEN ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE. GEORGIA TECH RESEARCH CORPORATION SPECIFICALLY DISCLAIMS ANY
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED
+# HEREUNDER IS ON AN "AS IS" BASIS, AND  GEORGIA TECH RESEARCH CORPORATION HAS
+# NO OBLIGATIONS TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR
+# MODIFICATIONS.
+#
+# This source code is part of the GRIP software. The original GRIP software is
+# Copyright (c) 2015 The Regents of the University of California. All rights
+# reserved. Permission to copy, modify, and distribute this software for
+# academic research and education purposes is subject to the conditions and
+# copyright notices in the source code files and in the included LICENSE file.
+
+# Compare the JSON backends in app/serializer.py on GRIP-like documents.
+#
+# Usage (from the repository root):
+#
+#     python -m benchmarks.bench_serializer
+#
+# For each payload this reports the time taken to encode it the way
+# post_process() does (via the Flask JSON provider) and to decode it the way
+# the elasticsearch client does, for every backend that is installed.
+
+import os, sys, timeit
+
+os.environ.setdefault('GRIP_API_NO_APP', '1')
+
+from flask import Flask
+
+from app.serializer import GripJSONProvider, GripESSerializer, \
+        JSONBackend, OrjsonBackend, UjsonBackend, orjson, ujson
+from benchmarks.events import make_event, make_events
+
+def available_backends():
+    backends = [JSONBackend()]
+    if orjson is not None:
+        backends.append(OrjsonBackend())
+    if ujson is not None:
+        backends.append(UjsonBackend())
+    return backends
+
+def payloads():
+    return [
+        ("events page (100 brief-ish)", {"data": make_events(100, n_pfx=3)}),
+        ("events page (100 full)", {"data": make_events(100, n_pfx=20)}),
+        ("event, 1k pfx_events", make_event("defcon", n_pfx=1000, seed=1)),
+        ("event, 20k pfx_events", make_event("moas", n_pfx=20000, seed=2)),
+    ]
+
+def bench(fn, min_time=0.5):
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    return min(timer.repeat(repeat=3, number=number)) / number
+
+def main():
+    app = Flask(__name__)
+    backends = available_backends()
+
+    print("{:<30} {:>8} {:>10} {:>12} {:>12}".format("payload", "backend",
+            "size (KB)", "encode (ms)", "decode (ms)"))
+
+    for name, payload in payloads():
+        baseline = None
+        for backend in backends:
+            provider = GripJSONProvider(app, backend)
+            serializer = GripESSerializer(backend)
+            encoded = provider.dumps(payload, separators=(",", ":"))
+
+            with app.app_context():
+                enc = bench(lambda: provider.response(payload))
+            dec = bench(lambda: serializer.loads(encoded))
+
+            if baseline is None:
+                baseline = (enc, dec)
+                speedup = ""
+            else:
+                speedup = "  ({:.1f}x / {:.1f}x)".format(baseline[0] / enc,
+                        baseline[1] / dec)
+
+            print("{:<30} {:>8} {:>10.0f} {:>12.2f} {:>12.2f}{}".format(name,
+                    backend.name, len(encoded) / 1024, enc * 1000,
+                    dec * 1000, speedup))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
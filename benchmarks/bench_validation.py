@@ -0,0 +1,120 @@
+# This source code is Copyright (c) 2023 Georgia Tech Research Corporation. All
+# Rights Reserved. Permission to copy, modify, and distribute this software and
+# its documentation for academic research and education purposes, without fee,
+# and without a written agreement is hereby granted, provided that the above
+# copyright notice, this paragraph and the following three paragraphs appear in
+# all copies. Permission to make use of this software for other than academic
+# research and education purposes may be obtained by contacting:
+#
+#  Office of Technology Licensing
+#  Georgia Institute of Technology
+#  926 Dalney Street, NW
+#  Atlanta, GA 30318
+#  404.385.8066
+#  techlicensing@gtrc.gatech.edu
+#
+# This software program and documentation are copyrighted by Georgia Tech
+# Research Corporation (GTRC). The software program and documentation are 
+# supplied "as is", without any accompanying services from GTRC. GTRC does
+# not warrant that the operation of the program will be uninterrupted or
+# error-free. The end-user understands that the program was developed for
+# research purposes and is advised not to rely exclusively on the program for
+# any reason.
+#
+# IN NO EVENT SHALL GEORGIA TECH RESEARCH CORPORATION BE LIABLE TO ANY PARTY FOR
+# DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING
+# LOST PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION,
+# EVEN IF GEORGIA TECH RESEARCH CORPORATION HAS BEEN ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE. GEORGIA TECH RESEARCH CORPORATION SPECIFICALLY DISCLAIMS ANY
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED
+# HEREUNDER IS ON AN "AS IS" BASIS, AND  GEORGIA TECH RESEARCH CORPORATION HAS
+# NO OBLIGATIONS TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR
+# MODIFICATIONS.
+#
+# This source code is part of the GRIP software. The original GRIP software is
+# Copyright (c) 2015 The Regents of the University of California. All rights
+# reserved. Permission to copy, modify, and distribute this software for
+# academic research and education purposes is subject to the conditions and
+# copyright notices in the source code files and in the included LICENSE file.
+
+
+# Measure the per-request cost of checking the event IDs and prefixes in
+# request URLs.
+# Usage (from the repository root):
+#     python -m benchmarks.bench_validation
+# Reports the time taken to parse valid and invalid IDs of each event type,
+# to work out the index of an event from its parsed ID and from the raw
+# string, to validate pfx_event fingerprints, and for all of the above
+# together as done for each /json/pfx_event/id/ request.
+
+import os, sys, timeit
+
+os.environ.setdefault('GRIP_API_NO_APP', '1')
+
+from ipaddress import ip_network
+
+from app.GripException import ValidationError
+from app.elastic import event_index_name
+from app.utils import check_prefix, parse_event_id
+
+EVENT_IDS = [
+    ("moas", "moas-1672617600-13335_209242"),
+    ("submoas", "submoas-1672617600-3356_1299=64512_65000"),
+    ("defcon", "defcon-1672617600-15169"),
+    ("edges", "edges-1672617600-174_3356"),
+    ("moas, 20 ASNs", "moas-1672617600-" + "_".join(str(a) for a in
+            range(1000, 1020))),
+    ("invalid ASN", "moas-1672617600-13335_0"),
+    ("invalid type", "foo-1672617600-13335"),
+]
+
+PREFIXES = ["192.0.2.0/24", "2001:db8::/32"]
+
+def bench(fn, min_time=0.5):
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    return min(timer.repeat(repeat=3, number=number)) / number
+
+def parse(evid):
+    try:
+        return parse_event_id(evid)
+    except ValidationError:
+        return None
+
+def main():
+    print("{:<40} {:>12}".format("operation", "time (us)"))
+
+    for name, evid in EVENT_IDS:
+        t = bench(lambda: parse(evid))
+        print("{:<40} {:>12.2f}".format("parse_event_id: " + name, t * 1e6))
+
+    evid = EVENT_IDS[0][1]
+    eventid = parse_event_id(evid)
+    t = bench(lambda: event_index_name(eventid))
+    print("{:<40} {:>12.2f}".format("event_index_name: parsed ID", t * 1e6))
+    t = bench(lambda: event_index_name(evid))
+    print("{:<40} {:>12.2f}".format("event_index_name: string", t * 1e6))
+
+    # everything that /json/pfx_event/id/ does before going to the cache or
+    # elasticsearch
+    fingerprint = ["192.0.2.0/24"]
+    def pfx_request():
+        eventid = parse_event_id(evid)
+        event_index_name(eventid)
+        for prefix in fingerprint:
+            check_prefix(prefix)
+    t = bench(pfx_request)
+    print("{:<40} {:>12.2f}".format("pfx_event request: total", t * 1e6))
+
+    for prefix in PREFIXES:
+        t = bench(lambda: check_prefix(prefix))
+        print("{:<40} {:>12.2f}".format("check_prefix: " + prefix, t * 1e6))
+        t = bench(lambda: ip_network(prefix))
+        print("{:<40} {:>12.2f}".format("ip_network: " + prefix, t * 1e6))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,209 @@
+# This source code is Copyright (c) 2023 Georgia Tech Research Corporation. All
+# Rights Reserved. Permission to copy, modify, and distribute this software and
+# its documentation for academic research and education purposes, without fee,
+# and without a written agreement is hereby granted, provided that the above
+# copyright notice, this paragraph and the following three paragraphs appear in
+# all copies. Permission to make use of this software for other than academic
+# research and education purposes may be obtained by contacting:
+#
+#  Office of Technology Licensing
+#  Georgia Institute of Technology
+#  926 Dalney Street, NW
+#  Atlanta, GA 30318
+#  404.385.8066
+#  techlicensing@gtrc.gatech.edu
+#
+# This software program and documentation are copyrighted by Georgia Tech
+# Research Corporation (GTRC). The software program and documentation are 
+# supplied "as is", without any accompanying services from GTRC. GTRC does
+# not warrant that the operation of the program will be uninterrupted or
+# error-free. The end-user understands that the program was developed for
+# research purposes and is advised not to rely exclusively on the program for
+# any reason.
+#
+# IN NO EVENT SHALL GEORGIA TECH RESEARCH CORPORATION BE LIABLE TO ANY PARTY FOR
+# DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING
+# LOST PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION,
+# EVEN IF GEORGIA TECH RESEARCH CORPORATION HAS BEEN ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE. GEORGIA TECH RESEARCH CORPORATION SPECIFICALLY DISCLAIMS ANY
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED
+# HEREUNDER IS ON AN "AS IS" BASIS, AND  GEORGIA TECH RESEARCH CORPORATION HAS
+# NO OBLIGATIONS TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR
+# MODIFICATIONS.
+#
+# This source code is part of the GRIP software. The original GRIP software is
+# Copyright (c) 2015 The Regents of the University of California. All rights
+# reserved. Permission to copy, modify, and distribute this software for
+# academic research and education purposes is subject to the conditions and
+# copyright notices in the source code files and in the included LICENSE file.
+
+# Check the two changes that buildESEventQuery() makes to keep equivalent
+# queries identical and cacheable, without needing elasticsearch:
+#   - view_ts bounds are rounded to whole minutes, which can't change which
+#     events match because view_ts is always the start of a minute -- every
+#     minute-aligned time either side of the bound is checked to be on the
+#     same side of the rounded bound as of the original one
+#   - the values of term parameters are put in a canonical order, so that
+#     reordering or repeating them gives the same query and cache key
+# It also checks that nothing is left in scoring (must or should) context
+# at the top level of the query, and that rounding is the only difference
+# between the rounded query and one built from the exact times.
+# Usage (from the repository root):
+#     python -m benchmarks.check_query_filters [iterations]
+# Failed checks are printed.
+
+import calendar, os, random, sys, time
+from unittest import mock
+
+os.environ.setdefault('GRIP_API_NO_APP', '1')
+
+from werkzeug.datastructures import MultiDict
+
+from app import elastic
+from benchmarks.events import EVENT_TYPES, INFERENCE_IDS, TAG_NAMES
+
+START = 1672531200
+
+TERM_PARAMS = ['pfxs', 'asns', 'tags', 'codes', 'labels']
+
+def epoch(ts_str):
+    return calendar.timegm(time.strptime(ts_str, "%Y-%m-%d %H:%M:%S"))
+
+def time_str(ts):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(ts))
+
+# a rounded bound has to be minute-aligned, no more than a minute away, and
+# on the same side of every minute-aligned view_ts as the exact bound
+def check_rounding(failures, ts):
+    exact = time_str(ts)
+    for up in (True, False):
+        rounded = epoch(elastic.round_view_ts(exact, up))
+        if rounded % 60 != 0 or abs(rounded - ts) >= 60:
+            failures.append("round_view_ts({!r}, up={}) gave {}".format(
+                    exact, up, time_str(rounded)))
+            continue
+
+        for view_ts in range(ts - ts % 60 - 120, ts + 180, 60):
+            if up:
+                same = (view_ts >= ts) == (view_ts >= rounded)
+            else:
+                same = (view_ts <= ts) == (view_ts <= rounded)
+            if not same:
+                failures.append("round_view_ts({!r}, up={}) gave {}, which moves {} across the bound".format(
+                        exact, up, time_str(rounded), time_str(view_ts)))
+
+# the paths to the leaves of two JSON values where they differ
+def differences(a, b, path=()):
+    if isinstance(a, dict) and isinstance(b, dict) and a.keys() == b.keys():
+        for k in a:
+            yield from differences(a[k], b[k], path + (k,))
+    elif isinstance(a, list) and isinstance(b, list) and len(a) == len(b):
+        for i, (x, y) in enumerate(zip(a, b)):
+            yield from differences(x, y, path + (i,))
+    elif a != b:
+        yield path
+
+def check_query(failures, params):
+    query = elastic.buildESEventQuery(params)['query']
+    with mock.patch.object(elastic, 'round_view_ts', lambda ts, up: ts):
+        exact = elastic.buildESEventQuery(params)['query']
+
+    scoring = set(query['bool']) - {'filter', 'must_not'}
+    if scoring:
+        failures.append("{} has top-level {} clauses".format(
+                params.to_dict(), "/".join(sorted(scoring))))
+
+    for path in differences(query, exact):
+        if path[-3:-1] != ('range', 'view_ts'):
+            failures.append("{} differs from the unrounded query at {}".format(
+                    params.to_dict(), ".".join(map(str, path))))
+
+def reordered(rng, params):
+    shuffled = MultiDict(params)
+    for name in TERM_PARAMS:
+        if name in params:
+            values = params[name].split(",")
+            values += rng.sample(values, rng.randrange(len(values) + 1))
+            rng.shuffle(values)
+            shuffled[name] = ",".join(values)
+    return shuffled
+
+def check_term_order(failures, rng, params):
+    other = reordered(rng, params)
+    if elastic.buildESEventQuery(params) != \
+            elastic.buildESEventQuery(other):
+        failures.append("{} and {} build different queries".format(
+                params.to_dict(), other.to_dict()))
+    elif elastic.EventSearch(params).cacheKey() != \
+            elastic.EventSearch(other).cacheKey():
+        failures.append("{} and {} have different cache keys".format(
+                params.to_dict(), other.to_dict()))
+
+# mostly within a few minutes of a minute boundary, where rounding mistakes
+# would show up, in each of the accepted formats
+def random_time(rng):
+    ts = START + rng.randrange(0, 3 * 86400 // 60) * 60
+    if rng.random() < 0.8:
+        ts += rng.randrange(-90, 91)
+    else:
+        ts += rng.randrange(0, 3600)
+    style = rng.randrange(3)
+    if style == 0:
+        return str(ts)
+    if style == 1:
+        return time.strftime("%Y-%m-%dT%H:%M", time.gmtime(ts))
+    return time_str(ts)
+
+def random_values(rng, choices):
+    values = rng.sample(choices, rng.randrange(1, 4))
+    return ",".join(("!" if rng.random() < 0.3 else "") + str(v)
+            for v in values)
+
+def random_params(rng):
+    params = MultiDict()
+    if rng.random() < 0.8:
+        params['ts_start'] = random_time(rng)
+    if rng.random() < 0.6:
+        params['ts_end'] = random_time(rng)
+    if rng.random() < 0.3:
+        params['overlap'] = 'true'
+    if rng.random() < 0.3:
+        params['event_type'] = rng.choice(EVENT_TYPES)
+    if rng.random() < 0.5:
+        params['min_susp'] = str(rng.randrange(0, 80))
+    if rng.random() < 0.2:
+        params['min_duration'] = str(rng.choice([0, 1800, 3600]))
+    if rng.random() < 0.4:
+        params['tags'] = random_values(rng, TAG_NAMES)
+    if rng.random() < 0.4:
+        params['codes'] = random_values(rng, INFERENCE_IDS)
+    if rng.random() < 0.4:
+        params['asns'] = random_values(rng, list(range(1, 20)))
+    if rng.random() < 0.2:
+        params['pfxs'] = random_values(rng, ["10.0.0.0/8", "192.0.2.0/24",
+                "2001:db8::/32"])
+    return params
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rng = random.Random(0)
+    failures = []
+
+    for ts in range(START - 120, START + 121):
+        check_rounding(failures, ts)
+    for _ in range(iterations):
+        check_rounding(failures, START + rng.randrange(0, 3 * 86400))
+
+    for _ in range(iterations):
+        params = random_params(rng)
+        check_query(failures, params)
+        check_term_order(failures, rng, params)
+
+    for f in failures:
+        print("FAILED " + f)
+    print("{} iterations, {} failed checks".format(iterations, len(failures)))
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+# This source code is Copyright (c) 2023 Georgia Tech Research Corporation. All
+# Rights Reserved. Permission to copy, modify, and distribute this software and
+# its documentation for academic research and education purposes, without fee,
+# and without a written agreement is hereby granted, provided that the above
+# copyright notice, this paragraph and the following three paragraphs appear in
+# all copies. Permission to make use of this software for other than academic
+# research and education purposes may be obtained by contacting:
+#
+#  Office of Technology Licensing
+#  Georgia Institute of Technology
+#  926 Dalney Street, NW
+#  Atlanta, GA 30318
+#  404.385.8066
+#  techlicensing@gtrc.gatech.edu
+#
+# This software program and documentation are copyrighted by Georgia Tech
+# Research Corporation (GTRC). The software program and documentation are 
+# supplied "as is", without any accompanying services from GTRC. GTRC does
+# not warrant that the operation of the program will be uninterrupted or
+# error-free. The end-user understands that the program was developed for
+# research purposes and is advised not to rely exclusively on the program for
+# any reason.
+#
+# IN NO EVENT SHALL GEORGIA TECH RESEARCH CORPORATION BE LIABLE TO ANY PARTY FOR
+# DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING
+# LOST PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION,
+# EVEN IF GEORGIA TECH RESEARCH CORPORATION HAS BEEN ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE. GEORGIA TECH RESEARCH CORPORATION SPECIFICALLY DISCLAIMS ANY
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED
+# HEREUNDER IS ON AN "AS IS" BASIS, AND  GEORGIA TECH RESEARCH CORPORATION HAS
+# NO OBLIGATIONS TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR
+# MODIFICATIONS.
+#
+# This source code is part of the GRIP software. The original GRIP software is
+# Copyright (c) 2015 The Regents of the University of California. All rights
+# reserved. Permission to copy, modify, and distribute this software for
+# academic research and education purposes is subject to the conditions and
+# copyright notices in the source code files and in the included LICENSE file.
+
+# Check that app/query_match.py compares values the way elasticsearch does,
+# i.e. that query arguments are converted to the type of the field they are
+# matched against -- /json/events parameters always arrive as strings, but
+# summary.ases holds numbers and the "*_ts" dates may be written in several
+# formats.
+# Usage (from the repository root):
+#     python -m benchmarks.check_query_match
+# Each check is run against the matcher directly, against the fake
+# elasticsearch used by the benchmarks and against a live feed subscription,
+# which all use the same matcher. Failed checks are printed.
+
+import os, sys
+
+os.environ.setdefault('GRIP_API_NO_APP', '1')
+
+from werkzeug.datastructures import MultiDict
+
+from app import create_app
+from app.elastic import buildESEventQuery
+from app.feed import EventFeed
+from app.query_match import matches
+from benchmarks.events import make_event
+from benchmarks.fake_services import EventStore, FakeMetaAdapter, \
+        transport_class
+
+VIEW_TS = 1672531200
+
+def make_check_event():
+    event = make_event("moas", n_pfx=2, seed=1, view_ts=VIEW_TS)
+    # integers, as they are stored in elasticsearch
+    assert all(isinstance(a, int) for a in event['summary']['ases'])
+    return event
+
+# (description, query, whether the event should match)
+def query_checks(event):
+    asn = event['summary']['ases'][0]
+    return [
+        ("asn term given as a string", {'term': {'summary.ases': str(asn)}},
+                True),
+        ("asn term given as a number", {'term': {'summary.ases': asn}}, True),
+        ("other asn term", {'term': {'summary.ases': str(asn + 1)}}, False),
+        ("non-numeric asn term", {'term': {'summary.ases': "AS" + str(asn)}},
+                False),
+        ("suspicion range given as strings",
+                {'range': {'summary.inference_result.primary_inference.suspicion_level': {'gte': "0", 'lte': "100"}}},
+                True),
+        ("view_ts range as a space-separated time",
+                {'range': {'view_ts': {'gte': "2023-01-01 00:00:00"}}}, True),
+        ("view_ts range in the old T format",
+                {'range': {'view_ts': {'gt': "2023-01-01T00:00"}}}, False),
+        ("view_ts range as epoch seconds",
+                {'range': {'view_ts': {'lte': str(VIEW_TS)}}}, True),
+        ("view_ts range as epoch milliseconds",
+                {'range': {'view_ts': {'lt': str(VIEW_TS * 1000)}}}, False),
+        ("view_ts range as ISO 8601 with a zone",
+                {'range': {'view_ts': {'gte': "2023-01-01T00:00:00Z"}}},
+                True),
+    ]
+
+# (description, /json/events parameters, whether the event should match)
+def param_checks(event):
+    asn = event['summary']['ases'][0]
+    return [
+        ("asns", {'asns': str(asn)}, True),
+        ("negated asns", {'asns': "!" + str(asn)}, False),
+        ("asns of another event", {'asns': str(asn + 1)}, False),
+        ("asns with ts_start", {'asns': str(asn), 'ts_start': str(VIEW_TS)},
+                True),
+    ]
+
+def check(failures, description, got, expected):
+    if got != expected:
+        failures.append("{}: matched {}, expected {}".format(description,
+                got, expected))
+
+def main():
+    event = make_check_event()
+    failures = []
+
+    for description, query, expected in query_checks(event):
+        check(failures, description, matches(event, query), expected)
+
+    store = EventStore([event])
+    app = create_app({'ES_NODES': ['http://localhost:9200'],
+            'ES_TRANSPORT_CLASS': transport_class(store),
+            'ES_HEALTH_CHECK_INTERVAL': 0,
+            'META_SERVICE': 'http://meta', 'META_ADAPTER': FakeMetaAdapter(),
+            'QUERY_CACHE_MAX_BYTES': 0, 'METRICS_ENABLED': False})
+    client = app.test_client()
+    feed = EventFeed(None)
+
+    for description, params, expected in param_checks(event):
+        params = MultiDict(params)
+        query = buildESEventQuery(params)['query']
+        check(failures, description + " (matcher)", matches(event, query),
+                expected)
+
+        response = client.get("/json/events", query_string=params)
+        ids = [e['id'] for e in response.get_json()['data']]
+        check(failures, description + " (fake elasticsearch)",
+                event['id'] in ids, expected)
+
+        sub = feed.subscribe(params)
+        doc = {'_index': store.docs[event['id']][0], '_source': event}
+        check(failures, description + " (live feed)", sub.wants(doc),
+                expected)
+        feed.unsubscribe(sub)
+
+    for f in failures:
+        print("FAILED " + f)
+    print("{} failed checks".format(len(failures)))
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+# This source code is Copyright (c) 2023 Georgia Tech Research Corporation. All
+# Rights Reserved. Permission to copy, modify, and distribute this software and
+# its documentation for academic research and education purposes, without fee,
+# and without a written agreement is hereby granted, provided that the above
+# copyright notice, this paragraph and the following three paragraphs appear in
+# all copies. Permission to make use of this software for other than academic
+# research and education purposes may be obtained by contacting:
+#
+#  Office of Technology Licensing
+#  Georgia Institute of Technology
+#  926 Dalney Street, NW
+#  Atlanta, GA 30318
+#  404.385.8066
+#  techlicensing@gtrc.gatech.edu
+#
+# This software program and documentation are copyrighted by Georgia Tech
+# Research Corporation (GTRC). The software program and documentation are 
+# supplied "as is", without any accompanying services from GTRC. GTRC does
+# not warrant that the operation of the program will be uninterrupted or
+# error-free. The end-user understands that the program was developed for
+# research purposes and is advised not to rely exclusively on the program for
+# any reason.
+#
+# IN NO EVENT SHALL GEORGIA TECH RESEARCH CORPORATION BE LIABLE TO ANY PARTY FOR
+# DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING
+# LOST PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION,
+# EVEN IF GEORGIA TECH RESEARCH CORPORATION HAS BEEN ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE. GEORGIA TECH RESEARCH CORPORATION SPECIFICALLY DISCLAIMS ANY
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED
+# HEREUNDER IS ON AN "AS IS" BASIS, AND  GEORGIA TECH RESEARCH CORPORATION HAS
+# NO OBLIGATIONS TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR
+# MODIFICATIONS.
+#
+# This source code is part of the GRIP software. The original GRIP software is
+# Copyright (c) 2015 The Regents of the University of California. All rights
+# reserved. Permission to copy, modify, and distribute this software for
+# academic research and education purposes is subject to the conditions and
+# copyright notices in the source code files and in the included LICENSE file.
+
+# Synthetic GRIP events for the benchmarks.
+#
+# The documents mimic the structure of the events stored in elasticsearch
+# (summary, inference results, per-prefix pfx_events with their details and
+# traceroute data) closely enough that their size and the cost of handling
+# them are representative, but the values themselves are made up.
+
+import random
+
+EVENT_TYPES = ['moas', 'submoas', 'defcon', 'edges']
+
+TAG_NAMES = ['all-newcomers', 'newcomer-small-asn', 'no-newcomer',
+        'single-rel-upstream', 'victim-has-rpki', 'attacker-no-rpki',
+        'due-to-private-asn', 'less-than-2-peers', 'oldcomer-path-prepending',
+        'not-previously-announced-by-any-newcomer', 'some-origins-are-siblings']
+
+INFERENCE_IDS = ['misconfig-prepending', 'default-tr-worthy',
+        'suspicious-newcomer', 'benign-siblings', 'rpki-invalid-newcomer']
+
+def _ts(epoch):
+    import time
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(epoch))
+
+def _prefix(rng, length=24):
+    a, b, c = rng.randrange(1, 224), rng.randrange(256), rng.randrange(256)
+    if length == 16:
+        return "{}.{}.0.0/16".format(a, b)
+    return "{}.{}.{}.0/24".format(a, b, c)
+
+def _aspath(rng, origin):
+    return " ".join(str(rng.randrange(1, 65000))
+            for _ in range(rng.randrange(2, 6))) + " " + str(origin)
+
+def _tags(rng, n):
+    return [{"name": t, "comment": "", "definition": ""}
+            for t in rng.sample(TAG_NAMES, n)]
+
+def _inference(rng):
+    return {"inference_id": rng.choice(INFERENCE_IDS),
+            "explanation": "synthetic inference for benchmarking",
+            "suspicion_level": rng.randrange(0, 101), "confidence": 50,
+            "labels": ["tr-worthy"] if rng.random() < 0.3 else []}
+
+def make_pfx_event(rng, event_type, ases):
+    if event_type in ['moas', 'edges']:
+        details = {"prefix": _prefix(rng)}
+    else:
+        details = {"sub_pfx": _prefix(rng), "super_pfx": _prefix(rng, 16)}
+
+    details.update({
+        "origins": ases,
+        "aspaths": [_aspath(rng, a) for a in ases for _ in range(3)],
+        "newcomer_origins": ases[1:],
+        "old_origins": ases[:1],
+    })
+
+    return {
+        "tags": _tags(rng, 3),
+        "finished_ts": None,
+        "inferences": [_inference(rng)],
+        "details": details,
+        "traceroutes": {
+            "worthy": rng.random() < 0.5,
+            "msm_ids": [rng.randrange(10 ** 7, 10 ** 8) for _ in range(4)],
+            "results": [{"prb_id": rng.randrange(1, 10 ** 6),
+                         "hops": [str(rng.randrange(1, 65000)) for _ in range(8)]}
+                        for _ in range(2)],
+        },
+        "event_type": event_type,
+        "position": "NEW",
+    }
+
+# build one event with `n_pfx` prefix events
+def make_event(event_type="moas", n_pfx=10, seed=None, finished=True,
+        view_ts=1672531200):
+    rng = random.Random(seed)
+
+    if event_type == 'submoas':
+        victims = [rng.randrange(1, 400000) for _ in range(2)]
+        attackers = [rng.randrange(1, 400000) for _ in range(2)]
+        asstr = "{}={}".format("_".join(map(str, victims)),
+                "_".join(map(str, attackers)))
+        ases = victims + attackers
+    else:
+        ases = sorted(set(rng.randrange(1, 400000) for _ in range(2)))
+        asstr = "_".join(map(str, ases))
+
+    evid = "{}-{}-{}".format(event_type, view_ts, asstr)
+    pfx_events = [make_pfx_event(rng, event_type, ases) for _ in range(n_pfx)]
+    primary = _inference(rng)
+
+    return {
+        "id": evid,
+        "event_type": event_type,
+        "view_ts": _ts(view_ts),
+        "finished_ts": _ts(view_ts + 3600) if finished else None,
+        "insert_ts": _ts(view_ts + 300),
+        "last_modified_ts": _ts(view_ts + (3600 if finished else 600)),
+        "duration": 3600 if finished else None,
+        "position": "NEW",
+        "asinfo": {str(a): {"asn": a, "org": "Synthetic Org %d" % a,
+                "country": "US"} for a in ases},
+        "tr_metrics": {"total_tr_worthy": n_pfx // 2, "total_tr_sent": 0},
+        "event_metrics": {"total_pfx_count": n_pfx},
+        "summary": {
+            "prefixes": sorted(set(p["details"].get("prefix",
+                    p["details"].get("sub_pfx")) for p in pfx_events)),
+            "ases": ases,
+            "tags": _tags(rng, 4),
+            "inference_result": {
+                "primary_inference": primary,
+                "inferences": [primary, _inference(rng)],
+            },
+        },
+        "pfx_events": pfx_events,
+        "debug": {"notes": "x" * 64},
+    }
+
+# a list of events of mixed types and sizes, like a page of /json/events
+def make_events(count=100, n_pfx=10, seed=0):
+    rng = random.Random(seed)
+    return [make_event(rng.choice(EVENT_TYPES), n_pfx=rng.randrange(1, 2 * n_pfx),
+            seed=rng.random(), view_ts=1672531200 + i * 300)
+            for i in range(count)]
@@ -0,0 +1,472 @@
+# This source code is Copyright (c) 2023 Georgia Tech Research Corporation. All
+# Rights Reserved. Permission to copy, modify, and distribute this software and
+# its documentation for academic research and education purposes, without fee,
+# and without a written agreement is hereby granted, provided that the above
+# copyright notice, this paragraph and the following three paragraphs appear in
+# all copies. Permission to make use of this software for other than academic
+# research and education purposes may be obtained by contacting:
+#
+#  Office of Technology Licensing
+#  Georgia Institute of Technology
+#  926 Dalney Street, NW
+#  Atlanta, GA 30318
+#  404.385.8066
+#  techlicensing@gtrc.gatech.edu
+#
+# This software program and documentation are copyrighted by Georgia Tech
+# Research Corporation (GTRC). The software program and documentation are 
+# supplied "as is", without any accompanying services from GTRC. GTRC does
+# not warrant that the operation of the program will be uninterrupted or
+# error-free. The end-user understands that the program was developed for
+# research purposes and is advised not to rely exclusively on the program for
+# any reason.
+#
+# IN NO EVENT SHALL GEORGIA TECH RESEARCH CORPORATION BE LIABLE TO ANY PARTY FOR
+# DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING
+# LOST PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION,
+# EVEN IF GEORGIA TECH RESEARCH CORPORATION HAS BEEN ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE. GEORGIA TECH RESEARCH CORPORATION SPECIFICALLY DISCLAIMS ANY
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED
+# HEREUNDER IS ON AN "AS IS" BASIS, AND  GEORGIA TECH RESEARCH CORPORATION HAS
+# NO OBLIGATIONS TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR
+# MODIFICATIONS.
+#
+# This source code is part of the GRIP software. The original GRIP software is
+# Copyright (c) 2015 The Regents of the University of California. All rights
+# reserved. Permission to copy, modify, and distribute this software for
+# academic research and education purposes is subject to the conditions and
+# copyright notices in the source code files and in the included LICENSE file.
+
+# In-process stand-ins for elasticsearch and the meta service, so that the
+# app can be benchmarked (and its queries checked) without a network.
+#
+# EventStore holds a set of event documents and answers the requests that
+# the app makes: get, _source, mget, search (queries, sorting, paging,
+# search_after, source filtering, track_total_hits, aggregations, the
+# pfx_event lookup script and points in time) and get_alias. Hook it up with
+#     create_app({..., 'ES_TRANSPORT_CLASS': transport_class(store),
+#             'META_SERVICE': 'http://meta', 'META_ADAPTER': FakeMetaAdapter()})
+# or, for create_asgi_app(), with async_transport_class(store).
+#
+# Responses are encoded as JSON and decoded by the client's serializer just
+# like real ones, so decoding costs are included in measurements, but the
+# stand-in's own work (matching, encoding) is cached as far as possible so
+# that it doesn't swamp the app's.
+
+import json, time
+from collections import Counter
+from datetime import datetime, timedelta
+from fnmatch import fnmatchcase
+from functools import cmp_to_key
+from urllib.parse import unquote, urlparse
+
+import requests
+from elasticsearch import AsyncTransport, Transport
+from elasticsearch.connection_pool import DummyConnectionPool, \
+        EmptyConnectionPool
+from elasticsearch.exceptions import NotFoundError
+from elasticsearch.serializer import JSONSerializer
+
+from app.elastic import event_index_name, find_pfx_event
+from app.query_match import field_values, matches
+from benchmarks.events import TAG_NAMES
+
+# the parts of `src` selected by a list of _source includes
+def filter_source(src, includes, prefix=''):
+    out = {}
+    for k, v in src.items():
+        path = prefix + k
+        if any(fnmatchcase(path, i) for i in includes):
+            out[k] = v
+            continue
+        if not any(i.startswith(path + ".") or "*" in i for i in includes):
+            continue
+
+        if isinstance(v, dict):
+            sub = filter_source(v, includes, path + ".")
+            if sub:
+                out[k] = sub
+        elif isinstance(v, list):
+            items = [filter_source(x, includes, path + ".") for x in v
+                    if isinstance(x, dict)]
+            items = [x for x in items if x]
+            if items:
+                out[k] = items
+    return out
+
+# the sort order of a search, as a list of (field, descending) pairs -- given
+# either as a "field:dir,..." parameter or as a list in the body
+def sort_spec(params, body):
+    spec = params.get('sort', body.get('sort'))
+    if spec is None:
+        return [('view_ts', True), ('id', True)]
+    if isinstance(spec, str):
+        spec = [dict([s.split(":")]) for s in spec.split(",")]
+    return [(field, direction == 'desc') for s in spec
+            for field, direction in s.items()]
+
+def sort_values(doc, spec):
+    return [doc.get(field) for field, _ in spec]
+
+# compare the sort values of two documents, with missing values last
+def compare_sort_values(a, b, spec):
+    for x, y, (_, desc) in zip(a, b, spec):
+        if x == y:
+            continue
+        if x is None or y is None:
+            return 1 if x is None else -1
+        if desc:
+            return -1 if x > y else 1
+        return -1 if x < y else 1
+    return 0
+
+def _date_bucket(value, interval):
+    if interval == 'week':
+        day = datetime.strptime(value[:10], "%Y-%m-%d")
+        return (day - timedelta(days=day.weekday())).strftime(
+                "%Y-%m-%d 00:00:00")
+    keep = {'hour': 13, 'day': 10, 'month': 7, 'year': 4}[interval]
+    return value[:keep] + "0000-01-01 00:00:00"[keep:]
+
+class EventStore(object):
+    def __init__(self, events=()):
+        self.docs = {}
+        self.indices = {}
+
+        self._encoded = {}
+        self._matches = {}
+        self._pits = {}
+
+        for event in events:
+            self.add(event)
+
+    def add(self, event):
+        index = event_index_name(event['id'])
+        self.docs[event['id']] = (index, event)
+        self.indices.setdefault(index, set()).add(event['id'])
+        self._matches.clear()
+
+    # the JSON for a document's _source, filtered by `includes` if given
+    def _source_json(self, evid, includes=None):
+        key = (evid, includes)
+        encoded = self._encoded.get(key)
+        if encoded is None:
+            src = self.docs[evid][1]
+            if includes is not None:
+                src = filter_source(src, includes)
+            encoded = json.dumps(src, separators=(",", ":"))
+            self._encoded[key] = encoded
+        return encoded
+
+    def _index_names(self, pattern):
+        names = set()
+        for p in pattern.split(","):
+            names.update(n for n in self.indices if fnmatchcase(n, p))
+        return names
+
+    # the IDs of the events in `pattern` matching `query`, in the order
+    # given by the sort spec
+    def _match(self, pattern, query, spec):
+        key = json.dumps([pattern, query, spec], sort_keys=True)
+        found = self._matches.get(key)
+        if found is None:
+            docs = [self.docs[evid][1] for name in self._index_names(pattern)
+                    for evid in self.indices[name]]
+            if query is not None:
+                docs = [d for d in docs if matches(d, query)]
+            docs.sort(key=cmp_to_key(lambda a, b: compare_sort_values(
+                    sort_values(a, spec), sort_values(b, spec), spec)))
+            found = [d['id'] for d in docs]
+            self._matches[key] = found
+        return found
+
+    def handle(self, method, url, params, body):
+        parts = [unquote(p) for p in urlparse(url).path.split("/") if p]
+        # the client escapes query parameters to bytes
+        params = {k: v.decode('utf-8') if isinstance(v, bytes) else v
+                for k, v in params.items()}
+
+        if method == 'HEAD' and len(parts) == 0:
+            return 200, None
+        if len(parts) == 3 and parts[1] in ('_doc', '_source'):
+            includes = params.get('_source_includes')
+            if includes is not None:
+                includes = tuple(includes.split(","))
+            return self.get(parts[0], parts[2], parts[1] == '_source',
+                    includes)
+        if parts[-1] == '_search':
+            return self.search(parts[0] if len(parts) == 2 else None,
+                    params, body or {})
+        if parts[-1] == '_mget':
+            return self.mget(parts[0], body['ids'])
+        if parts[-1] == '_pit':
+            if method == 'DELETE':
+                self._pits.pop(body['id'], None)
+                return 200, '{"succeeded":true,"num_freed":1}'
+            pit_id = "pit-{}".format(len(self._pits) + 1)
+            self._pits[pit_id] = parts[0]
+            return 200, json.dumps({'id': pit_id})
+        if parts[-1] == '_alias':
+            names = self._index_names(parts[0])
+            if len(names) == 0 and "*" not in parts[0]:
+                return 404, None
+            return 200, json.dumps({n: {'aliases': {}} for n in names})
+
+        raise ValueError("unsupported request {} {}".format(method, url))
+
+    def get(self, index, evid, source_only, includes=None):
+        if evid not in self.docs or self.docs[evid][0] != index:
+            return 404, None
+        if source_only:
+            return 200, self._source_json(evid, includes)
+        return 200, '{{"_index":{},"_id":{},"found":true,"_source":{}}}'.format(
+                json.dumps(index), json.dumps(evid),
+                self._source_json(evid, includes))
+
+    def mget(self, index, ids):
+        docs = []
+        for evid in ids:
+            if evid in self.docs and self.docs[evid][0] == index:
+                docs.append('{{"_index":{},"_id":{},"found":true,"_source":{}}}'
+                        .format(json.dumps(index), json.dumps(evid),
+                        self._source_json(evid)))
+            else:
+                docs.append(json.dumps({'_index': index, '_id': evid,
+                        'found': False}))
+        return 200, '{"docs":[' + ",".join(docs) + ']}'
+
+    def search(self, index, params, body):
+        if 'pit' in body:
+            index = self._pits[body['pit']['id']]
+        if 'script_fields' in body:
+            return self._script_search(index, body)
+
+        spec = sort_spec(params, body)
+        found = self._match(index, body.get('query'), spec)
+        total = len(found)
+
+        search_after = body.get('search_after')
+        if search_after is not None:
+            found = [evid for evid in found if compare_sort_values(
+                    sort_values(self.docs[evid][1], spec), search_after,
+                    spec) > 0]
+
+        start = int(params.get('from', body.get('from', 0)))
+        size = int(params.get('size', body.get('size', 10)))
+        page = found[start:start + size]
+
+        includes = params.get('_source_includes')
+        if includes is not None:
+            includes = tuple(includes.split(","))
+        elif isinstance(body.get('_source'), list):
+            includes = tuple(body['_source'])
+
+        hits = []
+        for evid in page:
+            index_name, doc = self.docs[evid]
+            hits.append('{{"_index":{},"_id":{},"_source":{},"sort":{}}}'
+                    .format(json.dumps(index_name), json.dumps(evid),
+                    self._source_json(evid, includes),
+                    json.dumps(sort_values(doc, spec))))
+
+        ret = '{"took":1,"timed_out":false,"hits":{'
+        tracked = str(params.get('track_total_hits',
+                body.get('track_total_hits', 10000))).lower()
+        if tracked != 'false':
+            if tracked != 'true' and total > int(tracked):
+                ret += '"total":{{"value":{},"relation":"gte"}},'.format(
+                        tracked)
+            else:
+                ret += '"total":{{"value":{},"relation":"eq"}},'.format(total)
+        ret += '"hits":[' + ",".join(hits) + ']}'
+
+        if 'aggs' in body:
+            docs = [self.docs[evid][1] for evid in self._match(index,
+                    body.get('query'), spec)]
+            ret += ',"aggregations":' + json.dumps(self._aggregate(docs,
+                    body['aggs']))
+        if 'pit' in body:
+            ret += ',"pit_id":' + json.dumps(body['pit']['id'])
+        return 200, ret + '}'
+
+    def _script_search(self, index, body):
+        evid = body['query']['ids']['values'][0]
+        if evid not in self.docs or \
+                self.docs[evid][0] not in self._index_names(index):
+            return 200, '{"took":1,"hits":{"total":{"value":0,"relation":"eq"},"hits":[]}}'
+
+        doc = self.docs[evid][1]
+        search = body['script_fields']['pfx_match']['script']['params']['search']
+        fields = {'event_type': doc['event_type']}
+        pfxevent = find_pfx_event(doc, search)
+        if pfxevent is not None:
+            fields['pfx_event'] = pfxevent
+        return 200, json.dumps({'took': 1, 'hits': {
+                'total': {'value': 1, 'relation': 'eq'},
+                'hits': [{'_id': evid, 'fields': {'pfx_match': [fields]}}]}})
+
+    def _aggregate(self, docs, aggs):
+        out = {}
+        for name, spec in aggs.items():
+            (atype, agg), = spec.items()
+            field = agg['field']
+
+            if atype == 'terms':
+                counts = Counter(v for d in docs
+                        for v in set(field_values(d, field)))
+                top = sorted(counts.items(), key=lambda kv: (-kv[1],
+                        str(kv[0])))[:agg.get('size', 10)]
+                buckets = [{'key': k, 'doc_count': n} for k, n in top]
+
+            elif atype == 'date_histogram':
+                counts = Counter(_date_bucket(v, agg['calendar_interval'])
+                        for d in docs for v in field_values(d, field)[:1])
+                buckets = [{'key_as_string': k, 'key': k, 'doc_count': n}
+                        for k, n in sorted(counts.items())]
+
+            else:
+                interval = agg['interval']
+                counts = Counter(int(v // interval * interval) for d in docs
+                        for v in field_values(d, field)[:1])
+                bounds = agg.get('extended_bounds', {})
+                keys = set(counts)
+                if bounds:
+                    keys.update(range(int(bounds['min']),
+                            int(bounds['max']) + 1, int(interval)))
+                buckets = [{'key': k, 'doc_count': counts.get(k, 0)}
+                        for k in sorted(keys)]
+
+            out[name] = {'buckets': buckets}
+        return out
+
+# the elasticsearch client's connection, only used directly by
+# ElasticSearchConn._rawRequest()
+class FakeConnection(object):
+    def __init__(self, store):
+        self.store = store
+
+    def perform_request(self, method, url, params=None, body=None,
+            headers=None, **kwargs):
+        status, data = self.store.handle(method, url, params or {}, body)
+        if status == 404:
+            raise NotFoundError(404, "not_found", {})
+        return status, {}, data
+
+class FakeTransport(Transport):
+    store = None
+
+    def __init__(self, hosts, serializer=None, **kwargs):
+        self.serializer = serializer or JSONSerializer()
+        self.max_retries = 0
+        self.connection = FakeConnection(self.store)
+
+    def get_connection(self):
+        return self.connection
+
+    def mark_dead(self, connection):
+        pass
+
+    def close(self):
+        pass
+
+    def perform_request(self, method, url, headers=None, params=None,
+            body=None):
+        if body is not None:
+            # what the real transport would send
+            self.serializer.dumps(body)
+
+        status, data = self.store.handle(method, url, params or {}, body)
+        if status == 404:
+            if method == 'HEAD':
+                return False
+            raise NotFoundError(404, "not_found", {})
+        if method == 'HEAD':
+            return True
+        return self.serializer.loads(data)
+
+# a FakeTransport class that serves the events in `store`, for the
+# ES_TRANSPORT_CLASS config option
+def transport_class(store):
+    return type("FakeTransport", (FakeTransport,), {'store': store})
+
+# The same for the AsyncElasticsearch client used by app/asgi.py: every
+# request is answered straight away by a FakeTransport. Like the real
+# AsyncTransport, it has no connection to hand out until it has been
+# initialized on the event loop by its first request (or _async_call()).
+class FakeAsyncConnection(object):
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def perform_request(self, *args, **kwargs):
+        return self.connection.perform_request(*args, **kwargs)
+
+class FakeAsyncTransport(AsyncTransport):
+    store = None
+
+    def __init__(self, hosts, serializer=None, **kwargs):
+        self.sync = transport_class(self.store)(hosts, serializer)
+        self.serializer = self.sync.serializer
+        self.max_retries = 0
+        self.connection_pool = EmptyConnectionPool()
+        self._async_init_called = False
+        self._sniff_on_start_event = None
+        self.sniffer_timeout = None
+
+    async def _async_init(self):
+        self.connection_pool = DummyConnectionPool(
+                [(FakeAsyncConnection(self.sync.connection), {})])
+
+    def mark_dead(self, connection):
+        pass
+
+    async def close(self):
+        pass
+
+    async def perform_request(self, *args, **kwargs):
+        await self._async_call()
+        return self.sync.perform_request(*args, **kwargs)
+
+def async_transport_class(store):
+    return type("FakeAsyncTransport", (FakeAsyncTransport,),
+            {'store': store})
+
+def make_meta_payloads(n_asns=2000):
+    return {
+        '/tags': {'tags': {name: {'definition': "synthetic tag " + name,
+                'comment': ""} for name in TAG_NAMES}},
+        '/asndrop': {'asndrop': list(range(64512, 64512 + n_asns))},
+        '/blacklist': {'blacklist': list(range(1000, 1000 + n_asns // 4))},
+    }
+
+# A requests transport adapter that answers for the meta service, for the
+# META_ADAPTER config option. `latency` (in seconds) is added to every
+# request.
+class FakeMetaAdapter(requests.adapters.BaseAdapter):
+    def __init__(self, payloads=None, latency=0.0):
+        super().__init__()
+        self.payloads = payloads if payloads is not None else \
+                make_meta_payloads()
+        self.latency = latency
+        self.requests = 0
+
+    def send(self, request, **kwargs):
+        self.requests += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        path = urlparse(request.url).path
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        if path in self.payloads:
+            response.status_code = 200
+            response._content = json.dumps(self.payloads[path]).encode('utf-8')
+            response.headers['Content-Type'] = 'application/json'
+        else:
+            response.status_code = 404
+            response._content = b''
+        return response
+
+    def close(self):
+        pass